@@ -0,0 +1,161 @@
+"""Circuit breaker for the docker daemon.
+
+When the daemon is unhealthy, retrying every docker command in every
+xdist worker turns a failure into a long hang. The circuit breaker
+keeps its state in the state directory so that, after consecutive
+daemon failures in any process, all processes fail fast:
+
+    >>> from pytest_xdocker.cache import MemoryCache
+    >>> from pytest_xdocker.lock import MemoryLock
+    >>> breaker = CircuitBreaker(MemoryCache(), MemoryLock(), threshold=1)
+    >>> with breaker:
+    ...     raise TimeoutExpired("docker", 1)
+    Traceback (most recent call last):
+    ...
+    subprocess.TimeoutExpired: Command 'docker' timed out after 1 seconds
+    >>> with breaker:
+    ...     pass
+    Traceback (most recent call last):
+    ...
+    pytest_xdocker.breaker.CircuitOpenError: Circuit breaker/docker is open
+
+After a cooldown, the circuit is half-open and a single operation is
+attempted to probe whether the daemon recovered.
+"""
+
+import re
+from functools import cache
+from subprocess import CalledProcessError, TimeoutExpired
+from time import time
+
+from attrs import define, field
+
+from pytest_xdocker.cache import FileCache, get_state_dir
+from pytest_xdocker.lock import get_lock_class
+
+DAEMON_ERROR_PATTERN = (
+    r"Cannot connect to the Docker daemon"
+    r"|Is the docker daemon running"
+    r"|docker daemon is not running"
+    r"|error during connect"
+)
+
+
+def is_daemon_error(error):
+    """Check if an error was caused by the docker daemon.
+
+    :param error: Exception raised when running a docker command.
+    """
+    if isinstance(error, TimeoutExpired):
+        return True
+
+    if isinstance(error, CalledProcessError):
+        output = "".join(o for o in [error.output, error.stderr] if isinstance(o, str))
+        return bool(re.search(DAEMON_ERROR_PATTERN, output, re.IGNORECASE))
+
+    return False
+
+
+class CircuitOpenError(Exception):
+    """Raised when the circuit is open, without attempting the operation."""
+
+
+@define
+class CircuitBreaker:
+    """Circuit breaker shared across processes.
+
+    :param cache: `Cache` for the state of the circuit.
+    :param lock: `BaseLock` to change the state of the circuit.
+    :param key: Key of the state in the cache.
+    :param threshold: Number of consecutive failures to open the circuit.
+    :param cooldown: Seconds before probing an open circuit.
+    :param is_failure: Function to check if an error is a failure.
+    """
+
+    cache = field()
+    lock = field()
+    key = field(default="breaker/docker")
+    threshold = field(default=5)
+    cooldown = field(default=30)
+    is_failure = field(default=is_daemon_error)
+    clock = field(default=time)
+
+    @classmethod
+    def from_state_dir(cls, name, **kwargs):
+        """Make a circuit breaker in the state directory."""
+        state_dir = get_state_dir()
+        cache = FileCache(state_dir)
+        lock = get_lock_class()(state_dir / f"breaker-{name}.lock")
+        return cls(cache, lock, key=f"breaker/{name}", **kwargs)
+
+    def _get_state(self):
+        return self.cache.get(self.key, None) or {"failures": 0, "opened": None, "probing": None}
+
+    @property
+    def is_open(self):
+        """Return True if operations fail fast, False otherwise."""
+        state = self._get_state()
+        if state["opened"] is None:
+            return False
+
+        now = self.clock()
+        since = max(state["opened"], state["probing"] or 0)
+        return now - since < self.cooldown
+
+    def before(self):
+        """Check the circuit before attempting an operation.
+
+        :raises CircuitOpenError: If the circuit is open, or half-open
+            while another operation is probing.
+        """
+        # Avoid locking in the usual case where the circuit is closed.
+        if self._get_state()["opened"] is None:
+            return
+
+        with self.lock:
+            if self.is_open:
+                raise CircuitOpenError(f"Circuit {self.key} is open")
+
+            state = self._get_state()
+            if state["opened"] is not None:
+                state["probing"] = self.clock()
+                self.cache.set(self.key, state)
+
+    def success(self):
+        """Close the circuit after a successful operation."""
+        state = self._get_state()
+        if state["failures"] or state["opened"] is not None:
+            with self.lock:
+                self.cache.set(self.key, None)
+
+    def failure(self):
+        """Count a failure, opening the circuit after the threshold."""
+        with self.lock:
+            state = self._get_state()
+            state["failures"] += 1
+            if state["failures"] >= self.threshold or state["probing"] is not None:
+                state["opened"] = self.clock()
+                state["probing"] = None
+
+            self.cache.set(self.key, state)
+
+    def __enter__(self):
+        self.before()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_val is None:
+            self.success()
+        elif self.is_failure(exc_val):
+            self.failure()
+        elif isinstance(exc_val, Exception):
+            # Any other error means the daemon responded.
+            self.success()
+
+        return False
+
+
+@cache
+def get_docker_breaker():
+    """Get the circuit breaker for the docker daemon on this host."""
+    return CircuitBreaker.from_state_dir("docker")
@@ -1,12 +1,76 @@
-"""Cache providers."""
+"""Cache providers.
+
+The payloads are JSON by default, which is compatible with the pytest
+cache. Faster codecs can be selected per cache, their payloads start
+with a header byte so that existing JSON payloads remain readable:
+
+    >>> codec = get_codec("pickle")
+    >>> payload = codec.encode({"ports": (8080, 8081)})
+    >>> codec.decode(payload)
+    {'ports': (8080, 8081)}
+    >>> codec.decode(cache_encode({"ports": [8080, 8081]}))
+    {'ports': [8080, 8081]}
+
+The orjson and msgpack codecs require installing the corresponding
+package.
+"""
 
-import codecs
 import json
+import os
+import pickle
+import sqlite3
+import threading
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager, suppress
+from functools import cache, partial
+from getpass import getuser
+from math import inf
 from pathlib import Path
+from stat import S_IMODE, S_ISDIR, S_ISLNK
+from tempfile import gettempdir
+from time import time
 
 from attrs import define, field
 
+from pytest_xdocker.lock import FileLock
+
+STATE_DIR_ENV = "XDOCKER_STATE_DIR"
+"""Environment variable to override the state directory."""
+
+
+def get_state_dir():
+    """Get the directory for the state shared by all processes on this host.
+
+    The state is about the docker daemon, like circuit breakers, so it
+    defaults to a directory in the temp dir rather than in a project.
+    That directory has a predictable name, so it must be private and
+    owned by the current user, otherwise another user could control
+    the state.
+
+    :raises CacheError: If the default directory is a symlink or is
+        owned by another user.
+    """
+    path = os.environ.get(STATE_DIR_ENV)
+    if path is not None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    path = Path(gettempdir()) / f"pytest-xdocker-{getuser()}"
+    path.mkdir(mode=0o700, exist_ok=True)
+    stat = path.lstat()
+    if S_ISLNK(stat.st_mode) or not S_ISDIR(stat.st_mode):
+        raise CacheError(f"Expecting {path} to be a directory, not a symlink")
+
+    if hasattr(os, "getuid"):
+        if stat.st_uid != os.getuid():
+            raise CacheError(f"Expecting {path} to be owned by the current user, set {STATE_DIR_ENV} otherwise")
+
+        if S_IMODE(stat.st_mode) & 0o077:
+            path.chmod(0o700)
+
+    return path
+
 
 def cache_encode(data):
     """Serialize cache payload."""
@@ -14,8 +78,77 @@ def cache_encode(data):
 
 
 def cache_decode(payload):
-    """Deserialize cache payload."""
-    return json.loads(codecs.decode(payload, "utf-8"))
+    """Deserialize cache payload, JSON or from a codec other than pickle."""
+    name = CODEC_HEADERS.get(payload[:1])
+    if name is not None and name != "pickle":
+        return get_codec(name).loads(payload[1:])
+
+    return json.loads(payload)
+
+
+@define(frozen=True)
+class Codec:
+    """Codec of cache payloads, prefixed with a header byte.
+
+    :param name: Name of the codec.
+    :param header: Byte identifying the payloads of the codec, empty for JSON.
+    :param dumps: Function serializing data to bytes.
+    :param loads: Function deserializing bytes to data.
+    """
+
+    name = field()
+    header = field()
+    dumps = field()
+    loads = field()
+
+    def encode(self, data):
+        """Serialize cache payload with the header, see `cache_encode`."""
+        return self.header + self.dumps(data)
+
+    def decode(self, payload):
+        """Deserialize cache payload from this codec or else `cache_decode`."""
+        if self.header and payload[:1] == self.header:
+            return self.loads(payload[1:])
+
+        return cache_decode(payload)
+
+
+CODEC_HEADERS = {
+    b"\x01": "orjson",
+    b"\x02": "msgpack",
+    b"\x03": "pickle",
+}
+"""Names of the codecs by header byte."""
+
+
+@cache
+def get_codec(name):
+    """Get a codec by name, importing its package lazily.
+
+    Pickle payloads can run arbitrary code when decoded, so they are only
+    decoded by the pickle codec itself and never by `cache_decode`.
+
+    :param name: Name of the codec, one of json, orjson, msgpack or pickle.
+    """
+    if name == "json":
+        return Codec(name, b"", cache_encode, json.loads)
+
+    headers = {n: h for h, n in CODEC_HEADERS.items()}
+    if name == "orjson":
+        import orjson
+
+        return Codec(name, headers[name], orjson.dumps, orjson.loads)
+    elif name == "msgpack":
+        import msgpack
+
+        return Codec(name, headers[name], msgpack.packb, partial(msgpack.unpackb, strict_map_key=False))
+    elif name == "pickle":
+        return Codec(name, headers[name], pickle.dumps, pickle.loads)
+    else:
+        raise ValueError(f"Unknown codec: {name}")
+
+
+_missing = object()
 
 
 class CacheError(Exception):
@@ -33,54 +166,542 @@ def get(self, key, default):
     def set(self, key, value):
         """Save value for the given key."""
 
+    def get_many(self, keys, default):
+        """Return a dict of the cached values for the given keys or the default."""
+        return {key: self.get(key, default) for key in keys}
+
+    def set_many(self, items):
+        """Save the values of a dict of keys."""
+        for key, value in items.items():
+            self.set(key, value)
+
+    def setdefault(self, key, value):
+        """Save the value unless the key exists, and return the saved value.
+
+        This is only atomic for caches overriding it.
+        """
+        existing = self.get(key, _missing)
+        if existing is _missing:
+            self.set(key, value)
+            return value
+
+        return existing
+
+    def compare_and_set(self, key, expected, value):
+        """Save the value only if the key has the expected value.
+
+        This is only atomic for caches overriding it.
+
+        :param expected: Expected value, None when the key should not exist.
+        :return: True if the value was saved, False otherwise.
+        """
+        if self.get(key, None) != expected:
+            return False
+
+        self.set(key, value)
+        return True
+
+    def get_generation(self, key):
+        """Return a cheap token that changes when the value of the key changes.
+
+        This is used to check if a copy of the value is stale, None means
+        unknown and the copy is always stale.
+        """
+        return None
+
+    def compact(self, prefix=""):  # noqa: B027
+        """Remove the expired and evicted values of keys with the prefix.
+
+        Nothing is removed by default, caches with bounds override this.
+        """
+
+
+@define(frozen=True)
+class CacheAdapter(Cache):
+    """Adapt any object with get and set methods to a `Cache`.
+
+    :param cache: Object with get and set methods.
+    """
+
+    _cache = field()
+
+    def get(self, key, default):
+        """Get from the adapted cache."""
+        return self._cache.get(key, default)
+
+    def set(self, key, value):
+        """Set in the adapted cache."""
+        self._cache.set(key, value)
+
+
+def as_cache(cache, **kwargs):
+    """Adapt a cache to a `Cache`, eg the pytest cache.
+
+    The pytest cache is adapted to a `FileCache` in its xdocker directory,
+    other objects with get and set methods to a `CacheAdapter`.
+
+    :param kwargs: Keyword arguments passed to the `FileCache` when
+        adapting the pytest cache.
+    """
+    if isinstance(cache, Cache):
+        return cache
+
+    mkdir = getattr(cache, "mkdir", None)
+    if mkdir is None:
+        return CacheAdapter(cache)
+
+    return FileCache(mkdir("xdocker"), **kwargs)
+
 
 @define(frozen=True)
 class FileCache(Cache):
     """Lightweight implementation of `pytest.cache`.
 
+    Values expire after the ttl since they were written, based on the
+    modification time of their file. The least recently read values
+    beyond the max size are evicted when compacting, based on the
+    access time of their file.
+
     :param path: Base path to cache directory.
     :param encode: Encoding function, defaults to `cache_encode`
     :param decode: Decoding function, defaults to `cache_decode`
+    :param ttl: Optional time in seconds before values expire.
+    :param max_size: Optional number of values kept when compacting.
     """
 
     _cachedir = field(converter=Path)
     encode = field(default=cache_encode)
     decode = field(default=cache_decode)
+    ttl = field(default=None, kw_only=True)
+    max_size = field(default=None, kw_only=True)
+    clock = field(default=time, kw_only=True)
 
     def _get_value_path(self, key):
-        path = self._cachedir / "v" / key
-        path.parent.mkdir(parents=True, exist_ok=True)
-        return path
+        return self._cachedir / "v" / key
+
+    def _is_expired(self, stat):
+        return self.ttl is not None and stat.st_mtime + self.ttl < self.clock()
 
     def get(self, key, default):
-        """Read from file."""
+        """Read from file, removing it when expired."""
         path = self._get_value_path(key)
-        if path.exists():
+        try:
+            stat = path.stat()
+            if self._is_expired(stat):
+                path.unlink()
+                return default
+
             payload = path.read_bytes()
-            return self.decode(payload)
-        else:
+        except FileNotFoundError:
             return default
 
+        if self.max_size is not None:
+            # Keep the modification time for the ttl.
+            with suppress(FileNotFoundError):
+                os.utime(path, (self.clock(), stat.st_mtime))
+
+        return self.decode(payload)
+
+    def get_generation(self, key):
+        """Return the inode and mtime, which change when a value is replaced.
+
+        An expired value has the generation of a missing value.
+        """
+        try:
+            stat = self._get_value_path(key).stat()
+        except FileNotFoundError:
+            return 0
+
+        if self._is_expired(stat):
+            return 0
+
+        return stat.st_ino, stat.st_mtime_ns
+
     def set(self, key, value):
         """Write to file."""
         path = self._get_value_path(key)
-        payload = self.encode(value)
-        path.write_bytes(payload)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Replace atomically so that concurrent readers never read half a value.
+        temp = self._write_temp(path, value)
+        os.replace(temp, path)
+
+    def _write_temp(self, path, value):
+        temp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        temp.write_bytes(self.encode(value))
+        return temp
+
+    def setdefault(self, key, value):
+        """Link a new file, which fails atomically when the file exists."""
+        path = self._get_value_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = self._write_temp(path, value)
+        try:
+            while True:
+                try:
+                    os.link(temp, path)
+                except FileExistsError:
+                    existing = self.get(key, _missing)
+                    # Try again only when the existing value expired or was removed.
+                    if existing is not _missing:
+                        return existing
+                else:
+                    return value
+        finally:
+            temp.unlink()
+
+    def compare_and_set(self, key, expected, value):
+        """Compare and replace the file under a lock."""
+        path = self._get_value_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(path.with_name(f"{path.name}.lock")):
+            if self.get(key, None) != expected:
+                return False
+
+            os.replace(self._write_temp(path, value), path)
+            return True
+
+    def compact(self, prefix=""):
+        """Remove the expired values, then the least recently read values."""
+        root = self._get_value_path(prefix)
+        if not root.is_dir():
+            return
+
+        files = []
+        for path in root.rglob("*"):
+            # Skip the files of concurrent writers.
+            if path.suffix in {".lock", ".tmp"}:
+                continue
+
+            with suppress(FileNotFoundError):
+                stat = path.stat()
+                if not path.is_file():
+                    continue
+                elif self._is_expired(stat):
+                    path.unlink()
+                else:
+                    files.append((stat.st_atime, path))
+
+        if self.max_size is not None:
+            files.sort(reverse=True)
+            for _, path in files[self.max_size :]:
+                with suppress(FileNotFoundError):
+                    path.unlink()
+
+        # Remove the empty directories left behind, deepest first.
+        for path in [*sorted(root.rglob("*"), key=lambda p: len(p.parts), reverse=True), root]:
+            with suppress(OSError):
+                path.rmdir()
+
+
+@define(frozen=True)
+class SqliteCache(Cache):
+    """Cache in a single SQLite database, safe for concurrent processes.
+
+    The database is in WAL mode so that readers don't block the writer,
+    and values are upserted atomically. Values expire after the ttl
+    since they were written, and the least recently written values
+    beyond the max size are evicted when compacting, so that reads
+    never write to the database.
+
+    :param path: Path to the database file.
+    :param encode: Encoding function, defaults to `cache_encode`
+    :param decode: Decoding function, defaults to `cache_decode`
+    :param timeout: Time in seconds to wait for the database to be unlocked.
+    :param ttl: Optional time in seconds before values expire.
+    :param max_size: Optional number of values kept when compacting.
+    """
+
+    _path = field(converter=Path)
+    encode = field(default=cache_encode)
+    decode = field(default=cache_decode)
+    timeout = field(default=30)
+    ttl = field(default=None, kw_only=True)
+    max_size = field(default=None, kw_only=True)
+    clock = field(default=time, kw_only=True)
+    _local = field(factory=threading.local, init=False, eq=False, repr=False)
+
+    # Stay below SQLITE_MAX_VARIABLE_NUMBER of older versions.
+    batch_size = 500
+
+    @property
+    def _connection(self):
+        # SQLite connections can't be shared across threads or forks.
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self._path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL, written REAL)"
+            )
+            self._migrate(connection)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def _migrate(self, connection):
+        # Databases of previous versions don't have the bounds columns.
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(cache)")}
+        for column in ("expires", "written"):
+            if column not in columns:
+                try:
+                    connection.execute(f"ALTER TABLE cache ADD COLUMN {column} REAL")
+                except sqlite3.OperationalError as error:
+                    # Another process might have added it meanwhile.
+                    if "duplicate column" not in str(error):
+                        raise
+
+    def _get_expires(self):
+        return None if self.ttl is None else self.clock() + self.ttl
+
+    def get(self, key, default):
+        """Read from the database, unless expired."""
+        row = self._connection.execute(
+            "SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires >= ?)",
+            (key, self.clock()),
+        ).fetchone()
+        return default if row is None else self.decode(row[0])
+
+    def set(self, key, value):
+        """Upsert into the database."""
+        self.set_many({key: value})
+
+    def get_generation(self, key):
+        """Return the version of the whole database.
+
+        The data version changes when other connections commit, and the
+        total changes when this connection commits. An expired value has
+        the generation of a missing value.
+        """
+        connection = self._connection
+        if self.ttl is not None:
+            row = connection.execute("SELECT expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] is not None and row[0] < self.clock():
+                return 0
+
+        (data_version,) = connection.execute("PRAGMA data_version").fetchone()
+        return data_version, connection.total_changes
+
+    def get_many(self, keys, default):
+        """Read many keys from the database in batches."""
+        keys = list(keys)
+        values = dict.fromkeys(keys, default)
+        now = self.clock()
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i : i + self.batch_size]
+            placeholders = ", ".join("?" * len(batch))
+            rows = self._connection.execute(
+                f"SELECT key, value FROM cache WHERE key IN ({placeholders}) AND (expires IS NULL OR expires >= ?)",  # noqa: S608
+                [*batch, now],
+            )
+            values.update((key, self.decode(payload)) for key, payload in rows)
+
+        return values
+
+    @contextmanager
+    def _transaction(self):
+        # Take the write lock immediately so that reads in the
+        # transaction are consistent with the writes.
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        connection.execute("COMMIT")
+
+    def _upsert(self, connection, items):
+        expires, written = self._get_expires(), self.clock()
+        connection.executemany(
+            "INSERT INTO cache (key, value, expires, written) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE"
+            " SET value = excluded.value, expires = excluded.expires, written = excluded.written",
+            [(key, self.encode(value), expires, written) for key, value in items.items()],
+        )
+
+    def set_many(self, items):
+        """Upsert many keys into the database in a single transaction."""
+        with self._transaction() as connection:
+            self._upsert(connection, items)
+
+    def setdefault(self, key, value):
+        """Insert unless the key exists and is not expired in a single transaction."""
+        now = self.clock()
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO cache (key, value, expires, written) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE"
+                " SET value = excluded.value, expires = excluded.expires, written = excluded.written"
+                " WHERE cache.expires < ?",
+                (key, self.encode(value), self._get_expires(), now, now),
+            )
+            return self.get(key, value)
+
+    def compare_and_set(self, key, expected, value):
+        """Compare and upsert in a single transaction."""
+        with self._transaction() as connection:
+            if self.get(key, None) != expected:
+                return False
+
+            self._upsert(connection, {key: value})
+            return True
+
+    def compact(self, prefix=""):
+        """Remove the expired values, then the least recently written values."""
+        # Compare the prefix with substr, LIKE has wildcards and ignores case.
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM cache WHERE substr(key, 1, ?) = ? AND expires < ?",
+                (len(prefix), prefix, self.clock()),
+            )
+            if self.max_size is not None:
+                connection.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache WHERE substr(key, 1, ?) = ?"
+                    " ORDER BY written DESC LIMIT -1 OFFSET ?)",
+                    (len(prefix), prefix, self.max_size),
+                )
 
 
 @define(frozen=True)
 class MemoryCache(Cache):
-    """Memory cache."""
+    """Memory cache.
+
+    Values expire after the ttl since they were written, and the least
+    recently used values beyond the max size are evicted.
+
+    :param ttl: Optional time in seconds before values expire.
+    :param max_size: Optional maximum number of values.
+    """
 
     _memory = field(factory=dict)
+    ttl = field(default=None, kw_only=True)
+    max_size = field(default=None, kw_only=True)
+    clock = field(default=time, kw_only=True)
+    _expires = field(factory=dict, init=False, eq=False, repr=False)
+    _lock = field(factory=threading.RLock, init=False, eq=False, repr=False)
+
+    def _pop(self, key):
+        self._memory.pop(key, None)
+        self._expires.pop(key, None)
 
     def get(self, key, default):
-        """Read from dict."""
-        return self._memory.get(key, default)
+        """Read from dict, removing the value when expired."""
+        with self._lock:
+            if key not in self._memory:
+                return default
+
+            if self._expires.get(key, inf) < self.clock():
+                self._pop(key)
+                return default
+
+            # Dicts keep the insertion order, so move the key last.
+            value = self._memory[key] = self._memory.pop(key)
+            return value
 
     def set(self, key, value):
-        """Write the value to dict."""
-        self._memory[key] = value
+        """Write the value to dict, evicting the least recently used values."""
+        with self._lock:
+            self._memory.pop(key, None)
+            self._memory[key] = value
+            if self.ttl is not None:
+                self._expires[key] = self.clock() + self.ttl
+
+            if self.max_size is not None:
+                while len(self._memory) > self.max_size:
+                    self._pop(next(iter(self._memory)))
+
+    def setdefault(self, key, value):
+        """Set the default in the dict under a lock."""
+        with self._lock:
+            return super().setdefault(key, value)
+
+    def compare_and_set(self, key, expected, value):
+        """Compare and write the value to dict under a lock."""
+        with self._lock:
+            return super().compare_and_set(key, expected, value)
+
+    def compact(self, prefix=""):
+        """Remove the expired values."""
+        with self._lock:
+            now = self.clock()
+            for key, expires in list(self._expires.items()):
+                if key.startswith(prefix) and expires < now:
+                    self._pop(key)
+
+
+@define(frozen=True)
+class TieredCache(Cache):
+    """Cache fronting a persistent cache with a memory cache.
+
+    Values are written through to the back cache, and read from the
+    front cache unless the generation of the key in the back cache
+    changed, eg when another process wrote the value:
+
+        >>> from tempfile import TemporaryDirectory
+        >>> with TemporaryDirectory() as path:
+        ...     cache = TieredCache(FileCache(path))
+        ...     cache.set("key", 1)
+        ...     FileCache(path).set("key", 2)
+        ...     cache.get("key", None)
+        2
+
+    :param back: Persistent `Cache`, eg a `FileCache`.
+    :param front: Optional `MemoryCache`, defaults to a new instance
+        keeping `front_size` values.
+    """
+
+    back = field()
+    front = field(factory=lambda: MemoryCache(max_size=TieredCache.front_size))
+
+    front_size = 1024
+
+    def _invalidate(self, key):
+        # The generation after writing might already be from another
+        # process, so the copy is only refreshed when reading.
+        self.front.set(key, (None, _missing))
+
+    def get(self, key, default):
+        """Read from the front cache, or from the back cache when stale."""
+        # Get the generation first so that a concurrent write makes the copy stale.
+        generation = self.back.get_generation(key)
+        entry = self.front.get(key, None)
+        if generation is not None and entry is not None and entry[0] == generation:
+            value = entry[1]
+        else:
+            value = self.back.get(key, _missing)
+            if generation is not None:
+                self.front.set(key, (generation, value))
+
+        return default if value is _missing else value
+
+    def set(self, key, value):
+        """Write through to the back cache."""
+        self.back.set(key, value)
+        self._invalidate(key)
+
+    def set_many(self, items):
+        """Write many keys through to the back cache."""
+        self.back.set_many(items)
+        for key in items:
+            self._invalidate(key)
+
+    def setdefault(self, key, value):
+        """Set the default in the back cache."""
+        value = self.back.setdefault(key, value)
+        self._invalidate(key)
+        return value
+
+    def compare_and_set(self, key, expected, value):
+        """Compare and set in the back cache."""
+        saved = self.back.compare_and_set(key, expected, value)
+        self._invalidate(key)
+        return saved
+
+    def compact(self, prefix=""):
+        """Compact the back cache."""
+        self.back.compact(prefix)
 
 
 @define(frozen=True)
@@ -23,6 +23,9 @@
 
 from attrs import define, evolve, field
 
+from pytest_xdocker.metrics import recorder
+from pytest_xdocker.trace import tracer
+
 
 @define(eq=False, frozen=True, repr=False)
 class Command(Iterable):
@@ -80,7 +83,8 @@ def execute(self, **kwargs):
         """Run the command."""
         logging.info("Executing command: %s", self)
         kwargs.setdefault("universal_newlines", True)
-        return check_output(self, **kwargs)  # noqa: S603
+        with tracer.span(self._command, command=self), recorder.timing(self._command, self):
+            return check_output(self, **kwargs)  # noqa: S603
 
 
 def empty_type():
@@ -13,10 +13,11 @@
 from collections.abc import Iterable
 from contextlib import suppress
 from pathlib import Path
-from subprocess import CalledProcessError, run
+from subprocess import PIPE, CalledProcessError, run
 
 from attrs import define, field
 
+from pytest_xdocker.breaker import get_docker_breaker
 from pytest_xdocker.command import (
     Command,
     OptionalArg,
@@ -24,7 +25,11 @@
     arg_type,
     args_type,
 )
+from pytest_xdocker.governor import get_docker_semaphore
+from pytest_xdocker.lock import NullLock
+from pytest_xdocker.metrics import recorder
 from pytest_xdocker.retry import retry_catching
+from pytest_xdocker.trace import tracer
 
 
 def docker_env_type(key, value=None):
@@ -66,6 +71,10 @@ def logs(self, name):
         """Return a logs command."""
         return DockerLogsCommand("logs", self).with_positionals(name)
 
+    def network(self):
+        """Return a network command."""
+        return DockerNetworkCommand("network", self)
+
     def port(self, name):
         """Return a port command."""
         return DockerPortCommand("port", self).with_positionals(name)
@@ -114,15 +123,33 @@ class DockerRunCommand(Command):
     with_interactive = OptionalArg("--interactive")
     """Keep STDIN open even if not attached."""
 
+    with_ip = OptionalArg("--ip", arg_type, converter=str)
+    """Assign an IPv4 address to the container on its network.
+
+    :param ip: IPv4 address, see `pytest_xdocker.network.unique_ip`.
+    """
+
     with_name = OptionalArg("--name", arg_type, converter=str)
     """Assign a name to the container.
 
     :param name: Container name.
     """
 
+    with_network = OptionalArg("--network", arg_type, converter=str)
+    """Connect the container to a network.
+
+    :param network: Network name.
+    """
+
     with_remove = OptionalArg("--rm")
     """Automatically remove the container when it exits."""
 
+    with_user = OptionalArg("--user", arg_type, converter=str)
+    """Run the container as a user, eg uid:gid of the host user.
+
+    :param user: User name or uid, optionally with a group.
+    """
+
     with_workdir = OptionalArg("--workdir", arg_type, converter=str)
     """Set the working directory in the container.
 
@@ -149,6 +176,19 @@ def with_publish(self, container_ports, host_ports=None, host_ip=None):
         publish = f'{host_ip or ""}:{host_ports or ""}:{container_ports}'
         return self.with_optionals("--publish", publish)
 
+    def with_socket_dir(self, host_dir, container_dir):
+        """Share a directory of unix sockets between the host and the container.
+
+        The sockets created by the server in the container can be used
+        from the host, except when docker runs in a VM like Docker Desktop.
+        The container should run as the owner of the host directory, eg
+        with `with_user(f"{os.getuid()}:{os.getgid()}")`.
+
+        :param host_dir: Directory on the host, see `ProcessServer.get_socket_dir`.
+        :param container_dir: Directory of the sockets in the container.
+        """
+        return self.with_volume(host_dir, container_dir, "rw")
+
     def with_volume(self, host_src, container_dest=None, options=None):
         """Mount volumes from the host to the docker container.
 
@@ -175,7 +215,17 @@ def execute(self, **kwargs):
         """
         kwargs.setdefault("check", True)
         logging.info("Running command: %s", self)
-        return run(self, **kwargs)  # noqa: S603
+        # The slot of an attached run would be held until the container exits.
+        semaphore = get_docker_semaphore("run") if "--detach" in self._optionals else NullLock()
+        with (
+            semaphore,
+            tracer.span(self._command, command=self),
+            recorder.timing(self._command, self) as timing,
+        ):
+            result = run(self, **kwargs)  # noqa: S603
+            timing.returncode = result.returncode
+
+        return result
 
 
 class DockerBuildCommand(Command):
@@ -197,6 +247,14 @@ class DockerBuildCommand(Command):
     :param value: Optional value, no value will carry from envionment variable.
     """
 
+    def execute(self, **kwargs):
+        """Run the docker build command, limiting concurrent builds on this host.
+
+        :param kwargs: See `Command.execute`.
+        """
+        with get_docker_semaphore("build"):
+            return super().execute(**kwargs)
+
 
 class DockerComposeCommand(Command):
     """Shortcut for "docker compose"."""
@@ -296,6 +354,95 @@ def with_since(self, timestamp):
         return self.with_optionals("--since", timestamp)
 
 
+class DockerNetworkCommand(Command):
+    """Shortcut for "docker network"."""
+
+    def connect(self, network, container):
+        """Return a connect command."""
+        return DockerNetworkConnectCommand("connect", self).with_positionals(network, container)
+
+    def create(self, network):
+        """Return a create command."""
+        return DockerNetworkCreateCommand("create", self).with_positionals(network)
+
+    def disconnect(self, network, container):
+        """Return a disconnect command."""
+        return DockerNetworkDisconnectCommand("disconnect", self).with_positionals(network, container)
+
+    def ls(self):
+        """Return a ls command."""
+        return DockerNetworkLsCommand("ls", self)
+
+    def remove(self, *networks):
+        """Return a rm command."""
+        return Command("rm", self).with_positionals(*networks)
+
+
+class DockerNetworkConnectCommand(Command):
+    """Shortcut for "docker network connect"."""
+
+    with_alias = OptionalArg("--alias", arg_type, converter=str)
+    """Add a network-scoped alias for the container.
+
+    :param alias: Alias name.
+    """
+
+    with_ip = OptionalArg("--ip", arg_type, converter=str)
+    """Assign an IPv4 address to the container.
+
+    :param ip: IPv4 address.
+    """
+
+
+class DockerNetworkCreateCommand(Command):
+    """Shortcut for "docker network create"."""
+
+    with_driver = OptionalArg("--driver", arg_type, converter=str)
+    """Driver to manage the network, defaults to bridge.
+
+    :param driver: Driver name.
+    """
+
+    with_internal = OptionalArg("--internal")
+    """Restrict external access to the network."""
+
+    with_label = OptionalArg("--label", docker_env_type)
+    """Set metadata on the network.
+
+    :param key: Label key.
+    :param value: Optional label value.
+    """
+
+    with_subnet = OptionalArg("--subnet", arg_type, converter=str)
+    """Subnet in CIDR format, eg 10.199.0.0/16.
+
+    :param subnet: Subnet.
+    """
+
+
+class DockerNetworkDisconnectCommand(Command):
+    """Shortcut for "docker network disconnect"."""
+
+    with_force = OptionalArg("--force")
+    """Force the container to disconnect from the network."""
+
+
+class DockerNetworkLsCommand(Command):
+    """Shortcut for "docker network ls"."""
+
+    with_filter = OptionalArg("--filter", arg_type, converter=str)
+    """Filter the networks, eg label=key=value.
+
+    :param filter: Filter condition.
+    """
+
+    with_format = OptionalArg("--format", arg_type, converter=str)
+    """Format the output using a Go template.
+
+    :param format: Template, eg {{.Name}}.
+    """
+
+
 class DockerPortCommand(Command):
     """Shortcut for "docker port"."""
 
@@ -310,11 +457,19 @@ def execute(self, **kwargs):
         """Run the docker pull command and output the progress.
 
         Retries when failing to pull because this is usually caused by
-        a recoverable network failure.
+        a recoverable network failure, unless the docker daemon itself
+        is failing in which case the circuit breaker fails fast.
 
         :param kwargs: See `Command.execute`.
         """
-        return super().execute(**kwargs)
+        # Capture the error to tell daemon failures apart.
+        kwargs.setdefault("stderr", PIPE)
+        try:
+            with get_docker_breaker(), get_docker_semaphore("pull"):
+                return super().execute(**kwargs)
+        except CalledProcessError as error:
+            logging.warning("Failed to pull: %s", error.stderr)
+            raise
 
 
 class DockerRemoveCommand(Command):
@@ -362,6 +517,28 @@ def exposed_ip(self):
         """Return the IP exposed to other containers."""
         return self.inspect.get("NetworkSettings", "IPAddress")
 
+    @property
+    def networks(self):
+        """Return the settings of the networks of the container by name."""
+        return self.inspect.get("NetworkSettings", "Networks") or {}
+
+    @property
+    def network_ips(self):
+        """Return the IPs of the container on each network, then the exposed IP."""
+        ips = [settings.get("IPAddress") for settings in self.networks.values()]
+        return [ip for ip in [*ips, self.exposed_ip] if ip]
+
+    def network_ip(self, network=None):
+        """Return the IP of the container on a network.
+
+        :param network: Optional network name, defaults to the first
+            network with an IP, then to the exposed IP.
+        """
+        if network is not None:
+            return self.networks.get(network, {}).get("IPAddress") or None
+
+        return next(iter(self.network_ips), None)
+
     @property
     def exposed_port(self):
         """Return the only port exposed to other containers."""
@@ -1,16 +1,43 @@
 """XProcess fixtures."""
 
-import pytest
+import os
+from pathlib import Path
 
-from pytest_xdocker.process import Process
+import pytest
 
 
 @pytest.fixture(scope="session")
 def process(request):
     """Initiliaze XProcess."""
+    # Import lazily so that loading the plugin doesn't import xprocess,
+    # psutil and netifaces for every pytest invocation.
+    from pytest_xdocker.process import Process
+
     return Process(config=request.config)
 
 
+@pytest.fixture(scope="session")
+def docker_network_pool():
+    """Fill the pool of docker networks once per session."""
+    from pytest_xdocker.network import NetworkPool
+
+    pool = NetworkPool.from_state_dir()
+    pool.fill()
+    return pool
+
+
+@pytest.fixture
+def docker_network(docker_network_pool):
+    """Lease a docker network from the pool of networks.
+
+    A container can be given a static IP on the network with
+    `unique("ip", subnet=docker_network_pool.get_subnet(docker_network))`.
+    """
+    network = docker_network_pool.acquire()
+    yield network
+    docker_network_pool.release(network)
+
+
 @pytest.hookimpl(hookwrapper=True)
 def pytest_runtest_makereport(item, call):
     """Workaround pyest-xprocess trying to read from closed logfiles."""
@@ -22,6 +49,24 @@ def pytest_runtest_makereport(item, call):
     yield
 
 
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    """Tag the metrics recorded while running a test."""
+    from pytest_xdocker.metrics import recorder
+
+    with recorder.context(test=item.nodeid):
+        yield
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(fixturedef, request):
+    """Tag the metrics recorded while setting up a fixture."""
+    from pytest_xdocker.metrics import recorder
+
+    with recorder.context(fixture=fixturedef.argname):
+        yield
+
+
 def pytest_addoption(parser):
     """Add pytest options."""
     # Extends pytest_xprocess.pytest_addoption
@@ -32,3 +77,104 @@ def pytest_addoption(parser):
         nargs="*",
         help="restart named processes on the next run",
     )
+    group.addoption(
+        "--xdocker-durations",
+        metavar="N",
+        type=int,
+        default=None,
+        help="show N slowest docker operations (N=0 for all)",
+    )
+    group.addoption(
+        "--xdocker-metrics",
+        metavar="PATH",
+        default=None,
+        help="write the raw docker metrics as JSON to PATH",
+    )
+    group.addoption(
+        "--xdocker-trace",
+        metavar="PATH",
+        default=None,
+        help="write container lifecycle spans in Chrome trace format to PATH",
+    )
+    group.addoption(
+        "--xdocker-limits",
+        metavar="LIMITS",
+        default=None,
+        help="limit concurrent docker operations on this host, eg run=4,build=2,pull=2 (unlimited by default)",
+    )
+
+
+def pytest_configure(config):
+    """Enable the metrics recorder and the tracer, and set the limits when requested."""
+    from pytest_xdocker.metrics import recorder
+
+    limits = config.option.xdocker_limits
+    if limits is not None:
+        # Import lazily so that loading the plugin doesn't import sqlite3,
+        # hamcrest and concurrent.futures for every pytest invocation.
+        from pytest_xdocker.governor import LIMITS_ENV
+
+        # Also limit the xdocker scripts started by xprocess.
+        os.environ[LIMITS_ENV] = limits
+
+    if config.option.xdocker_durations is not None or config.option.xdocker_metrics:
+        recorder.enabled = True
+
+    trace = config.option.xdocker_trace
+    if trace is not None:
+        from pytest_xdocker.trace import TRACE_ENV, start_trace, tracer
+
+        trace = os.path.abspath(trace)
+        # Only the controller starts the trace, workers append to it.
+        if not hasattr(config, "workerinput"):
+            start_trace(trace)
+
+        # Also trace the xdocker scripts started by xprocess.
+        os.environ[TRACE_ENV] = trace
+        tracer.path = trace
+
+
+def pytest_sessionfinish(session):
+    """Send the metrics from xdist workers to the controller."""
+    from pytest_xdocker.metrics import recorder
+
+    workeroutput = getattr(session.config, "workeroutput", None)
+    if workeroutput is not None and recorder.enabled:
+        workeroutput["xdocker_metrics"] = recorder.to_dict()
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    """Receive the metrics from xdist workers on the controller."""
+    from pytest_xdocker.metrics import recorder
+
+    metrics = getattr(node, "workeroutput", {}).get("xdocker_metrics")
+    if metrics is not None:
+        recorder.update(metrics)
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    """Report the slowest docker operations, retries and locks, and write the raw metrics."""
+    from pytest_xdocker.metrics import recorder
+
+    durations = config.option.xdocker_durations
+    if durations is not None:
+        title = "slowest docker operations" if durations == 0 else f"slowest {durations} docker operations"
+        terminalreporter.write_sep("=", title)
+        for line in recorder.summary(durations):
+            terminalreporter.write_line(line)
+
+        if recorder.retries:
+            terminalreporter.write_sep("=", "docker retries by test")
+            for line in recorder.retry_summary(durations):
+                terminalreporter.write_line(line)
+
+        if recorder.locks:
+            terminalreporter.write_sep("=", "most contended docker locks")
+            for line in recorder.lock_summary(durations):
+                terminalreporter.write_line(line)
+
+    path = config.option.xdocker_metrics
+    if path is not None:
+        Path(path).write_text(recorder.to_json())
+        terminalreporter.write_sep("-", f"docker metrics written to {path}")
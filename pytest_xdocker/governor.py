@@ -0,0 +1,60 @@
+"""Concurrency governor for heavy docker operations.
+
+Running many docker operations at the same time, like each xdist
+worker starting containers, overloads the daemon and makes every
+operation slower than running a few at a time. The governor limits
+the number of concurrent operations of each kind on this host:
+
+    >>> parse_limits("run=2,pull=0")
+    {'run': 2, 'pull': 0}
+
+Operations are unlimited by default, limits are set with the
+`LIMITS_ENV` environment variable, a limit of 0 meaning unlimited.
+Only detached runs are limited because the slot of an attached
+"docker run" would be held until the container exits.
+"""
+
+import os
+
+from pytest_xdocker.cache import get_state_dir
+from pytest_xdocker.lock import FileSemaphore, NullLock
+
+LIMITS_ENV = "XDOCKER_LIMITS"
+"""Environment variable to change the limits, eg run=4,build=2."""
+
+DEFAULT_LIMITS = {}
+"""Default number of concurrent operations of each kind, unlimited."""
+
+
+def parse_limits(value):
+    """Parse limits in the format of `LIMITS_ENV`.
+
+    :param value: Comma separated operation=limit pairs.
+    """
+    limits = {}
+    for pair in value.split(","):
+        if pair.strip():
+            operation, _, limit = pair.partition("=")
+            limits[operation.strip()] = int(limit)
+
+    return limits
+
+
+def get_limits():
+    """Get the limits of each kind of operation."""
+    return {**DEFAULT_LIMITS, **parse_limits(os.environ.get(LIMITS_ENV, ""))}
+
+
+def get_docker_semaphore(operation):
+    """Get a semaphore limiting a kind of docker operation on this host.
+
+    A new semaphore is returned each time so that threads can acquire
+    their own slot.
+
+    :param operation: Kind of operation, eg build, pull or run.
+    """
+    limit = get_limits().get(operation)
+    if not limit:
+        return NullLock()
+
+    return FileSemaphore(get_state_dir() / "governor" / operation, limit)
@@ -6,8 +6,17 @@
 try:
     import fcntl
 
-    def lock(fd):
-        fcntl.flock(fd, fcntl.LOCK_EX)
+    def lock(fd, shared=False, blocking=True):
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            return False
+
+        return True
 
     def unlock(fd):
         fcntl.flock(fd, fcntl.LOCK_UN)
@@ -15,20 +24,55 @@ def unlock(fd):
 except ImportError:
     import msvcrt
 
-    def lock(fd):
-        msvcrt.locking(fd, msvcrt.LK_LOCK, 0)
+    def lock(fd, shared=False, blocking=True):
+        # Shared locks are not supported, they are exclusive.
+        mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+        try:
+            msvcrt.locking(fd, mode, 0)
+        except OSError:
+            if blocking:
+                raise
+            return False
+
+        return True
 
     def unlock(fd):
         msvcrt.locking(fd, msvcrt.LK_UNLCK, 0)
 
 
-from attrs import define, field
+import json
+import logging
+import socket
+import threading
+import uuid
+from contextlib import contextmanager, suppress
+from math import inf
+from pathlib import Path
+from time import monotonic, time
+
+from attrs import Factory, define, field
+from hamcrest import greater_than
+
+from pytest_xdocker.metrics import recorder
+from pytest_xdocker.retry import BackoffPoller, ProbeResult
+from pytest_xdocker.trace import tracer
+from pytest_xdocker.validators import matches
+
+log = logging.getLogger(__name__)
 
 
 class AlreadyLockedError(Exception):
     """Raised when a lock was already acquired."""
 
 
+class LeaseLostError(Exception):
+    """Raised when releasing a lease which was removed while held."""
+
+
+class LockTimeoutError(Exception):
+    """Raised when a lock could not be acquired before the timeout."""
+
+
 class NotLockedError(Exception):
     """Raised when the lock was never acquired or already released."""
 
@@ -69,24 +113,85 @@ def __exit__(self, exc_type, exc_val, exc_tb):
 class FileLock(BaseLock):
     """Advisory file locking.
 
+    Many processes can hold a shared lock on the same file at the same
+    time, but only one can hold an exclusive lock.
+
+    The time waiting for and holding the lock is recorded when the
+    metrics recorder is enabled.
+
     :param lockfile: Path to the lock file.
+    :param shared: True for a shared lock, False for an exclusive lock.
+    :param timeout: Time in seconds to wait for the lock, None to wait
+        forever.
     """
 
     _lockfile = field(converter=str)
     _lockfd = field(default=None)
+    shared = field(default=False, kw_only=True)
+    timeout = field(default=None, kw_only=True)
+    _acquired = field(default=None, init=False)
+    _wait = field(default=0.0, init=False)
 
     @property
     def is_locked(self):
         """Check if the file is locked, based on the file descriptor."""
         return self._lockfd is not None
 
+    def _lock(self, blocking):
+        if self.is_locked:
+            raise AlreadyLockedError("Already locked")
+
+        lockfd = os.open(self._lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            locked = lock(lockfd, self.shared, blocking)
+        except BaseException:
+            os.close(lockfd)
+            raise
+
+        if not locked:
+            os.close(lockfd)
+            return False
+
+        self._lockfd = lockfd
+        return True
+
     def lock(self):
-        """See `BaseLock.lock`."""
+        """See `BaseLock.lock`.
+
+        :raises LockTimeoutError: If the lock could not be acquired
+            before the timeout.
+        """
         if self.is_locked:
             raise AlreadyLockedError("Already locked")
 
-        self._lockfd = os.open(self._lockfile, os.O_RDWR | os.O_CREAT, 0o644)
-        lock(self._lockfd)
+        start = monotonic()
+        with tracer.span("lock", lockfile=self._lockfile):
+            if self.timeout is None:
+                self._lock(blocking=True)
+            else:
+                # Poll without blocking so that a hung holder can't block forever.
+                poller = BackoffPoller(self.timeout)
+                if not poller.poll(lambda: ProbeResult(self._lock(blocking=False)), poller.clock() + self.timeout):
+                    recorder.record_lock(self._lockfile, monotonic() - start, acquired=False)
+                    raise LockTimeoutError(f"Failed to lock {self._lockfile} after {self.timeout} seconds")
+
+        self._acquired = monotonic()
+        self._wait = self._acquired - start
+
+    def try_lock(self, wait=0.0):
+        """Try to acquire the lock without blocking.
+
+        :param wait: Time in seconds already waited for the lock, eg when
+            polling it, recorded on unlock.
+        :return: True if the lock was acquired, False otherwise.
+        :raises AlreadyLockedError: If the lock was already acquired.
+        """
+        locked = self._lock(blocking=False)
+        if locked:
+            self._acquired = monotonic()
+            self._wait = wait
+
+        return locked
 
     def unlock(self):
         """See `BaseLock.unlock`."""
@@ -96,6 +201,357 @@ def unlock(self):
         unlock(self._lockfd)
         os.close(self._lockfd)
         self._lockfd = None
+        recorder.record_lock(self._lockfile, self._wait, monotonic() - self._acquired)
+
+
+@define
+class FileSemaphore(BaseLock):
+    """Counting semaphore across processes.
+
+    The semaphore is a directory of lock files, one for each slot, so a
+    slot is released even when the process holding it is killed, or
+    when its lease expires.
+
+    :param directory: Path to the directory of the slots.
+    :param limit: Number of slots.
+    :param timeout: Time in seconds to wait for a slot, None to wait
+        forever.
+    :param lock_class: Class of the slot locks, defaults to `get_lock_class`.
+    """
+
+    _directory = field(converter=Path)
+    limit = field(validator=matches(greater_than(0)))
+    timeout = field(default=None, kw_only=True)
+    lock_class = field(default=Factory(lambda: get_lock_class()), kw_only=True)
+    _slot = field(default=None, init=False)
+
+    @property
+    def is_locked(self):
+        """Check if a slot is held."""
+        return self._slot is not None
+
+    def _try_slots(self, start):
+        for i in range(self.limit):
+            slot = self.lock_class(self._directory / f"slot-{i}.lock")
+            if slot.try_lock(wait=monotonic() - start):
+                self._slot = slot
+                return True
+
+        return False
+
+    def lock(self):
+        """See `BaseLock.lock`.
+
+        :raises LockTimeoutError: If no slot could be acquired before
+            the timeout.
+        """
+        if self.is_locked:
+            raise AlreadyLockedError("Already locked")
+
+        self._directory.mkdir(parents=True, exist_ok=True)
+        start = monotonic()
+        with tracer.span("lock", lockfile=self._directory):
+            timeout = inf if self.timeout is None else self.timeout
+            poller = BackoffPoller(timeout)
+            if not poller.poll(lambda: ProbeResult(self._try_slots(start)), poller.clock() + timeout):
+                recorder.record_lock(self._directory, monotonic() - start, acquired=False)
+                raise LockTimeoutError(f"Failed to acquire a slot in {self._directory} after {self.timeout} seconds")
+
+    def unlock(self):
+        """See `BaseLock.unlock`."""
+        if not self.is_locked:
+            raise NotLockedError("Already unlocked")
+
+        slot, self._slot = self._slot, None
+        slot.unlock()
+
+
+def get_lease_owner():
+    """Get a unique owner for a lease, identifying the host and process."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+
+@define
+class LeaseLock(BaseLock):
+    """Lease locking for shared filesystems where advisory locks are unreliable.
+
+    The lease is a file with the owner and the expiry time, renewed by a
+    heartbeat thread while the lock is held. When the owner crashes, the
+    lease expires and can be removed by another process. Each shared
+    lease is a file next to the exclusive lease, which waits until the
+    shared leases are released or expired.
+
+    Leases are only renewed or removed under a guard held for an
+    instant, so that an expired lease can't be removed while renewed.
+    The guard is linked like an exclusive lease rather than locked with
+    advisory locks, and is broken when it outlives the ttl.
+
+    Expiry compares times written by different hosts, so their clocks
+    must be synchronized, eg with NTP, well within the ttl.
+
+    :param leasefile: Path to the lease file.
+    :param ttl: Time in seconds before a lease expires without renewal.
+    :param heartbeat: Time in seconds between renewals, defaults to a
+        third of the ttl.
+    :param shared: True for a shared lease, False for an exclusive lease.
+    :param timeout: Time in seconds to wait for the lease, None to wait
+        forever.
+    :param owner: Unique owner of the lease, defaults to the host and
+        process.
+    """
+
+    _leasefile = field(converter=Path)
+    ttl = field(default=30, validator=matches(greater_than(0)))
+    heartbeat = field(default=Factory(lambda self: self.ttl / 3, takes_self=True))
+    shared = field(default=False, kw_only=True)
+    timeout = field(default=None, kw_only=True)
+    owner = field(factory=get_lease_owner, kw_only=True)
+    clock = field(default=time, kw_only=True)
+    _path = field(default=None, init=False)
+    _stop = field(factory=threading.Event, init=False)
+    _thread = field(default=None, init=False)
+    _lost = field(default=False, init=False)
+    _acquired = field(default=None, init=False)
+    _wait = field(default=0.0, init=False)
+
+    @property
+    def is_locked(self):
+        """Check if the lease is held, even if it was lost."""
+        return self._thread is not None
+
+    @property
+    def is_lost(self):
+        """Return True if the lease was removed while held, False otherwise."""
+        return self._lost
+
+    @contextmanager
+    def _guard(self):
+        guard = self._leasefile.with_name(f"{self._leasefile.name}.guard")
+        token = uuid.uuid4().hex
+        poller = BackoffPoller(inf, delay=0.01, max_delay=0.1)
+        poller.poll(lambda: ProbeResult(self._try_guard(guard, token)), inf)
+        try:
+            yield
+        finally:
+            record = self._read(guard)
+            if record is not None and record.get("token") == token:
+                with suppress(FileNotFoundError):
+                    guard.unlink()
+
+    def _try_guard(self, guard, token):
+        temp = self._write_temp(token=token)
+        try:
+            os.link(temp, guard)
+        except FileExistsError:
+            pass
+        finally:
+            temp.unlink()
+
+        # Read back the owner, linking can fail after succeeding on NFS.
+        record = self._read(guard)
+        if record is None:
+            return False
+
+        if record.get("token") == token:
+            return True
+
+        if self._is_expired(guard, record):
+            self._break_guard(guard, record)
+
+        return False
+
+    def _break_guard(self, guard, record):
+        # Only one process breaks an expired guard, the one linking a
+        # marker named after it, and only when it wasn't replaced.
+        marker = guard.with_name(f"{guard.name}.{record['token']}")
+        temp = self._write_temp()
+        try:
+            os.link(temp, marker)
+        except FileExistsError:
+            return
+        finally:
+            temp.unlink()
+
+        try:
+            current = self._read(guard)
+            if current is not None and current.get("token") == record["token"]:
+                log.warning("Breaking expired guard %s of %s", guard, record["owner"])
+                with suppress(FileNotFoundError):
+                    guard.unlink()
+        finally:
+            marker.unlink()
+
+    def _read(self, path):
+        try:
+            return json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_temp(self, **extra):
+        # Write to a unique file so that linking or renaming is atomic.
+        record = {"owner": self.owner, "expires": self.clock() + self.ttl, **extra}
+        temp = self._leasefile.with_name(f"{self._leasefile.name}.{uuid.uuid4().hex}")
+        temp.write_text(json.dumps(record))
+        return temp
+
+    def _is_expired(self, path, record):
+        if record is None:
+            # Unreadable lease, probably crashed while writing.
+            with suppress(FileNotFoundError):
+                return path.stat().st_mtime + self.ttl < self.clock()
+            return False
+
+        return record["expires"] < self.clock()
+
+    def _is_held(self, path):
+        """Check if a lease is held, removing it when expired."""
+        record = self._read(path)
+        if record is None and not path.exists():
+            return False
+
+        if not self._is_expired(path, record):
+            return True
+
+        with self._guard():
+            # Check again, the lease might have been renewed meanwhile.
+            record = self._read(path)
+            if not self._is_expired(path, record):
+                return record is not None or path.exists()
+
+            log.warning("Removing expired lease %s of %s", path, record and record["owner"])
+            with suppress(FileNotFoundError):
+                path.unlink()
+
+        return False
+
+    def _shared_paths(self):
+        return self._leasefile.parent.glob(f"{self._leasefile.name}.*.shared")
+
+    def _try_lease(self):
+        if self.shared:
+            if self._is_held(self._leasefile):
+                return False
+
+            path = self._leasefile.with_name(f"{self._leasefile.name}.{uuid.uuid4().hex}.shared")
+            os.replace(self._write_temp(), path)
+            # Back off when an exclusive lease was acquired meanwhile, it
+            # waits for this shared lease otherwise.
+            if self._is_held(self._leasefile):
+                path.unlink()
+                return False
+
+            self._path = path
+            return True
+
+        temp = self._write_temp()
+        try:
+            os.link(temp, self._leasefile)
+        except FileExistsError:
+            self._is_held(self._leasefile)
+            return False
+        finally:
+            temp.unlink()
+
+        self._path = self._leasefile
+        return True
+
+    def _has_shared(self):
+        return any(self._is_held(path) for path in self._shared_paths())
+
+    def _renew(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._guard():
+                record = self._read(self._path)
+                if record is None or record["owner"] != self.owner:
+                    log.warning("Lost lease %s to %s", self._path, record and record["owner"])
+                    self._lost = True
+                    return
+
+                os.replace(self._write_temp(), self._path)
+
+    def _start(self, start):
+        self._acquired = monotonic()
+        self._wait = self._acquired - start
+        self._lost = False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._renew, name=f"lease-{self._leasefile.name}", daemon=True)
+        self._thread.start()
+
+    def _release(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        with self._guard():
+            record = self._read(self._path)
+            if record is not None and record["owner"] == self.owner:
+                self._path.unlink()
+            else:
+                self._lost = True
+
+        self._path = None
+
+    def lock(self):
+        """See `BaseLock.lock`.
+
+        :raises LockTimeoutError: If the lease could not be acquired
+            before the timeout.
+        """
+        if self.is_locked:
+            raise AlreadyLockedError("Already locked")
+
+        start = monotonic()
+        with tracer.span("lock", lockfile=self._leasefile):
+            timeout = inf if self.timeout is None else self.timeout
+            poller = BackoffPoller(timeout)
+            deadline = poller.clock() + timeout
+            if not poller.poll(lambda: ProbeResult(self._try_lease()), deadline):
+                recorder.record_lock(self._leasefile, monotonic() - start, acquired=False)
+                raise LockTimeoutError(f"Failed to lease {self._leasefile} after {self.timeout} seconds")
+
+            # Renew the exclusive lease while waiting for the shared leases.
+            self._start(start)
+            if not self.shared and not poller.poll(lambda: ProbeResult(not self._has_shared()), deadline):
+                self._release()
+                recorder.record_lock(self._leasefile, monotonic() - start, acquired=False)
+                raise LockTimeoutError(f"Failed to lease {self._leasefile} after {self.timeout} seconds")
+
+        self._wait = monotonic() - start
+
+    def try_lock(self, wait=0.0):
+        """Try to acquire the lease without waiting.
+
+        :param wait: Time in seconds already waited for the lease, eg
+            when polling it, recorded on unlock.
+        :return: True if the lease was acquired, False otherwise.
+        :raises AlreadyLockedError: If the lease was already acquired.
+        """
+        if self.is_locked:
+            raise AlreadyLockedError("Already locked")
+
+        if not self._try_lease():
+            return False
+
+        self._start(monotonic() - wait)
+        if not self.shared and self._has_shared():
+            self._release()
+            return False
+
+        return True
+
+    def unlock(self):
+        """See `BaseLock.unlock`.
+
+        :raises LeaseLostError: If the lease was removed while held, in
+            which case another process might have acquired it.
+        """
+        if not self.is_locked:
+            raise NotLockedError("Already unlocked")
+
+        path = self._path
+        self._release()
+        recorder.record_lock(self._leasefile, self._wait, monotonic() - self._acquired)
+        if self._lost:
+            raise LeaseLostError(f"Lost lease {path} while held")
 
 
 @define
@@ -138,3 +594,27 @@ def lock(self):
 
     def unlock(self):
         """Do nothing."""
+
+
+LOCKS_ENV = "XDOCKER_LOCKS"
+"""Environment variable to change the kind of locks between processes, file or lease."""
+
+LOCK_CLASSES = {
+    "file": FileLock,
+    "lease": LeaseLock,
+}
+"""Classes of the locks between processes by kind."""
+
+
+def get_lock_class():
+    """Get the class of the locks between processes from `LOCKS_ENV`.
+
+    Lease locks should be used when the state directory or the control
+    directories are on a shared filesystem, like NFS, where advisory
+    locks are unreliable. All the processes must use the same kind.
+    """
+    kind = os.environ.get(LOCKS_ENV, "file")
+    try:
+        return LOCK_CLASSES[kind]
+    except KeyError:
+        raise ValueError(f"Expecting {LOCKS_ENV} in {sorted(LOCK_CLASSES)}, found {kind!r}") from None
@@ -0,0 +1,245 @@
+"""Metrics recorded while running docker commands.
+
+The recorder is disabled by default, it is enabled by the pytest plugin
+when asking for docker durations:
+
+    >>> recorder = Recorder(enabled=True)
+    >>> with recorder.timing("run", "docker run alpine") as timing:
+    ...     pass
+    >>> recorder.timings == [timing]
+    True
+"""
+
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from subprocess import CalledProcessError
+from time import perf_counter
+
+from attrs import asdict, define, field
+
+
+@define
+class Timing:
+    """Wall time of an operation.
+
+    :param kind: Kind of operation, eg run, inspect, pull or poll.
+    :param command: String representation of the operation.
+    :param test: Node id of the test running the operation, if any.
+    :param fixture: Name of the fixture running the operation, if any.
+    :param duration: Wall time in seconds.
+    :param returncode: Exit code of the operation, None when unknown.
+    """
+
+    kind = field()
+    command = field()
+    test = field(default=None)
+    fixture = field(default=None)
+    duration = field(default=0.0)
+    returncode = field(default=None)
+
+
+@define
+class RetryStats:
+    """Statistics of polling a probe.
+
+    :param probe: String representation of the probe.
+    :param test: Node id of the test polling the probe, if any.
+    :param fixture: Name of the fixture polling the probe, if any.
+    :param attempts: Number of times the probe was called.
+    :param sleep: Total time in seconds sleeping between attempts.
+    :param success: True if the probe succeeded, False otherwise.
+    """
+
+    probe = field()
+    test = field(default=None)
+    fixture = field(default=None)
+    attempts = field(default=0)
+    sleep = field(default=0.0)
+    success = field(default=False)
+
+
+@define
+class LockStats:
+    """Contention of a lock.
+
+    :param lockfile: Path to the lock file.
+    :param test: Node id of the test acquiring the lock, if any.
+    :param fixture: Name of the fixture acquiring the lock, if any.
+    :param wait: Time in seconds waiting to acquire the lock.
+    :param hold: Time in seconds holding the lock.
+    :param acquired: True if the lock was acquired, False on timeout.
+    """
+
+    lockfile = field()
+    test = field(default=None)
+    fixture = field(default=None)
+    wait = field(default=0.0)
+    hold = field(default=0.0)
+    acquired = field(default=True)
+
+
+@define
+class Recorder:
+    """Record metrics for the running test and fixture."""
+
+    enabled = field(default=False)
+    test = field(default=None)
+    fixture = field(default=None)
+    timings = field(factory=list)
+    retries = field(factory=list)
+    locks = field(factory=list)
+
+    @contextmanager
+    def context(self, **changes):
+        """Change the test or fixture of the recorded metrics."""
+        previous = {key: getattr(self, key) for key in changes}
+        for key, value in changes.items():
+            setattr(self, key, value)
+        try:
+            yield self
+        finally:
+            for key, value in previous.items():
+                setattr(self, key, value)
+
+    @contextmanager
+    def timing(self, kind, command):
+        """Measure the wall time of the operation in the context.
+
+        The returncode defaults to 0 unless a `CalledProcessError` is
+        raised, it can also be set on the yielded `Timing`.
+        """
+        if not self.enabled:
+            yield Timing(kind, command)
+            return
+
+        timing = Timing(kind, str(command), self.test, self.fixture)
+        start = perf_counter()
+        try:
+            yield timing
+        except CalledProcessError as error:
+            timing.returncode = error.returncode
+            raise
+        else:
+            if timing.returncode is None:
+                timing.returncode = 0
+        finally:
+            timing.duration = perf_counter() - start
+            self.timings.append(timing)
+
+    @contextmanager
+    def retrying(self, probe):
+        """Record the statistics of polling a probe in the context.
+
+        The attempts, sleep and success should be updated on the yielded
+        `RetryStats` while polling.
+        """
+        if not self.enabled:
+            yield RetryStats(probe)
+            return
+
+        stats = RetryStats(str(probe), self.test, self.fixture)
+        try:
+            yield stats
+        finally:
+            self.retries.append(stats)
+
+    def record_lock(self, lockfile, wait, hold=0.0, acquired=True):
+        """Record the time waiting for and holding a lock."""
+        if self.enabled:
+            self.locks.append(LockStats(str(lockfile), self.test, self.fixture, wait, hold, acquired))
+
+    def slowest(self, n=None):
+        """Return the n slowest timings, all of them by default."""
+        timings = sorted(self.timings, key=lambda t: t.duration, reverse=True)
+        return timings[: n or None]
+
+    def totals(self, key):
+        """Return the total duration grouped by a timing attribute."""
+        totals = defaultdict(float)
+        for timing in self.timings:
+            value = getattr(timing, key)
+            if value is not None:
+                totals[value] += timing.duration
+
+        return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+    def summary(self, n=None):
+        """Yield lines summarizing the n slowest operations, tests and fixtures."""
+        total = sum(t.duration for t in self.timings)
+        yield f"{total:.2f}s in {len(self.timings)} docker operations"
+        for timing in self.slowest(n):
+            returncode = "-" if timing.returncode is None else timing.returncode
+            where = timing.test or ""
+            if timing.fixture:
+                where += f" [{timing.fixture}]"
+            command = timing.command.splitlines()[0] if timing.command else ""
+            yield f"{timing.duration:.2f}s {timing.kind:<8} rc={returncode:<3} {where} {command}".rstrip()
+
+        for key in ("test", "fixture"):
+            for name, duration in list(self.totals(key).items())[: n or None]:
+                yield f"{duration:.2f}s {key} {name}"
+
+    def retry_totals(self):
+        """Return the aggregated retry statistics of each test."""
+        totals = {}
+        for stats in self.retries:
+            total = totals.setdefault(stats.test, {"polls": 0, "attempts": 0, "sleep": 0.0, "failures": 0})
+            total["polls"] += 1
+            total["attempts"] += stats.attempts
+            total["sleep"] += stats.sleep
+            total["failures"] += not stats.success
+
+        return dict(sorted(totals.items(), key=lambda item: item[1]["sleep"], reverse=True))
+
+    def retry_summary(self, n=None):
+        """Yield lines summarizing the retries of the n tests sleeping the most."""
+        for test, total in list(self.retry_totals().items())[: n or None]:
+            yield (
+                f"{total['sleep']:.2f}s sleeping in {total['attempts']} attempts"
+                f" of {total['polls']} polls ({total['failures']} failed) {test or ''}"
+            ).rstrip()
+
+    def lock_totals(self):
+        """Return the aggregated contention of each lock file."""
+        totals = {}
+        for stats in self.locks:
+            total = totals.setdefault(
+                stats.lockfile, {"locks": 0, "wait": 0.0, "max_wait": 0.0, "hold": 0.0, "timeouts": 0}
+            )
+            total["locks"] += 1
+            total["wait"] += stats.wait
+            total["max_wait"] = max(total["max_wait"], stats.wait)
+            total["hold"] += stats.hold
+            total["timeouts"] += not stats.acquired
+
+        return dict(sorted(totals.items(), key=lambda item: item[1]["wait"], reverse=True))
+
+    def lock_summary(self, n=None):
+        """Yield lines summarizing the n lock files waited for the most."""
+        for lockfile, total in list(self.lock_totals().items())[: n or None]:
+            yield (
+                f"{total['wait']:.2f}s waiting (max {total['max_wait']:.2f}s) and {total['hold']:.2f}s holding"
+                f" in {total['locks']} locks ({total['timeouts']} timed out) {lockfile}"
+            )
+
+    def to_dict(self):
+        """Return the raw metrics as a serializable dictionary."""
+        return {
+            "timings": [asdict(t) for t in self.timings],
+            "retries": [asdict(r) for r in self.retries],
+            "locks": [asdict(lock) for lock in self.locks],
+        }
+
+    def update(self, data):
+        """Add raw metrics from `to_dict`, eg from another xdist worker."""
+        self.timings.extend(Timing(**t) for t in data.get("timings", []))
+        self.retries.extend(RetryStats(**r) for r in data.get("retries", []))
+        self.locks.extend(LockStats(**lock) for lock in data.get("locks", []))
+
+    def to_json(self):
+        """Return the raw metrics as JSON."""
+        return json.dumps(self.to_dict(), indent=2)
+
+
+recorder = Recorder()
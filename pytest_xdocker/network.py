@@ -1,38 +1,629 @@
 """Networking tools."""
 
+import ipaddress
+import json
+import logging
+import os
+import random
+import re
 import socket
+from contextlib import contextmanager, suppress
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+from subprocess import DEVNULL, CalledProcessError, TimeoutExpired
+from time import time
 
-import netifaces
+from attrs import define, field
+
+from pytest_xdocker.cache import get_state_dir
+from pytest_xdocker.docker import DockerNetworkInspect, docker
+from pytest_xdocker.lock import FileLock
+from pytest_xdocker.retry import BackoffPoller, ProbeResult
+
+log = logging.getLogger(__name__)
+
+PORTS_ENV = "XDOCKER_PORTS"
+"""Environment variable to change the range of allocated ports, eg 20000-29999."""
+
+DEFAULT_PORTS = "20000-29999"
+"""Default range of allocated ports, below the ephemeral ports of Linux."""
+
+SUBNET_ENV = "XDOCKER_SUBNET"
+"""Environment variable to change the subnet of allocated IPs, eg 10.10.0.0/16."""
+
+DEFAULT_SUBNET = "10.199.0.0/16"
+"""Default subnet of allocated IPs, for networks created with --subnet.
+
+It is outside the default address pools of docker, 172.17.0.0/16 to
+172.31.0.0/16 and 192.168.0.0/16, so that it doesn't overlap the
+networks created without --subnet, eg by docker compose.
+"""
+
+NETWORKS_ENV = "XDOCKER_NETWORKS"
+"""Environment variable to change the number of networks in the pool."""
+
+DEFAULT_NETWORKS = 8
+"""Default number of networks in the pool."""
+
+POOL_LABEL = "pytest-xdocker.pool"
+"""Label of the networks with the name of their pool."""
+
+OWNER_LABEL = "pytest-xdocker.owner"
+"""Label of the networks with the process which created them."""
+
+
+def get_bridge_gateway(timeout=5):
+    """Get the gateway of the docker bridge network, None when unavailable.
+
+    :param timeout: Time in seconds to wait for docker, so that a hung
+        daemon doesn't hang getting the host IP.
+    """
+    try:
+        output = DockerNetworkInspect("bridge").command.execute(stderr=DEVNULL, timeout=timeout)
+    except (CalledProcessError, OSError, TimeoutExpired):
+        # Docker is not installed, not running or hung.
+        return None
+
+    return DockerNetworkInspect("bridge", json.loads(output)[0]).get("IPAM", "Config", 0, "Gateway")
+
+
+def get_interface_ips(interfaces):
+    """Get the IPv4 addresses of the interfaces, except loopback."""
+    import netifaces
+
+    ips = {}
+    for interface in interfaces:
+        try:
+            addrs = netifaces.ifaddresses(interface).get(socket.AF_INET, [])
+        except ValueError:
+            continue
+
+        ips[interface] = [a["addr"] for a in addrs if a.get("addr") not in {None, "127.0.0.1"}]
+
+    return ips
+
+
+def get_interface_rank(interface):
+    """Rank the docker0 interface first, then en0-en9 on MacOS, then by name."""
+    return interface != "docker0", not re.fullmatch(r"en\d", interface), interface
+
+
+@lru_cache(maxsize=1)
+def find_host_ip(interfaces):
+    """Find an IP on this host among the interfaces.
+
+    The gateway of the docker bridge network is preferred when it is
+    bound to an interface of this host.
+
+    :param interfaces: Tuple of interface names.
+    """
+    ips = get_interface_ips(interfaces)
+    gateway = get_bridge_gateway()
+    if gateway is not None and any(gateway in addrs for addrs in ips.values()):
+        return gateway
+
+    for interface in sorted(ips, key=get_interface_rank):
+        if ips[interface]:
+            return ips[interface][0]
+
+    raise Exception("Network interfaces not found")
 
 
 def get_host_ip():
     """Get an IP on this host.
 
-    The function tries to use the IP bound to the docker0 interface
-    which should be available on Linux and, if that fails, it defaults
-    to the default
-    en0-en9 interfaces which should be available on MacOS.
+    The IP is only looked up again when the set of interfaces changes,
+    see `find_host_ip`.
     """
-    for interface in netifaces.interfaces():
+    import netifaces
+
+    return find_host_ip(tuple(sorted(netifaces.interfaces())))
+
+
+@lru_cache(maxsize=1)
+def find_local_subnets(interfaces):
+    """Find the IPv4 subnets of the interfaces on this host, except loopback.
+
+    :param interfaces: Tuple of interface names.
+    """
+    import netifaces
+
+    subnets = []
+    for interface in interfaces:
         try:
-            addr = netifaces.ifaddresses(interface)[2][0]["addr"]
-            if addr != "127.0.0.1":
-                return addr
-        except (ValueError, KeyError):
-            pass
+            addrs = netifaces.ifaddresses(interface).get(socket.AF_INET, [])
+        except ValueError:
+            continue
 
-    raise Exception("Network interfaces not found")
+        for addr in addrs:
+            if addr.get("netmask") and addr.get("addr") != "127.0.0.1":
+                subnets.append(ipaddress.ip_network(f"{addr['addr']}/{addr['netmask']}", strict=False))
+
+    return subnets
+
+
+def is_routable_ip(ip):
+    """Check if an IP can be routed to directly from this host.
+
+    The IP is routable when it is in the subnet of an interface, like a
+    container on the docker bridge or a user-defined network on Linux.
+    Containers behind a VM, like with Docker Desktop, are not routable.
+    """
+    import netifaces
+
+    ip = ipaddress.ip_address(ip)
+    return any(ip in subnet for subnet in find_local_subnets(tuple(sorted(netifaces.interfaces()))))
 
 
 def get_open_port():
     """Get an unused port.
 
     There is a race condition where the port could be taken after this
-    method closes the socket but before the consumer opens it. Since
-    this is just for test fixtures I'm not worrying about that.
+    method closes the socket but before the consumer opens it, use a
+    `PortAllocator` to reserve ports across processes instead.
     """
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.bind(("", 0))
     port = s.getsockname()[1]
     s.close()
     return port
+
+
+def is_port_free(port, host=""):
+    """Check if a port can be bound on the host.
+
+    The socket reuses the address like docker does, so ports with
+    connections lingering in TIME_WAIT are free.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind((host, port))
+        except OSError:
+            return False
+
+    return True
+
+
+def get_container_names():
+    """Get the names of all the containers, running or not."""
+    output = docker.command("ps").with_optionals("--all", "--format", "{{.Names}}").execute(stderr=DEVNULL)
+    return set(output.split())
+
+
+def get_process_owners():
+    """Get the lease owners of the processes running on this host."""
+    import psutil
+
+    hostname = socket.gethostname()
+    return {f"{hostname}:{pid}" for pid in psutil.pids()}
+
+
+def get_process_owner():
+    """Get the lease owner of the current process."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_lease_owners():
+    """Get the names of the containers and the processes of this host."""
+    return get_container_names() | get_process_owners()
+
+
+@contextmanager
+def open_leases(path):
+    """Read and write the leases in a file under a file lock.
+
+    :param path: Path to the lease file.
+    """
+    with FileLock(path.with_name(f"{path.name}.lock")):
+        try:
+            leases = json.loads(path.read_text())
+        except FileNotFoundError:
+            leases = {}
+
+        yield leases
+
+        temp = path.with_name(f"{path.name}.tmp")
+        temp.write_text(json.dumps(leases))
+        os.replace(temp, path)
+
+
+def reclaim_leases(leases, grace, get_owners, now):
+    """Remove the leases of owners gone after the grace period.
+
+    :param leases: Dictionary of leases with an owner and a time.
+    :param grace: Time in seconds before reclaiming a lease.
+    :param get_owners: Function returning the existing owners.
+    :param now: Current time in seconds.
+    """
+    expired = [key for key, lease in leases.items() if lease["time"] + grace < now]
+    if not expired:
+        return
+
+    try:
+        owners = get_owners()
+    except (CalledProcessError, OSError):
+        # Keep the leases when the owners are unknown.
+        return
+
+    for key in expired:
+        if leases[key]["owner"] not in owners:
+            del leases[key]
+
+
+def parse_ports(value):
+    """Parse a range of ports in the format start-end, inclusively.
+
+    :param value: Range of ports, ie 1234 or 1234-1238, optionally
+        with a protocol like 1234-1238/tcp.
+    """
+    start, _, end = str(value).split("/")[0].partition("-")
+    return int(start), int(end or start)
+
+
+def format_ports(start, count=1):
+    """Format a block of ports as a range for docker, ie 1234-1238.
+
+    A single port is returned unchanged.
+    """
+    return start if count == 1 else f"{start}-{start + count - 1}"
+
+
+class PortAllocationError(Exception):
+    """Raised when no port is free in the range."""
+
+
+@define
+class PortAllocator:
+    """Allocate host ports from a range, reserved across processes.
+
+    The reservations are kept in a lease file under a file lock, with
+    the owner of each port, eg the container name. The ports of owners
+    which are gone are reclaimed after a grace period, which leaves
+    time for the owner to start.
+
+    :param path: Path to the lease file.
+    :param start: First port of the range.
+    :param end: Last port of the range.
+    :param grace: Time in seconds before reclaiming a port.
+    :param get_owners: Function returning the existing owners, defaults
+        to the names of the docker containers.
+    :param is_free: Function checking if a port is free on the host.
+    """
+
+    path = field(converter=Path)
+    start = field(default=parse_ports(DEFAULT_PORTS)[0])
+    end = field(default=parse_ports(DEFAULT_PORTS)[1])
+    grace = field(default=60)
+    get_owners = field(default=get_container_names)
+    is_free = field(default=is_port_free)
+    clock = field(default=time)
+    randrange = field(default=random.randrange)
+
+    @classmethod
+    def from_state_dir(cls, **kwargs):
+        """Make a port allocator in the state directory, with the range from `PORTS_ENV`."""
+        start, end = parse_ports(os.environ.get(PORTS_ENV, DEFAULT_PORTS))
+        return cls(get_state_dir() / "ports.json", start, end, **kwargs)
+
+    def allocate(self, owner, count=1):
+        """Allocate a contiguous block of free ports in the range.
+
+        :param owner: Owner of the ports, eg the container name.
+        :param count: Number of ports in the block.
+        :return: First port of the block.
+        :raises PortAllocationError: If no block is free in the range.
+        """
+        with open_leases(self.path) as leases:
+            reclaim_leases(leases, self.grace, self.get_owners, self.clock())
+            # Start at a random port to avoid reusing recently released ports.
+            size = self.end - self.start + 2 - count
+            offset = self.randrange(size) if size > 0 else 0
+            for i in range(size):
+                start = self.start + (offset + i) % size
+                ports = range(start, start + count)
+                if all(str(port) not in leases for port in ports) and all(self.is_free(port) for port in ports):
+                    for port in ports:
+                        leases[str(port)] = {"owner": owner, "time": self.clock()}
+                    return start
+
+        raise PortAllocationError(f"No {count} free ports in {self.start}-{self.end}")
+
+    def reserve(self, owner, port, count=1):
+        """Reserve a block of ports unless reserved by another owner.
+
+        This renews the reservation of ports previously allocated to
+        the same owner, eg when restarting a container.
+
+        :return: True if the ports are reserved for the owner, False otherwise.
+        """
+        with open_leases(self.path) as leases:
+            reclaim_leases(leases, self.grace, self.get_owners, self.clock())
+            ports = [str(p) for p in range(port, port + count)]
+            if any(leases.get(p, {"owner": owner})["owner"] != owner for p in ports):
+                return False
+
+            for p in ports:
+                leases[p] = {"owner": owner, "time": self.clock()}
+            return True
+
+    def release(self, port, count=1):
+        """Release a block of ports."""
+        with open_leases(self.path) as leases:
+            for p in range(port, port + count):
+                leases.pop(str(p), None)
+
+
+class IpAllocationError(Exception):
+    """Raised when no IP is free in the subnet."""
+
+
+@define
+class IpAllocator:
+    """Allocate IPs from a subnet, reserved across processes.
+
+    The reservations are kept in a lease file like `PortAllocator`. The
+    network and broadcast addresses are never allocated, nor the first
+    host which docker assigns to the gateway.
+
+    :param path: Path to the lease file.
+    :param subnet: Subnet of the IPs, eg 10.199.0.0/16.
+    :param grace: Time in seconds before reclaiming an IP.
+    :param get_owners: Function returning the existing owners, defaults
+        to the names of the docker containers and the processes.
+    """
+
+    path = field(converter=Path)
+    subnet = field(default=DEFAULT_SUBNET, converter=ipaddress.ip_network)
+    grace = field(default=60)
+    get_owners = field(default=get_lease_owners)
+    clock = field(default=time)
+    randrange = field(default=random.randrange)
+
+    @classmethod
+    def from_state_dir(cls, subnet=None, **kwargs):
+        """Make an IP allocator in the state directory, with the subnet from `SUBNET_ENV`."""
+        if subnet is None:
+            subnet = os.environ.get(SUBNET_ENV, DEFAULT_SUBNET)
+        return cls(get_state_dir() / "ips.json", subnet, **kwargs)
+
+    def allocate(self, owner):
+        """Allocate a free IP in the subnet.
+
+        :param owner: Owner of the IP, eg the container name.
+        :return: IP as a string.
+        :raises IpAllocationError: If no IP is free in the subnet.
+        """
+        # Skip the network address, the gateway and the broadcast address.
+        first = int(self.subnet.network_address) + 2
+        size = int(self.subnet.broadcast_address) - first
+        with open_leases(self.path) as leases:
+            reclaim_leases(leases, self.grace, self.get_owners, self.clock())
+            # Start at a random IP to avoid reusing recently released IPs.
+            offset = self.randrange(size) if size > 0 else 0
+            for i in range(size):
+                ip = str(ipaddress.ip_address(first + (offset + i) % size))
+                if ip not in leases:
+                    leases[ip] = {"owner": owner, "time": self.clock()}
+                    return ip
+
+        raise IpAllocationError(f"No free IP in {self.subnet}")
+
+    def reserve(self, owner, ip):
+        """Reserve an IP unless reserved by another owner.
+
+        :return: True if the IP is reserved for the owner, False otherwise.
+        """
+        with open_leases(self.path) as leases:
+            reclaim_leases(leases, self.grace, self.get_owners, self.clock())
+            if leases.get(ip, {"owner": owner})["owner"] != owner:
+                return False
+
+            leases[ip] = {"owner": owner, "time": self.clock()}
+            return True
+
+    def release(self, ip):
+        """Release an IP."""
+        with open_leases(self.path) as leases:
+            leases.pop(ip, None)
+
+
+def unique_ip(unique, subnet=None, owner=None):
+    """Return an IP unique across processes, for the pytest-unique plugin.
+
+    The IP can be assigned to a container with `--ip` on a network
+    created with the same subnet, see `IpAllocator`.
+
+    :param subnet: Optional subnet, defaults to `SUBNET_ENV` or `DEFAULT_SUBNET`.
+    :param owner: Optional owner of the IP, eg the container name, defaults
+        to the current process so the IP is reclaimed after it exits.
+    """
+    if owner is None:
+        owner = get_process_owner()
+
+    return IpAllocator.from_state_dir(subnet).allocate(owner)
+
+
+class NetworkPoolError(Exception):
+    """Raised when no network of the pool is free before the timeout."""
+
+
+@define
+class NetworkPool:
+    """Pool of user-defined docker networks leased to tests.
+
+    Creating and removing a network for each test is slow and contends
+    on the docker daemon. Instead, the networks of the pool are created
+    once, labeled with the pool and the creating process, then leased to
+    tests like `PortAllocator` leases ports. Containers left on a network
+    are disconnected when it is released.
+
+    Each network gets its own block of the subnet, so that containers
+    can be given a static IP with `unique_ip` and `get_subnet`. Networks
+    which can't be created, eg because their block overlaps another
+    network, are left out of the pool.
+
+    The networks are created and the networks of processes which are
+    gone are garbage collected by `fill`, once per pool, so that leasing
+    a network only reads and writes the lease file.
+
+    :param path: Path to the lease file.
+    :param name: Name of the pool, also the prefix of the networks.
+    :param size: Number of networks in the pool.
+    :param subnet: Subnet divided between the networks, eg 10.199.0.0/16.
+    :param prefixlen: Prefix length of the subnet of each network.
+    :param timeout: Time in seconds to wait for a free network.
+    :param owner: Owner of the created networks, defaults to the current process.
+    :param get_owners: Function returning the existing owners, defaults
+        to the processes of this host, so leases are owned by processes.
+    """
+
+    path = field(converter=Path)
+    name = field(default="xdocker-pool")
+    size = field(default=DEFAULT_NETWORKS)
+    subnet = field(default=DEFAULT_SUBNET, converter=ipaddress.ip_network)
+    prefixlen = field(default=24)
+    timeout = field(default=60)
+    owner = field(factory=get_process_owner)
+    grace = field(default=60)
+    get_owners = field(default=get_process_owners)
+    clock = field(default=time)
+    _available = field(default=None, init=False)
+
+    @classmethod
+    def from_state_dir(cls, name="xdocker-pool", **kwargs):
+        """Make a network pool in the state directory, with the size from `NETWORKS_ENV`."""
+        kwargs.setdefault("size", int(os.environ.get(NETWORKS_ENV, DEFAULT_NETWORKS)))
+        kwargs.setdefault("subnet", os.environ.get(SUBNET_ENV, DEFAULT_SUBNET))
+        return cls(get_state_dir() / f"{name}.json", name, **kwargs)
+
+    @property
+    def networks(self):
+        """Names of the networks in the pool."""
+        return [f"{self.name}-{i}" for i in range(self.size)]
+
+    def get_subnet(self, network):
+        """Get the subnet of a network in the pool, eg to pass to `unique_ip`."""
+        index = self.networks.index(network)
+        subnet = next(islice(self.subnet.subnets(new_prefix=self.prefixlen), index, None), None)
+        if subnet is None:
+            raise NetworkPoolError(f"No subnet /{self.prefixlen} left in {self.subnet} for {network}")
+
+        return str(subnet)
+
+    def get_networks(self):
+        """Get the existing networks of the pool with their owner."""
+        output = (
+            docker.network()
+            .ls()
+            .with_filter(f"label={POOL_LABEL}={self.name}")
+            .with_format(f'{{{{.Name}}}} {{{{.Label "{OWNER_LABEL}"}}}}')
+            .execute(stderr=DEVNULL)
+        )
+        networks = {}
+        for line in output.splitlines():
+            network, _, owner = line.partition(" ")
+            networks[network] = owner
+
+        return networks
+
+    def create(self, network):
+        """Create a network labeled for the pool, in its own subnet."""
+        command = docker.network().create(network).with_subnet(self.get_subnet(network))
+        command = command.with_label(POOL_LABEL, self.name).with_label(OWNER_LABEL, self.owner)
+        command.execute(stderr=DEVNULL)
+
+    def disconnect(self, network):
+        """Disconnect all the containers from a network."""
+        containers = DockerNetworkInspect(network).get("Containers") or {}
+        for container in containers.values():
+            # The container might have been removed in the meantime.
+            with suppress(CalledProcessError):
+                docker.network().disconnect(network, container["Name"]).with_force().execute(stderr=DEVNULL)
+
+    def collect(self, leases, networks):
+        """Remove the networks created by processes which are gone.
+
+        :param leases: Leases of the pool, leased networks are kept.
+        :param networks: Existing networks with their owner, updated
+            with the removed networks.
+        """
+        owners = self.get_owners()
+        for network, owner in list(networks.items()):
+            if network not in leases and owner not in owners:
+                self.disconnect(network)
+                with suppress(CalledProcessError):
+                    docker.network().remove(network).execute(stderr=DEVNULL)
+                    del networks[network]
+
+    def fill(self):
+        """Collect the networks of processes which are gone and create the missing networks.
+
+        This is called once per pool before leasing the first network,
+        under the lock of the lease file so that processes don't create
+        the same network. Only the networks which exist afterwards are
+        leased by this pool.
+
+        :raises NetworkPoolError: If no network of the pool exists.
+        """
+        available = []
+        with open_leases(self.path) as leases:
+            reclaim_leases(leases, self.grace, self.get_owners, self.clock())
+            networks = self.get_networks()
+            self.collect(leases, networks)
+            for network in self.networks:
+                if network not in networks:
+                    try:
+                        self.create(network)
+                    except CalledProcessError:
+                        log.warning("Skipping network %s, its subnet might overlap another network", network)
+                        continue
+
+                available.append(network)
+
+        if not available:
+            raise NetworkPoolError(f"No network of {self.name} could be created in {self.subnet}")
+
+        self._available = available
+
+    def _try_acquire(self, owner):
+        with open_leases(self.path) as leases:
+            reclaim_leases(leases, self.grace, self.get_owners, self.clock())
+            for network in self._available:
+                if network not in leases:
+                    leases[network] = {"owner": owner, "time": self.clock()}
+                    return ProbeResult(True, network)
+
+        return ProbeResult(False)
+
+    def acquire(self, owner=None):
+        """Lease a network of the pool, filling the pool the first time.
+
+        :param owner: Process owner of the lease, like `get_process_owner`,
+            defaults to the current process.
+        :return: Name of the network.
+        :raises NetworkPoolError: If no network is free before the timeout.
+        :raises ValueError: If the owner is not a process owner, its lease
+            would be reclaimed after the grace period.
+        """
+        if owner is None:
+            owner = get_process_owner()
+        elif not re.fullmatch(r".+:\d+", owner):
+            raise ValueError(f"Expecting a process owner like host:pid, found {owner!r}")
+
+        if self._available is None:
+            self.fill()
+
+        poller = BackoffPoller(self.timeout)
+        result = poller.poll(lambda: self._try_acquire(owner), poller.clock() + self.timeout)
+        if not result:
+            raise NetworkPoolError(f"No free network in {self.name} after {self.timeout} seconds")
+
+        return result.returned
+
+    def release(self, network):
+        """Disconnect the containers left on a network and release it."""
+        self.disconnect(network)
+        with open_leases(self.path) as leases:
+            leases.pop(network, None)
@@ -1,25 +1,35 @@
 """XProcess management."""
 
 import logging
+import os
 import sys
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple
 from contextlib import contextmanager
 from functools import partial
 from pathlib import Path
+from time import monotonic, sleep
 
 import psutil
 import py
-from attrs import make_class
-from pytest_cache import getrootdir as get_cache_root_dir
+from attrs import define, field, make_class
 from xprocess import ProcessStarter, XProcess, XProcessInfo
 
-from pytest_xdocker.cache import FileCache
-from pytest_xdocker.lock import FileLock
-from pytest_xdocker.network import get_host_ip, get_open_port
+from pytest_xdocker.cache import NullCache, SqliteCache, TieredCache, as_cache
+from pytest_xdocker.docker import DockerContainer
+from pytest_xdocker.lock import get_lock_class
+from pytest_xdocker.network import PortAllocator, format_ports, get_host_ip, parse_ports
+from pytest_xdocker.retry import MultiPoller, get_container_address
+from pytest_xdocker.trace import tracer
 
 log = logging.getLogger(__name__)
 
+MAX_SOCKET_PATH = 107
+"""Maximum length in bytes of a unix socket path, without the null byte."""
+
+PUBLISH_KEY = "xdocker/publish"
+"""Prefix of the cache keys of the published ports."""
+
 
 def get_root_dir(config):
     """Get the root directory of the project.
@@ -32,6 +42,8 @@ def get_root_dir(config):
         cache_root_dir = Path(config.rootdir)
     else:
         # Fallback to detecting root using pytest-cache
+        from pytest_cache import getrootdir as get_cache_root_dir
+
         compat = pytest_cache_config_compat(None, config.args, config.trace)
         cache_root_dir = Path(get_cache_root_dir(compat, ".").strpath)
 
@@ -99,7 +111,13 @@ def __init__(self, root_dir=None, cache=None):
         # Needed by ProcessServer.get_cache_publish
         if cache is None:
             cache_dir = get_root_dir(self) / ".pytest_cache"
-            cache = FileCache(cache_dir)
+            cache = TieredCache(
+                SqliteCache(
+                    cache_dir / "xdocker.sqlite3",
+                    ttl=ProcessServer.publish_ttl,
+                    max_size=ProcessServer.publish_max_size,
+                )
+            )
 
         self.cache = cache
 
@@ -156,18 +174,96 @@ def isrunning(self):
         return self.stime == int(proc.create_time())
 
 
+def percentile(values, q):
+    """Get the nearest-rank percentile of the values.
+
+    :param values: Non-empty list of numbers.
+    :param q: Percentile between 0 and 100.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+@define
+class StartupHistory:
+    """History of the time for processes to be ready, kept in a cache.
+
+    The history adapts how a process is waited for: the wait starts
+    after half the usual fastest startup and the timeout is extended
+    for processes that are usually slow, up to a hard ceiling.
+
+    :param cache: `Cache` instance, eg the pytest cache.
+    :param size: Number of startups kept for each process.
+    :param factor: Multiplier of the 95th percentile for the timeout.
+    :param ceiling: Maximum adapted timeout in seconds.
+    """
+
+    cache = field()
+    size = field(default=20)
+    factor = field(default=2)
+    ceiling = field(default=600)
+    sleeper = field(default=sleep)
+
+    def _get_key(self, name):
+        return f"xdocker/startup/{name}"
+
+    def get(self, name):
+        """Get the startup times of a process."""
+        return self.cache.get(self._get_key(name), [])
+
+    def add(self, name, duration):
+        """Add the startup time of a process."""
+        history = [*self.get(name), duration][-self.size :]
+        self.cache.set(self._get_key(name), history)
+
+    def get_delay(self, name):
+        """Get the initial delay before waiting for a process, 0 without history."""
+        history = self.get(name)
+        return percentile(history, 10) / 2 if history else 0
+
+    def get_timeout(self, name, timeout):
+        """Get the timeout for a process, at least the given timeout."""
+        history = self.get(name)
+        if not history:
+            return timeout
+
+        return max(timeout, min(self.ceiling, self.factor * percentile(history, 95)))
+
+    def adapt(self, name, starter):
+        """Adapt the timeout and the wait of a `ProcessStarter`."""
+        delay = self.get_delay(name)
+        starter.timeout = self.get_timeout(name, starter.timeout)
+        if delay:
+            wait = starter.wait
+
+            def delayed_wait(log_file):
+                self.sleeper(delay)
+                return wait(log_file)
+
+            starter.wait = delayed_wait
+
+        return starter
+
+
 class Process(XProcess):
     """XProcess with restarting capability and extra logging."""
 
-    def __init__(self, config=None, root_dir=None, log=None):
-        """Init."""
+    def __init__(self, config=None, root_dir=None, log=None, history=None):
+        """Init.
+
+        :param history: Optional `StartupHistory`, defaults to using the
+            cache of the config.
+        """
         if config is None:
             config = ProcessConfig()
         if root_dir is None:
             root_dir = get_process_dir(config)
+        if history is None:
+            history = StartupHistory(getattr(config, "cache", None) or NullCache())
 
         root_dir = py.path.local(root_dir)
         super().__init__(config, root_dir, log)
+        self.history = history
 
     @property
     def root_dir(self):
@@ -178,24 +274,44 @@ def getinfo(self, name):
         """Get the process info based on the name."""
         return ProcessInfo(self.root_dir, name)
 
-    def ensure(self, name, prepare_func, restart=None):
-        """Ensure the container is running or restarted if requested."""
+    def get_restart(self, name, restart=None):
+        """Get whether to restart the process, defaults to the xrestart option."""
         if restart is None:
             xrestart = getattr(self.config.option, "xrestart", None)
             if xrestart is not None:
                 restart = xrestart == [] or name in xrestart
 
+        return restart
+
+    def ensure(self, name, prepare_func, restart=None):
+        """Ensure the container is running or restarted if requested."""
+        restart = self.get_restart(name, restart)
+
+        # Only called when the process is started.
+        started = []
+
+        def adapted_prepare_func(controldir, *args, **kwargs):
+            starter = self.history.adapt(name, prepare_func(controldir, *args, **kwargs))
+            started.append(monotonic())
+            return starter
+
         try:
-            pid, log_path = super().ensure(name, prepare_func, restart)
+            with tracer.span("ensure", container=name):
+                pid, log_path = super().ensure(name, adapted_prepare_func, restart)
         except Exception:
             process_output_file = Path(self.getinfo(name).logpath)
             if process_output_file.exists():
                 log.warning(process_output_file.read_text())
             raise
 
-        proc = psutil.Process(pid)
-        info = self.getinfo(name)
-        info.stime_path.write(str(int(proc.create_time())))
+        if started:
+            self.history.add(name, monotonic() - started[0])
+
+            # Only write STIME when started, other processes might be
+            # reading it concurrently under a shared lock.
+            proc = psutil.Process(pid)
+            info = self.getinfo(name)
+            info.stime_path.write(str(int(proc.create_time())))
 
         return pid, log_path
 
@@ -203,12 +319,53 @@ def ensure(self, name, prepare_func, restart=None):
 class ProcessServer(metaclass=ABCMeta):
     """Base class for a container process."""
 
-    def __init__(self, process=None):
-        """Init."""
+    publish_ttl = 7 * 24 * 60 * 60
+    """Time in seconds before the published ports expire in the cache."""
+
+    publish_max_size = 1000
+    """Number of published ports kept in the cache."""
+
+    socket_dir = "/run/xdocker"
+    """Directory of the unix sockets in the container, see `get_socket_dir`."""
+
+    socket_mode = 0o770
+    """Mode of the directory of the unix sockets on the host.
+
+    Only the owner and group of the control directory can create sockets,
+    so the container should run with the same user, see
+    `DockerRunCommand.with_user`.
+    """
+
+    def __init__(
+        self, process=None, poller=None, lock_timeout=None, port_allocator=None, direct=False, lock_class=None
+    ):
+        """Init.
+
+        :param process: Optional `Process`, defaults to a new instance.
+        :param poller: Optional `MultiPoller` for the probes returned by
+            `get_probes`, defaults to a new instance.
+        :param lock_timeout: Optional time in seconds to wait for the
+            locks of the process, defaults to waiting forever.
+        :param port_allocator: Optional `PortAllocator` for the published
+            ports, defaults to one in the state directory.
+        :param direct: True to connect to the IP of the container when
+            routable, see `get_address`.
+        :param lock_class: Optional class of the locks of the process,
+            defaults to `get_lock_class`.
+        """
         if process is None:
             process = Process()
+        if poller is None:
+            poller = MultiPoller()
+        if port_allocator is None:
+            port_allocator = PortAllocator.from_state_dir()
 
         self.process = process
+        self.poller = poller
+        self.lock_timeout = lock_timeout
+        self.port_allocator = port_allocator
+        self.direct = direct
+        self.lock_class = get_lock_class() if lock_class is None else lock_class
 
     @abstractmethod
     def prepare_func(self, controldir):
@@ -218,16 +375,123 @@ def prepare_func(self, controldir):
         :return: ProcessData used to ensure the server is running.
         """
 
-    def get_cache_publish(self, controldir, container_ports):
-        """Read from cache or define published ports."""
-        cache = self.process.config.cache
-        key = f"{controldir.basename}/{container_ports}"
-        host_ports = cache.get(key, None)
-        if host_ports is None:
-            host_ports = get_open_port()
-            cache.set(key, host_ports)
+    def get_probes(self, name):
+        """Get the probes to poll until the server is ready.
+
+        The probes are polled concurrently after the process is ensured,
+        eg `TcpProbe.from_container(DockerContainer(name), direct=self.direct)`.
+
+        :param name: Name of the process.
+        :return: List of probes, none by default.
+        """
+        return []
+
+    def get_address(self, name, port=None, network=None):
+        """Get the host and port to connect to the server from tests.
+
+        When `direct` is True, this is the IP of the container on its
+        network if this host can route to it, which bypasses the docker
+        proxy of the published ports. Otherwise, this is the published
+        port on the host.
+
+        :param name: Name of the process, also the container name.
+        :param port: Port in the container, defaults to the port binding.
+        :param network: Optional network of the container, defaults to
+            the first network with a routable IP.
+        """
+        return get_container_address(DockerContainer(name), port, self.direct, network)
+
+    def get_socket_dir(self, controldir):
+        """Get the directory of the unix sockets shared with the server.
+
+        The directory is created in the control directory with the
+        `socket_mode`. It can be mounted on `socket_dir` with
+        `DockerRunCommand.with_socket_dir`.
+
+        :param controldir: Control directory of the process.
+        :return: Path to the directory on the host.
+        """
+        path = Path(str(controldir), "sockets")
+        path.mkdir(parents=True, exist_ok=True)
+        path.chmod(self.socket_mode)
+        return path
 
-        return container_ports, host_ports, get_host_ip()
+    def get_socket_path(self, name, socket):
+        """Get the path of a unix socket of the server, eg to connect from tests.
+
+        The socket path can be probed for readiness with `UnixSocketProbe`.
+
+        :param name: Name of the process.
+        :param socket: Name of the socket in `socket_dir`.
+        :raises ValueError: If the path is too long for a unix socket.
+        """
+        path = self.get_socket_dir(self.process.getinfo(name).controldir) / socket
+        for socket_path in (str(path), f"{self.socket_dir}/{socket}"):
+            if len(os.fsencode(socket_path)) > MAX_SOCKET_PATH:
+                raise ValueError(
+                    f"Unix socket path longer than {MAX_SOCKET_PATH} bytes: {socket_path}, "
+                    "use a shorter process name or a shorter xprocess rootdir"
+                )
+
+        return path
+
+    def get_cache_publish(self, controldir, container_ports):
+        """Read from cache or define published ports.
+
+        :param controldir: Control directory of the process.
+        :param container_ports: Container ports, ie 1234 or a contiguous
+            block like 1234-1238, which is published to a contiguous
+            block of host ports cached under a single key.
+        :return: Container ports, host ports and host IP, which can be
+            passed to `DockerRunCommand.with_publish`.
+        """
+        cache = as_cache(self.process.config.cache, ttl=self.publish_ttl, max_size=self.publish_max_size)
+        key = f"{PUBLISH_KEY}/{controldir.basename}/{container_ports}"
+        owner = controldir.basename
+        start, end = parse_ports(container_ports)
+        count = end - start + 1
+        host_port = cache.get(key, None)
+        if host_port is None or not self.port_allocator.reserve(owner, host_port, count):
+            port = self.port_allocator.allocate(owner, count)
+            # Only one of the processes racing to publish the ports wins.
+            if host_port is None:
+                winner = cache.setdefault(key, port)
+            elif cache.compare_and_set(key, host_port, port):
+                winner = port
+            else:
+                winner = cache.get(key, port)
+
+            if winner != port:
+                self.port_allocator.release(port, count)
+
+            host_port = winner
+            # Bound the ports published by servers with unique names.
+            cache.compact(PUBLISH_KEY)
+
+        return container_ports, format_ports(host_port, count), get_host_ip()
+
+    def _restart(self, name, prepare_func, lock, controldir):
+        """Restart a server with exclusive access, then share it again.
+
+        Restarts are serialized so that only one waits for exclusive
+        access, and the start lock is held until the shared lock is taken
+        back so that other processes don't terminate the restarted server.
+        """
+        lockfile = controldir.join("xprocess.lock")
+        lock.unlock()
+        with self.lock_class(controldir.join("xprocess.restart.lock"), timeout=self.lock_timeout):
+            exclusive_lock = self.lock_class(lockfile, timeout=self.lock_timeout)
+            exclusive_lock.lock()
+            try:
+                with self.lock_class(controldir.join("xprocess.start.lock"), timeout=self.lock_timeout):
+                    started = self.process.ensure(name, prepare_func, True)
+                    exclusive_lock.unlock()
+                    lock.lock()
+            finally:
+                if exclusive_lock.is_locked:
+                    exclusive_lock.unlock()
+
+        return started
 
     @contextmanager
     def run(self, name, restart=None):
@@ -239,7 +503,8 @@ def run(self, name, restart=None):
         """
 
         def prepare_func(controldir, *args, **kwargs):
-            process_data = self.prepare_func(controldir)
+            with tracer.span("prepare", container=name):
+                process_data = self.prepare_func(controldir)
 
             class Starter(ProcessStarter):
                 pattern = process_data.pattern
@@ -248,18 +513,57 @@ class Starter(ProcessStarter):
                 timeout = process_data.timeout
                 max_read_lines = 100000
 
+                def wait(self, log_file):
+                    with tracer.span("wait", container=name):
+                        return super().wait(log_file)
+
             return Starter(controldir, *args, **kwargs)
 
+        restart = self.process.get_restart(name, restart)
         info = self.process.getinfo(name)
         lockfile = info.controldir.join("xprocess.lock")
-        lock = FileLock(lockfile)
+        # Processes using the server hold a shared lock so that they
+        # don't serialize on an already running server.
+        lock = self.lock_class(lockfile, shared=True, timeout=self.lock_timeout)
 
-        with lock:
-            yield self.process.ensure(name, prepare_func, restart)
-
-        # Prevent pytest_runtest_makereport from reading a closed file handle.
-        self.process.resources[0].fhandles = []
-        info.terminate()
+        try:
+            with tracer.span("run", container=name):
+                lock.lock()
+                if restart:
+                    started = self._restart(name, prepare_func, lock, info.controldir)
+                elif not self.process.getinfo(name).isrunning():
+                    # Keep the shared lock so that other processes don't
+                    # terminate the server, and only serialize with other
+                    # processes starting it.
+                    with self.lock_class(info.controldir.join("xprocess.start.lock"), timeout=self.lock_timeout):
+                        started = self.process.ensure(name, prepare_func, False)
+                else:
+                    started = self.process.ensure(name, prepare_func, False)
+
+                with tracer.span("ready", container=name):
+                    self.poller.check(self.get_probes(name))
+
+            yield started
+        finally:
+            if lock.is_locked:
+                lock.unlock()
+
+        with tracer.span("teardown", container=name):
+            # Prevent pytest_runtest_makereport from reading a closed file handle.
+            self.process.resources[0].fhandles = []
+            # Only terminate when no other process is using or starting the server.
+            start_lock = self.lock_class(info.controldir.join("xprocess.start.lock"))
+            if start_lock.try_lock():
+                try:
+                    terminate_lock = self.lock_class(lockfile)
+                    if terminate_lock.try_lock():
+                        try:
+                            # Get the info again, the pid changes when restarted.
+                            self.process.getinfo(name).terminate()
+                        finally:
+                            terminate_lock.unlock()
+                finally:
+                    start_lock.unlock()
 
 
 # Fake ProcessConfig that matches the config at the pytest version pytest-cache
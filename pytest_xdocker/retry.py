@@ -6,18 +6,33 @@
     >>> from hamcrest import greater_than
     >>> retry(calling(next, count())).until(greater_than(2), delay=0)
     3
+
+Instead of a fixed number of tries, the retry can also be given an
+overall deadline in seconds with an exponential backoff between tries:
+
+    >>> retry(calling(next, count())).within(10).until(greater_than(2))
+    3
 """
 
+import random
 import re
+import socket
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from time import sleep
+from pathlib import Path
+from subprocess import DEVNULL, CalledProcessError, TimeoutExpired
+from time import monotonic, sleep
 
-from attrs import define, field
+from attrs import Factory, define, evolve, field
 from hamcrest import (
+    all_of,
     greater_than_or_equal_to,
+    less_than_or_equal_to,
 )
 
+from pytest_xdocker.metrics import RetryStats, recorder
+from pytest_xdocker.trace import tracer
 from pytest_xdocker.validators import matches
 
 
@@ -77,16 +92,28 @@ class Retry:
     """Retry the given function until the expected result."""
 
     func = field()
+    poller = field(default=None)
+
+    def _get_poller(self, tries, delay):
+        return Poller(tries, delay) if self.poller is None else self.poller
+
+    def within(self, timeout, **kwargs):
+        """Retry until a deadline instead of a number of tries.
+
+        :param timeout: Overall time in seconds.
+        :param kwargs: Optional keyword arguments passed to `BackoffPoller`.
+        """
+        return evolve(self, poller=BackoffPoller(timeout, **kwargs))
 
     def until(self, value, tries=30, delay=1):
         """Return a poller with a value check probe."""
         probe = UntilProbe(self.func, value)
-        return Poller(tries, delay).check(probe)
+        return self._get_poller(tries, delay).check(probe)
 
     def catching(self, exception, pattern="", tries=30, delay=1):
         """Return a poller with a catching probe."""
         probe = CatchingProbe(self.func, exception, pattern)
-        return Poller(tries, delay).check(probe)
+        return self._get_poller(tries, delay).check(probe)
 
 
 @define(frozen=True)
@@ -99,14 +126,21 @@ class Poller:
 
     def check(self, probe):
         """Poll until the probe succeeds."""
+        with tracer.span("poll", probe=probe), recorder.timing("poll", probe), recorder.retrying(probe) as stats:
+            return self._check(probe, stats)
+
+    def _check(self, probe, stats):
         result = ProbeResult(False)
         for n in range(self.tries):
             # Only sleep in between attempts.
             if n:
                 self.sleeper(self.delay)
+                stats.sleep += self.delay
 
             result = probe()
+            stats.attempts += 1
             if result:
+                stats.success = True
                 return result.returned
         else:
             if result.raised:
@@ -117,6 +151,135 @@ def check(self, probe):
                 )
 
 
+@define(frozen=True)
+class BackoffPoller:
+    """Poller for retrying an operation until a deadline.
+
+    The delay between tries starts small and backs off exponentially
+    up to a maximum, with some jitter so that concurrent pollers don't
+    probe in lockstep. A probe can also request the next delay with
+    `ProbeResult.delay`.
+
+    :param timeout: Overall time in seconds, the probe is tried at least once.
+    :param delay: Initial delay in seconds.
+    :param max_delay: Maximum delay in seconds.
+    :param factor: Multiplier of the delay after each try.
+    :param jitter: Ratio of the delay randomly added or removed.
+    """
+
+    timeout = field(validator=matches(greater_than_or_equal_to(0)))
+    delay = field(default=0.05, validator=matches(greater_than_or_equal_to(0)))
+    max_delay = field(default=1, validator=matches(greater_than_or_equal_to(0)))
+    factor = field(default=2, validator=matches(greater_than_or_equal_to(1)))
+    jitter = field(default=0.1, validator=matches(all_of(greater_than_or_equal_to(0), less_than_or_equal_to(1))))
+    sleeper = field(default=sleep)
+    clock = field(default=monotonic)
+    uniform = field(default=random.uniform)
+
+    def delays(self):
+        """Yield the delays between tries before jitter."""
+        delay = min(self.delay, self.max_delay)
+        while True:
+            yield delay
+            delay = min(delay * self.factor, self.max_delay)
+
+    def poll(self, probe, deadline, stats=None):
+        """Poll until the probe succeeds or the deadline passes.
+
+        :param probe: Probe to call.
+        :param deadline: Time from the clock when to stop polling.
+        :param stats: Optional `RetryStats` to count attempts and sleep.
+        :return: Last `ProbeResult` of the probe.
+        """
+        if stats is None:
+            stats = RetryStats(probe)
+
+        delays = self.delays()
+        while True:
+            result = probe()
+            stats.attempts += 1
+            stats.success = bool(result)
+            remaining = deadline - self.clock()
+            if result or remaining <= 0:
+                return result
+
+            delay = next(delays)
+            if result.delay is not None:
+                delay = result.delay
+            else:
+                delay = self.uniform(delay * (1 - self.jitter), delay * (1 + self.jitter))
+
+            delay = max(0, min(delay, remaining))
+            self.sleeper(delay)
+            stats.sleep += delay
+
+    def check(self, probe):
+        """Poll until the probe succeeds."""
+        with tracer.span("poll", probe=probe), recorder.timing("poll", probe), recorder.retrying(probe) as stats:
+            result = self.poll(probe, self.clock() + self.timeout, stats)
+            if result:
+                return result.returned
+            elif result.raised:
+                raise result.raised
+            else:
+                raise AssertionError(f"Polling failed after {self.timeout} seconds\n{probe}\n{result}")
+
+
+class PollingError(AssertionError):
+    """Raised when probes failed to succeed before the deadline.
+
+    :param failures: List of failed probes with their last `ProbeResult`.
+    """
+
+    def __init__(self, failures):
+        """Init."""
+        self.failures = failures
+        details = "\n".join(f"{probe}\n{result}" for probe, result in failures)
+        super().__init__(f"Polling failed for {len(failures)} probes\n{details}")
+
+
+@define(frozen=True)
+class MultiPoller:
+    """Poller for retrying many probes concurrently.
+
+    Each probe is polled in its own thread until it succeeds, all with
+    the same deadline, so waiting for many probes takes as long as the
+    slowest one rather than the sum of all of them.
+
+    :param poller: `BackoffPoller` used for each probe.
+    :param max_workers: Maximum number of threads, defaults to one per probe.
+    """
+
+    poller = field(default=Factory(lambda: BackoffPoller(30)))
+    max_workers = field(default=None)
+
+    def _poll(self, probe, deadline):
+        with tracer.span("poll", probe=probe), recorder.retrying(probe) as stats:
+            return self.poller.poll(probe, deadline, stats)
+
+    def check(self, probes):
+        """Poll until all the probes succeed.
+
+        :param probes: Iterable of probes.
+        :return: List of values returned by each probe.
+        :raises PollingError: If any probe failed before the deadline.
+        """
+        probes = list(probes)
+        if not probes:
+            return []
+
+        deadline = self.poller.clock() + self.poller.timeout
+        with recorder.timing("poll", f"{len(probes)} probes"):
+            with ThreadPoolExecutor(self.max_workers or len(probes)) as executor:
+                results = list(executor.map(self._poll, probes, [deadline] * len(probes)))
+
+            failures = [(probe, result) for probe, result in zip(probes, results, strict=True) if not result]
+            if failures:
+                raise PollingError(failures)
+
+        return [result.returned for result in results]
+
+
 class Probe(metaclass=ABCMeta):
     """Base probe class."""
 
@@ -170,13 +333,235 @@ def __str__(self):
         return f"Probing: {self.func}\nCatching: {self.exception}"
 
 
+def get_container_address(container, port=None, direct=False, network=None):
+    """Get the host and port to connect to a container from the host.
+
+    :param container: `DockerContainer` instance.
+    :param port: Port exposed to the host, defaults to the port binding.
+    :param direct: True to connect to the IP of the container on its
+        network when routable, which bypasses the docker proxy of the
+        published ports.
+    :param network: Optional network of the direct IP, defaults to the
+        first network of the container with a routable IP.
+    """
+    if direct:
+        # Import lazily because the network module imports this module.
+        from pytest_xdocker.network import is_routable_ip
+
+        ips = container.network_ips if network is None else [container.network_ip(network)]
+        ip = next((ip for ip in ips if ip is not None and is_routable_ip(ip)), None)
+        if ip is not None:
+            try:
+                return ip, port if port is not None else container.port_binding
+            except AssertionError:
+                pass
+
+    host = container.host_ip(port)
+    if host in (None, "", "0.0.0.0"):  # noqa: S104
+        host = "127.0.0.1"
+    elif host == "::":
+        host = "::1"
+
+    return host, container.host_port(port)
+
+
+@define(frozen=True)
+class TcpProbe(Probe):
+    """Probe to connect to a TCP port.
+
+    When the port is published by docker, the userland proxy accepts
+    connections before the server is listening but closes them right
+    away, so the connection is only ready if it stays open for a peek.
+
+    :param host: Host name or IP.
+    :param port: Port number.
+    :param timeout: Connection timeout in seconds.
+    :param peek: Time in seconds to wait for the connection to be closed.
+    """
+
+    host = field()
+    port = field(converter=int)
+    timeout = field(default=0.25)
+    peek = field(default=0.05)
+
+    @classmethod
+    def from_container(cls, container, port=None, direct=False, network=None, **kwargs):
+        """Probe the port of a `DockerContainer`, see `get_container_address`."""
+        return cls(*get_container_address(container, port, direct, network), **kwargs)
+
+    def __call__(self):
+        """Connect and peek at the socket."""
+        try:
+            with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+                sock.settimeout(self.peek)
+                try:
+                    closed = sock.recv(1, socket.MSG_PEEK) == b""
+                except TimeoutError:
+                    # The server is waiting for the client to talk first.
+                    closed = False
+        except OSError as error:
+            return ProbeResult(False, raised=error)
+
+        return ProbeResult(not closed)
+
+    def __str__(self):
+        return f"Probing: tcp://{self.host}:{self.port}"
+
+
+@define
+class HttpProbe(Probe):
+    """Probe to expect an HTTP status, reusing the same connection.
+
+    :param host: Host name or IP.
+    :param port: Port number.
+    :param path: Path of the request, defaults to /.
+    :param status: Expected status or matcher, defaults to 200.
+    :param timeout: Connection and read timeout in seconds.
+    """
+
+    host = field()
+    port = field(converter=int)
+    path = field(default="/")
+    status = field(default=200)
+    timeout = field(default=0.5)
+    _connection = field(default=None, init=False, eq=False, repr=False)
+
+    @classmethod
+    def from_container(cls, container, port=None, direct=False, network=None, **kwargs):
+        """Probe the port of a `DockerContainer`, see `get_container_address`."""
+        return cls(*get_container_address(container, port, direct, network), **kwargs)
+
+    def __call__(self):
+        """Match the response status with the expected status."""
+        # Import lazily because http.client pulls in the email package.
+        from http.client import HTTPConnection, HTTPException
+
+        if self._connection is None:
+            self._connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+        try:
+            self._connection.request("GET", self.path)
+            response = self._connection.getresponse()
+            response.read()
+        except (OSError, HTTPException) as error:
+            # Reconnect on the next call.
+            self._connection.close()
+            return ProbeResult(False, raised=error)
+
+        try:
+            success = self.status.matches(response.status)
+        except AttributeError:
+            success = self.status == response.status
+        return ProbeResult(success, response.status)
+
+    def __str__(self):
+        return f"Probing: http://{self.host}:{self.port}{self.path}\n Expecting: {self.status!r}"
+
+
+@define(frozen=True)
+class CommandProbe(Probe):
+    """Probe to expect a command to succeed, eg a docker exec command.
+
+    :param command: `Command` instance.
+    :param timeout: Timeout in seconds for the command to complete.
+    """
+
+    command = field()
+    timeout = field(default=2)
+
+    def __call__(self):
+        """Execute the command and check the exit status."""
+        try:
+            output = self.command.execute(stderr=DEVNULL, timeout=self.timeout)
+        except (CalledProcessError, TimeoutExpired) as error:
+            return ProbeResult(False, raised=error)
+
+        return ProbeResult(True, output)
+
+    def __str__(self):
+        return f"Probing: {self.command}"
+
+
+@define
+class LogProbe(Probe):
+    """Probe to expect a line matching a pattern in a log file.
+
+    The file is read incrementally, each call only reads the lines
+    appended since the previous call.
+
+    :param path: Path to the log file.
+    :param pattern: Regular expression to search in each line.
+    """
+
+    path = field(converter=Path)
+    pattern = field()
+    _offset = field(default=0, init=False, eq=False, repr=False)
+
+    def __call__(self):
+        """Search the pattern in the new lines."""
+        try:
+            with self.path.open("rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return ProbeResult(False)
+
+        # Only consume complete lines, the last one might still be written.
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        for line in data[:end].decode("utf-8", "replace").splitlines():
+            if re.search(self.pattern, line):
+                return ProbeResult(True, line)
+
+        return ProbeResult(False)
+
+    def __str__(self):
+        return f"Probing: {self.path}\n Expecting: {self.pattern!r}"
+
+
+@define(frozen=True)
+class UnixSocketProbe(Probe):
+    """Probe to connect to a unix socket.
+
+    Connecting rather than checking if the socket exists ignores a
+    stale socket left by a previous server.
+
+    :param path: Path to the socket.
+    :param timeout: Connection timeout in seconds.
+    """
+
+    path = field(converter=Path)
+    timeout = field(default=0.25)
+
+    def __call__(self):
+        """Connect to the socket."""
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(str(self.path))
+        except OSError as error:
+            return ProbeResult(False, raised=error)
+
+        return ProbeResult(True, self.path)
+
+    def __str__(self):
+        return f"Probing: unix://{self.path}"
+
+
 @define(frozen=True)
 class ProbeResult:
-    """Result of a probe."""
+    """Result of a probe.
+
+    :param success: True if the probe succeeded, False otherwise.
+    :param returned: Value returned by the probe.
+    :param raised: Exception raised by the probe.
+    :param delay: Optional delay in seconds requested before the next try.
+    """
 
     success = field()
     returned = field(default=None)
     raised = field(default=None)
+    delay = field(default=None)
 
     def __bool__(self):
         return self.success
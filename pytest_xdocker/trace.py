@@ -0,0 +1,118 @@
+"""Trace spans in the Chrome trace event format.
+
+Spans are appended to a file which can be opened in Perfetto or in
+chrome://tracing. Each span is written as a complete event on a single
+line, so concurrent processes like xdist workers and xdocker scripts
+can append to the same file:
+
+    >>> from tempfile import TemporaryDirectory
+    >>> with TemporaryDirectory() as directory:
+    ...     tracer = Tracer(f"{directory}/trace.json")
+    ...     with tracer.span("run", container="test"):
+    ...         pass
+    ...     [event["name"] for event in load_trace(tracer.path)]
+    ['process_name', 'run']
+
+The file is a JSON array without the closing bracket, which is allowed
+by the format.
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import time_ns
+
+from attrs import define, field
+
+TRACE_ENV = "XDOCKER_TRACE"
+"""Environment variable to trace the xdocker script, set by the plugin."""
+
+
+def get_worker():
+    """Get the xdist worker id of the current process."""
+    return os.environ.get("PYTEST_XDIST_WORKER", "main")
+
+
+def start_trace(path):
+    """Start a new trace file, truncating any previous trace."""
+    with open(path, "w") as f:
+        f.write("[\n")
+
+
+def load_trace(path):
+    """Load the events from a trace file."""
+    with open(path) as f:
+        content = f.read().rstrip().rstrip(",")
+
+    return json.loads(f"{content}]")
+
+
+@define
+class Tracer:
+    """Write spans to a trace file.
+
+    :param path: Path to the trace file, None to disable tracing.
+    """
+
+    path = field(default=None)
+    _pid = field(default=None, init=False)
+
+    @property
+    def enabled(self):
+        """Return True when tracing to a file, False otherwise."""
+        return self.path is not None
+
+    def _write(self, event):
+        line = json.dumps(event) + ",\n"
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        else:
+            line = "[\n" + line
+
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def _write_metadata(self):
+        # Name the process once so that each worker gets a track.
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._write({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": get_worker()}})
+
+    @contextmanager
+    def span(self, name, **args):
+        """Trace the context as a span.
+
+        :param name: Name of the span, eg pull, run or poll.
+        :param args: Attributes of the span, eg the container name.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self._write_metadata()
+        start = time_ns()
+        try:
+            yield
+        finally:
+            end = time_ns()
+            self._write(
+                {
+                    "name": name,
+                    "cat": "xdocker",
+                    "ph": "X",
+                    "ts": start // 1000,
+                    "dur": (end - start) // 1000,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {"worker": get_worker(), **{k: str(v) for k, v in args.items()}},
+                }
+            )
+
+
+tracer = Tracer(os.environ.get(TRACE_ENV))
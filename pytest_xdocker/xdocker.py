@@ -13,24 +13,39 @@
 import re
 from argparse import ArgumentParser
 from contextlib import suppress
+from functools import cache
 from multiprocessing import Process
 from subprocess import STDOUT, CalledProcessError, check_call
 from time import sleep
 
-import psutil
 from hamcrest import is_not
 
+from pytest_xdocker.breaker import get_docker_breaker
 from pytest_xdocker.command import Command, script_to_command
 from pytest_xdocker.docker import (
     DockerCommand,
     DockerContainer,
     docker,
 )
+from pytest_xdocker.governor import get_docker_semaphore
 from pytest_xdocker.retry import retry
+from pytest_xdocker.trace import tracer
 
 log = logging.getLogger(__name__)
 
-xdocker = script_to_command("xdocker", DockerCommand)
+
+@cache
+def get_xdocker():
+    """Get the xdocker command, only looking for the script on first call."""
+    return script_to_command("xdocker", DockerCommand)
+
+
+def __getattr__(name):
+    """Resolve the xdocker command lazily instead of scanning PATH on import."""
+    if name == "xdocker":
+        return get_xdocker()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def docker_remove(name):
@@ -80,7 +95,8 @@ def docker_run(*args, command=docker.command("run")):  # noqa: B008
         raise ValueError("Cannot pass --detach in xdocker arguments")
 
     try:
-        output = command.with_optionals("--detach").with_positionals(*args).execute(stderr=STDOUT)
+        with get_docker_breaker(), get_docker_semaphore("run"):
+            output = command.with_optionals("--detach").with_positionals(*args).execute(stderr=STDOUT)
     except CalledProcessError as error:
         match = re.search(r'The container name "/?(?P<name>[^"]+)" is already in use', error.output)
         if not match:
@@ -102,11 +118,13 @@ def docker_up(*args, command):
     services = [a for a in args if not a.startswith("-")]
 
     up_command = Command("up", command).with_optionals("-d", *options).with_positionals(*services)
-    up_command.execute(stderr=STDOUT)
+    with get_docker_breaker():
+        up_command.execute(stderr=STDOUT)
 
     # Get the container name from docker compose ps.
     ps_command = Command("ps", command).with_optionals("--format", "{{.Name}}").with_positionals(*services)
-    output = ps_command.execute(stderr=STDOUT).strip()
+    with get_docker_breaker():
+        output = ps_command.execute(stderr=STDOUT).strip()
     if not output:
         return None
 
@@ -120,6 +138,8 @@ def wait_ppid(ppid=None, interval=1):
     :param ppid: The parent PID to monitor. If None, uses os.getppid().
     :param interval: Check the parent PID status every interval seconds.
     """
+    import psutil
+
     if ppid is None:
         ppid = os.getppid()
     while True:
@@ -197,7 +217,8 @@ def main(argv=None):
     _, args = parser.parse_known_args(argv)
 
     try:
-        name = retry(docker_call, *args).until(is_not(None), tries=10)
+        with tracer.span("xdocker", args=" ".join(args)):
+            name = retry(docker_call, *args).until(is_not(None), tries=10)
     except Exception as error:
         parser.error(str(error))
 
@@ -0,0 +1,63 @@
+"""Benchmark the cache codecs on realistic payloads.
+
+Run with: python -m tests.benchmarks.bench_codecs
+"""
+
+import timeit
+
+from pytest_xdocker.cache import get_codec
+
+
+def make_inspect(containers=20):
+    """Make a snapshot like the output of docker inspect."""
+    return [
+        {
+            "Id": f"{i:064x}",
+            "Name": f"/container-{i}",
+            "State": {"Status": "running", "Running": True, "Pid": 1000 + i, "ExitCode": 0},
+            "Config": {
+                "Image": "postgres:16",
+                "Env": [f"KEY_{j}=value-{j}" for j in range(20)],
+                "Labels": {f"label.{j}": f"value-{j}" for j in range(10)},
+            },
+            "NetworkSettings": {
+                "Ports": {f"{5432 + j}/tcp": [{"HostIp": "0.0.0.0", "HostPort": str(40000 + j)}] for j in range(4)},  # noqa: S104
+                "Networks": {"bridge": {"IPAddress": f"172.17.0.{i + 2}", "Gateway": "172.17.0.1"}},
+            },
+        }
+        for i in range(containers)
+    ]
+
+
+PAYLOADS = {
+    "inspect": make_inspect(),
+    "history": [0.5 + i / 100 for i in range(20)],
+    "publish": 40001,
+}
+
+
+def bench(codec, data, number=1000):
+    """Return the encode and decode time in microseconds, and the size in bytes."""
+    payload = codec.encode(data)
+    encode = timeit.timeit(lambda: codec.encode(data), number=number) / number * 1e6
+    decode = timeit.timeit(lambda: codec.decode(payload), number=number) / number * 1e6
+    return encode, decode, len(payload)
+
+
+def main():
+    """Print the benchmark of each available codec."""
+    print(f"{'codec':<8} {'payload':<8} {'encode':>10} {'decode':>10} {'size':>8}")
+    for name in ["json", "orjson", "msgpack", "pickle"]:
+        try:
+            codec = get_codec(name)
+        except ImportError:
+            print(f"{name:<8} not installed")
+            continue
+
+        for payload, data in PAYLOADS.items():
+            encode, decode, size = bench(codec, data)
+            print(f"{name:<8} {payload:<8} {encode:>8.1f}us {decode:>8.1f}us {size:>8}")
+
+
+if __name__ == "__main__":
+    main()
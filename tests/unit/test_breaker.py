@@ -0,0 +1,116 @@
+"""Unit tests for the breaker module."""
+
+from subprocess import CalledProcessError, TimeoutExpired
+from unittest.mock import Mock
+
+import pytest
+
+from pytest_xdocker.breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    is_daemon_error,
+)
+from pytest_xdocker.cache import MemoryCache
+from pytest_xdocker.lock import MemoryLock
+
+
+@pytest.fixture
+def clock():
+    """Clock that can be moved forward."""
+    return Mock(return_value=0)
+
+
+@pytest.fixture
+def breaker(clock):
+    """Circuit breaker opening after two failures."""
+    return CircuitBreaker(MemoryCache(), MemoryLock(), threshold=2, cooldown=10, clock=clock)
+
+
+def fail(breaker):
+    """Fail an operation with a daemon error."""
+    with pytest.raises(TimeoutExpired), breaker:
+        raise TimeoutExpired("docker", 1)
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (TimeoutExpired("docker", 1), True),
+        (CalledProcessError(1, "docker", stderr="Cannot connect to the Docker daemon at unix:///var/run/docker.sock"), True),
+        (CalledProcessError(1, "docker", output="error during connect: Get ..."), True),
+        (CalledProcessError(1, "docker", stderr="manifest unknown"), False),
+        (CalledProcessError(1, "docker"), False),
+        (ValueError(), False),
+    ],
+)
+def test_is_daemon_error(error, expected):
+    """Only timeouts and connection errors should be daemon errors."""
+    assert is_daemon_error(error) == expected
+
+
+def test_breaker_closed(breaker):
+    """Failing less than the threshold should keep the circuit closed."""
+    fail(breaker)
+    assert not breaker.is_open
+    with breaker:
+        pass
+
+
+def test_breaker_success_resets(breaker):
+    """A success should reset the consecutive failures."""
+    fail(breaker)
+    with breaker:
+        pass
+
+    fail(breaker)
+    assert not breaker.is_open
+
+
+def test_breaker_other_error_resets(breaker):
+    """Other errors mean the daemon responded, like a success."""
+    fail(breaker)
+    with pytest.raises(ValueError), breaker:
+        raise ValueError
+
+    fail(breaker)
+    assert not breaker.is_open
+
+
+def test_breaker_open(breaker):
+    """Failing up to the threshold should open the circuit."""
+    fail(breaker)
+    fail(breaker)
+    operation = Mock()
+    with pytest.raises(CircuitOpenError), breaker:
+        operation()
+
+    operation.assert_not_called()
+
+
+def test_breaker_half_open_success(breaker, clock):
+    """After the cooldown, a successful probe should close the circuit."""
+    fail(breaker)
+    fail(breaker)
+    clock.return_value = 10
+    with breaker:
+        # Other operations fail fast while probing.
+        assert breaker.is_open
+
+    assert not breaker.is_open
+
+
+def test_breaker_half_open_failure(breaker, clock):
+    """After the cooldown, a failed probe should open the circuit again."""
+    fail(breaker)
+    fail(breaker)
+    clock.return_value = 10
+    fail(breaker)
+    assert breaker.is_open
+
+
+def test_breaker_shared(breaker):
+    """Breakers with the same cache should share the circuit state."""
+    other = CircuitBreaker(breaker.cache, MemoryLock(), threshold=2, clock=breaker.clock)
+    fail(breaker)
+    fail(other)
+    assert breaker.is_open
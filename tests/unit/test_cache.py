@@ -1,13 +1,27 @@
 """Unit tests for the cache module."""
 
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from tempfile import TemporaryDirectory
+from time import time
+from unittest.mock import Mock, patch
 
 import pytest
 
 from pytest_xdocker.cache import (
+    STATE_DIR_ENV,
+    CacheError,
     FileCache,
     MemoryCache,
     NullCache,
+    SqliteCache,
+    TieredCache,
+    as_cache,
+    cache_decode,
+    get_codec,
+    get_state_dir,
 )
 
 
@@ -15,6 +29,8 @@
     params=[
         "file",
         "memory",
+        "sqlite",
+        "tiered",
     ]
 )
 def real_cache(request):
@@ -24,6 +40,12 @@ def real_cache(request):
             yield FileCache(path)
     elif request.param == "memory":
         yield MemoryCache()
+    elif request.param == "sqlite":
+        with TemporaryDirectory() as path:
+            yield SqliteCache(Path(path) / "cache.sqlite3")
+    elif request.param == "tiered":
+        with TemporaryDirectory() as path:
+            yield TieredCache(FileCache(path))
     else:
         raise Exception(f"Unsupported cache type: {request.param}")
 
@@ -39,8 +61,376 @@ def test_cache_get_existing(real_cache):
     assert real_cache.get("test", False)
 
 
+def test_cache_set_existing(real_cache):
+    """Setting an existing key should replace its value."""
+    real_cache.set("test", 1)
+    real_cache.set("test", 2)
+    assert real_cache.get("test", None) == 2
+
+
+def test_cache_get_many(real_cache):
+    """Getting many keys should return their value or the default."""
+    real_cache.set_many({"a": 1, "b/c": [2]})
+    assert real_cache.get_many(["a", "b/c", "d"], None) == {"a": 1, "b/c": [2], "d": None}
+
+
+def test_sqlite_cache_get_many_batches(tmp_path):
+    """Getting more keys than a batch should return all of them."""
+    cache = SqliteCache(tmp_path / "cache.sqlite3")
+    items = {str(i): i for i in range(cache.batch_size + 1)}
+    cache.set_many(items)
+    assert cache.get_many(items, None) == items
+
+
+def test_sqlite_cache_threads(tmp_path):
+    """Threads should share the same database."""
+    cache = SqliteCache(tmp_path / "cache.sqlite3")
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda i: cache.set(str(i), i), range(8)))
+
+    assert cache.get_many([str(i) for i in range(8)], None) == {str(i): i for i in range(8)}
+
+
+def test_cache_setdefault(real_cache):
+    """Setting a default should only save the first value."""
+    assert real_cache.setdefault("test", 1) == 1
+    assert real_cache.setdefault("test", 2) == 1
+    assert real_cache.get("test", None) == 1
+
+
+def test_cache_setdefault_none(real_cache):
+    """Setting a default should return a saved None value."""
+    real_cache.set("test", None)
+    assert real_cache.setdefault("test", 1) is None
+    assert real_cache.get("test", 2) is None
+
+
+def test_cache_setdefault_threads(real_cache):
+    """Setting a default concurrently should return the same value to all threads."""
+    with ThreadPoolExecutor(8) as executor:
+        values = set(executor.map(lambda i: real_cache.setdefault("test", i), range(8)))
+
+    assert values == {real_cache.get("test", None)}
+
+
+@pytest.mark.parametrize(
+    "expected, saved",
+    [
+        (None, False),
+        (1, True),
+        (2, False),
+    ],
+)
+def test_cache_compare_and_set(real_cache, expected, saved):
+    """Comparing and setting should only save when the value is expected."""
+    real_cache.set("test", 1)
+    assert real_cache.compare_and_set("test", expected, 3) == saved
+    assert real_cache.get("test", None) == (3 if saved else 1)
+
+
+def test_cache_compare_and_set_missing(real_cache):
+    """Comparing a missing key with None should save the value."""
+    assert real_cache.compare_and_set("test", None, 1)
+    assert real_cache.get("test", None) == 1
+
+
+def test_as_cache_pytest(request):
+    """The pytest cache should be adapted to a file cache in its directory."""
+    cache = as_cache(request.config.cache)
+    assert isinstance(cache, FileCache)
+    cache.set("test", [1])
+    assert as_cache(request.config.cache).get("test", None) == [1]
+
+
+def test_as_cache_adapter():
+    """Other caches should be adapted with their get and set methods."""
+    other = Mock(spec=["get", "set"])
+    other.get.return_value = 1
+    cache = as_cache(other)
+    assert cache.get("test", None) == 1
+    cache.set("test", 2)
+    other.set.assert_called_once_with("test", 2)
+
+
 def test_null_cache():
     """Getting an existing key should always return the default."""
     null_cache = NullCache()
     null_cache.set("test", True)
     assert not null_cache.get("test", False)
+
+
+def test_get_state_dir_env(tmp_path, monkeypatch):
+    """The state directory should be created from the environment."""
+    monkeypatch.setenv(STATE_DIR_ENV, str(tmp_path / "state"))
+    assert get_state_dir() == tmp_path / "state"
+    assert get_state_dir().is_dir()
+
+
+@pytest.fixture
+def default_state_dir(tmp_path, monkeypatch):
+    """Default state directory in a temporary directory."""
+    monkeypatch.delenv(STATE_DIR_ENV, raising=False)
+    monkeypatch.setattr("pytest_xdocker.cache.gettempdir", lambda: str(tmp_path))
+    monkeypatch.setattr("pytest_xdocker.cache.getuser", lambda: "user")
+    return tmp_path / "pytest-xdocker-user"
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="requires POSIX permissions")
+def test_get_state_dir_private(default_state_dir):
+    """The default state directory should only be accessible by the user."""
+    default_state_dir.mkdir(mode=0o755)
+    default_state_dir.chmod(0o755)
+    assert get_state_dir() == default_state_dir
+    assert default_state_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_get_state_dir_symlink(default_state_dir, tmp_path):
+    """A default state directory which is a symlink should raise."""
+    (tmp_path / "other").mkdir()
+    default_state_dir.symlink_to(tmp_path / "other")
+    with pytest.raises(CacheError, match="symlink"):
+        get_state_dir()
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="requires POSIX permissions")
+def test_get_state_dir_other_user(default_state_dir, monkeypatch):
+    """A default state directory owned by another user should raise."""
+    monkeypatch.setattr("os.getuid", lambda: os.stat(default_state_dir.parent).st_uid + 1)
+    with pytest.raises(CacheError, match="owned"):
+        get_state_dir()
+
+
+@pytest.fixture
+def clock():
+    """Clock that can be moved forward."""
+    return Mock(return_value=1000)
+
+
+def test_memory_cache_ttl(clock):
+    """A value should expire after the ttl."""
+    cache = MemoryCache(ttl=10, clock=clock)
+    cache.set("test", 1)
+    clock.return_value += 5
+    assert cache.get("test", None) == 1
+    clock.return_value += 10
+    assert cache.get("test", None) is None
+
+
+def test_memory_cache_max_size():
+    """The least recently used value should be evicted."""
+    cache = MemoryCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a", None)
+    cache.set("c", 3)
+    assert cache.get_many(["a", "b", "c"], None) == {"a": 1, "b": None, "c": 3}
+
+
+def test_memory_cache_compact(clock):
+    """Compacting should remove the expired values with the prefix."""
+    cache = MemoryCache(ttl=10, clock=clock)
+    cache.set_many({"a/1": 1, "b/1": 1})
+    clock.return_value += 20
+    cache.compact("a/")
+    assert list(cache._memory) == ["b/1"]
+
+
+def test_file_cache_ttl(tmp_path, clock):
+    """An expired value should be removed when read."""
+    cache = FileCache(tmp_path, ttl=10, clock=clock)
+    cache.set("test", 1)
+    clock.return_value = time() + 20
+    assert cache.get("test", None) is None
+    assert not (tmp_path / "v" / "test").exists()
+
+
+def test_file_cache_setdefault_expired(tmp_path, clock):
+    """Setting a default should replace an expired value."""
+    cache = FileCache(tmp_path, ttl=10, clock=clock)
+    cache.set("test", 1)
+    clock.return_value = time() + 20
+    assert cache.setdefault("test", 2) == 2
+
+
+def test_file_cache_setdefault_expired_none(tmp_path, clock):
+    """Setting a default should replace an expired None value."""
+    cache = FileCache(tmp_path, ttl=10, clock=clock)
+    cache.set("test", None)
+    clock.return_value = time() + 20
+    assert cache.setdefault("test", 2) == 2
+
+
+def test_file_cache_compact_max_size(tmp_path):
+    """Compacting should keep the most recently read values."""
+    cache = FileCache(tmp_path, max_size=1)
+    cache.set("a/1", 1)
+    cache.set("b/1", 2)
+    os.utime(tmp_path / "v" / "b" / "1", (0, 0))
+    cache.compact()
+    assert cache.get_many(["a/1", "b/1"], None) == {"a/1": 1, "b/1": None}
+    assert not (tmp_path / "v" / "b").exists()
+
+
+def test_file_cache_compact_prefix(tmp_path, clock):
+    """Compacting should only remove values with the prefix."""
+    cache = FileCache(tmp_path, ttl=10, clock=clock)
+    cache.set_many({"a/1": 1, "b/1": 1})
+    clock.return_value = time() + 20
+    cache.compact("a")
+    assert not (tmp_path / "v" / "a").exists()
+    assert (tmp_path / "v" / "b" / "1").exists()
+
+
+def test_sqlite_cache_ttl(tmp_path, clock):
+    """An expired value should not be read."""
+    cache = SqliteCache(tmp_path / "cache.sqlite3", ttl=10, clock=clock)
+    cache.set("test", 1)
+    clock.return_value += 5
+    assert cache.get_many(["test"], None) == {"test": 1}
+    clock.return_value += 10
+    assert cache.get("test", None) is None
+    assert cache.get_many(["test"], None) == {"test": None}
+    assert cache.get_generation("test") == 0
+
+
+def test_sqlite_cache_setdefault_expired(tmp_path, clock):
+    """Setting a default should replace an expired value."""
+    cache = SqliteCache(tmp_path / "cache.sqlite3", ttl=10, clock=clock)
+    cache.set("test", None)
+    assert cache.setdefault("test", 2) is None
+    clock.return_value += 20
+    assert cache.setdefault("test", 2) == 2
+
+
+def test_sqlite_cache_compact_prefix(tmp_path, clock):
+    """Compacting should only remove expired values with the prefix."""
+    cache = SqliteCache(tmp_path / "cache.sqlite3", ttl=10, clock=clock)
+    cache.set_many({"a_1": 1, "ab": 1, "A1": 1})
+    clock.return_value += 20
+    cache.compact("a_")
+    keys = [key for (key,) in cache._connection.execute("SELECT key FROM cache ORDER BY key")]
+    assert keys == ["A1", "ab"]
+
+
+def test_sqlite_cache_compact_max_size(tmp_path, clock):
+    """Compacting should keep the most recently written values."""
+    cache = SqliteCache(tmp_path / "cache.sqlite3", max_size=1, clock=clock)
+    cache.set("a/1", 1)
+    clock.return_value += 1
+    cache.set("a/2", 2)
+    cache.set("b/1", 3)
+    cache.compact("a/")
+    assert cache.get_many(["a/1", "a/2", "b/1"], None) == {"a/1": None, "a/2": 2, "b/1": 3}
+
+
+def test_sqlite_cache_migrate(tmp_path):
+    """A database of a previous version should get the bounds columns."""
+    path = tmp_path / "cache.sqlite3"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+    connection.execute("INSERT INTO cache VALUES ('test', '1')")
+    connection.commit()
+    connection.close()
+    cache = SqliteCache(path, ttl=10)
+    assert cache.get("test", None) == 1
+    cache.set("test", 2)
+    assert cache.get("test", None) == 2
+
+
+@pytest.mark.parametrize(
+    "back",
+    [
+        FileCache,
+        lambda path: SqliteCache(path / "cache.sqlite3"),
+    ],
+)
+def test_tiered_cache_stale(tmp_path, back):
+    """A value written by another process should be read from the back cache."""
+    cache = TieredCache(back(tmp_path))
+    cache.set("test", 1)
+    assert cache.get("test", None) == 1
+    back(tmp_path).set("test", 2)
+    assert cache.get("test", None) == 2
+
+
+def test_tiered_cache_front(tmp_path):
+    """A fresh value should be read from the front cache."""
+    back = FileCache(tmp_path)
+    cache = TieredCache(back)
+    cache.set("test", 1)
+    cache.get("test", None)
+    with patch.object(FileCache, "get") as get:
+        assert cache.get("test", None) == 1
+
+    get.assert_not_called()
+
+
+def test_tiered_cache_expired(tmp_path):
+    """A value expired in the back cache should not be read from the front cache."""
+    clock = Mock(return_value=1000)
+    cache = TieredCache(FileCache(tmp_path, ttl=10, clock=clock))
+    cache.set("test", 1)
+    os.utime(tmp_path / "v" / "test", (1000, 1000))
+    assert cache.get("test", None) == 1
+    clock.return_value += 20
+    assert cache.get("test", None) is None
+
+
+def test_tiered_cache_front_size(tmp_path):
+    """The default front cache should be bounded."""
+    cache = TieredCache(FileCache(tmp_path))
+    assert cache.front.max_size == TieredCache.front_size
+
+
+def test_tiered_cache_unknown_generation():
+    """Without generations, values should always be read from the back cache."""
+    back = NullCache()
+    cache = TieredCache(back)
+    cache.set("test", 1)
+    assert cache.get("test", None) is None
+
+
+@pytest.fixture(
+    params=[
+        "json",
+        "orjson",
+        "msgpack",
+        "pickle",
+    ]
+)
+def codec(request):
+    """Produce pytest parameters for all available codecs."""
+    if request.param in {"orjson", "msgpack"}:
+        pytest.importorskip(request.param)
+
+    return get_codec(request.param)
+
+
+def test_codec_roundtrip(codec, tmp_path):
+    """A cache with a codec should read back its values."""
+    cache = FileCache(tmp_path, encode=codec.encode, decode=codec.decode)
+    cache.set("test", {"ports": [1, 2]})
+    assert cache.get("test", None) == {"ports": [1, 2]}
+
+
+def test_codec_legacy_json(codec):
+    """A codec should decode legacy JSON payloads."""
+    assert codec.decode(b'{"ports": [1, 2]}') == {"ports": [1, 2]}
+
+
+def test_cache_decode_codec():
+    """The default decoding should read payloads from safe codecs."""
+    codec = get_codec(pytest.importorskip("orjson").__name__)
+    assert cache_decode(codec.encode([1])) == [1]
+
+
+def test_cache_decode_pickle():
+    """The default decoding should never unpickle payloads."""
+    with pytest.raises(ValueError):
+        cache_decode(get_codec("pickle").encode([1]))
+
+
+def test_get_codec_unknown():
+    """Getting an unknown codec should raise."""
+    with pytest.raises(ValueError):
+        get_codec("unknown")
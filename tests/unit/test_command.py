@@ -2,8 +2,14 @@
 
 import sys
 from operator import eq, ne
+from unittest.mock import patch
 
 import pytest
+from hamcrest import (
+    assert_that,
+    contains_exactly,
+    has_properties,
+)
 
 from pytest_xdocker.command import (
     Command,
@@ -13,6 +19,7 @@
     const_type,
     script_to_command,
 )
+from pytest_xdocker.metrics import Recorder
 
 
 @pytest.fixture
@@ -147,6 +154,15 @@ def test_command_execute():
     assert result
 
 
+def test_command_execute_timing():
+    """Executing a command should record its timing by kind."""
+    recorder = Recorder(enabled=True)
+    with patch("pytest_xdocker.command.recorder", recorder):
+        Command("whoami").execute()
+
+    assert_that(recorder.timings, contains_exactly(has_properties(kind="whoami", command="whoami", returncode=0)))
+
+
 @pytest.mark.skipif(sys.platform != "win32", reason="powershell exists on win32")
 def test_command_execute_win32():
     """Executing the echo command with `powershell` should return the line."""
@@ -293,10 +293,46 @@
             docker.run(DockerImageTag("image", "tag")).with_publish(1, 2, "ip"),
             ["docker", "run", "--publish", "ip:2:1", "image:tag"],
         ),
+        (
+            docker.run(DockerImageTag("image", "tag")).with_ip("ip"),
+            ["docker", "run", "--ip", "ip", "image:tag"],
+        ),
+        (
+            docker.run(DockerImageTag("image", "tag")).with_network("network"),
+            ["docker", "run", "--network", "network", "image:tag"],
+        ),
+        (
+            docker.run(DockerImageTag("image", "tag")).with_socket_dir("/sockets", "/run"),
+            ["docker", "run", "--volume", "/sockets:/run:rw", "image:tag"],
+        ),
+        (
+            docker.run(DockerImageTag("image", "tag")).with_user("1000:1000"),
+            ["docker", "run", "--user", "1000:1000", "image:tag"],
+        ),
         (
             docker.run(DockerImageTag("image", "tag")).with_remove(),
             ["docker", "run", "--rm", "image:tag"],
         ),
+        (
+            docker.network().connect("network", "name").with_alias("alias"),
+            ["docker", "network", "connect", "--alias", "alias", "network", "name"],
+        ),
+        (
+            docker.network().create("network").with_label("key", "value").with_subnet("subnet"),
+            ["docker", "network", "create", "--label", "key=value", "--subnet", "subnet", "network"],
+        ),
+        (
+            docker.network().disconnect("network", "name").with_force(),
+            ["docker", "network", "disconnect", "--force", "network", "name"],
+        ),
+        (
+            docker.network().ls().with_filter("label=key"),
+            ["docker", "network", "ls", "--filter", "label=key"],
+        ),
+        (
+            docker.network().remove("network1", "network2"),
+            ["docker", "network", "rm", "network1", "network2"],
+        ),
         (
             docker.run(DockerImageTag("image", "tag")).with_workdir("workdir"),
             ["docker", "run", "--workdir", "workdir", "image:tag"],
@@ -328,6 +364,25 @@ def test_docker_run_volume(args, volume):
     ]
 
 
+@pytest.mark.parametrize(
+    "command, acquired",
+    [
+        (docker.run("image"), False),
+        (docker.run("image").with_detach(), True),
+    ],
+)
+def test_docker_run_execute_semaphore(command, acquired):
+    """docker.run should only take a governor slot when detached."""
+    with (
+        patch("pytest_xdocker.docker.get_docker_semaphore") as mock_semaphore,
+        patch("pytest_xdocker.docker.run") as mock_run,
+    ):
+        command.execute()
+
+    assert mock_semaphore.called == acquired
+    mock_run.assert_called_once()
+
+
 def test_container_env():
     """A container env should parse Config/Env."""
     inspect = DockerInspect(
@@ -359,6 +414,59 @@ def test_container_exposed_ip():
     assert container.exposed_ip == ip
 
 
+@pytest.mark.parametrize(
+    "network, expected",
+    [
+        (None, "1.2.3.5"),
+        ("bridge", None),
+        ("user", "1.2.3.5"),
+        ("missing", None),
+    ],
+)
+def test_container_network_ip(network, expected):
+    """A container network IP should return the IP on a user-defined network."""
+    inspect = DockerInspect(
+        "name",
+        {
+            "NetworkSettings": {
+                "IPAddress": "",
+                "Networks": {
+                    "bridge": {"IPAddress": ""},
+                    "user": {"IPAddress": "1.2.3.5"},
+                },
+            },
+        },
+    )
+    container = DockerContainer("name", inspect)
+    assert container.network_ip(network) == expected
+
+
+def test_container_network_ips():
+    """A container network IPs should be the IPs on each network, then the exposed IP."""
+    inspect = DockerInspect(
+        "name",
+        {
+            "NetworkSettings": {
+                "IPAddress": "1.2.3.4",
+                "Networks": {
+                    "bridge": {"IPAddress": ""},
+                    "user": {"IPAddress": "1.2.3.5"},
+                    "other": {"IPAddress": "1.2.3.6"},
+                },
+            },
+        },
+    )
+    container = DockerContainer("name", inspect)
+    assert container.network_ips == ["1.2.3.5", "1.2.3.6", "1.2.3.4"]
+
+
+def test_container_network_ip_legacy():
+    """A container network IP should default to the exposed IP."""
+    inspect = DockerInspect("name", {"NetworkSettings": {"IPAddress": "1.2.3.4"}})
+    container = DockerContainer("name", inspect)
+    assert container.network_ip() == "1.2.3.4"
+
+
 def test_container_exposed_port():
     """A container exposed port should return Config or ExposedPorts."""
     inspect = DockerInspect(
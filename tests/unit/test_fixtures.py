@@ -1,8 +1,31 @@
 """Unit tests for the fixtures module."""
 
+import sys
+from subprocess import run
+
 from pytest_xdocker.process import Process
 
 
 def test_process(process):
     """The process fixture should be a Process instance."""
     assert isinstance(process, Process)
+
+
+def test_import_time():
+    """Importing the plugin should not import the heavy dependencies."""
+    result = run(
+        [sys.executable, "-X", "importtime", "-c", "import pytest_xdocker.fixtures"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    modules = {line.rsplit("|", 1)[-1].strip() for line in result.stderr.splitlines()}
+    assert not modules & {
+        "concurrent.futures",
+        "hamcrest",
+        "netifaces",
+        "psutil",
+        "pytest_cache",
+        "sqlite3",
+        "xprocess",
+    }
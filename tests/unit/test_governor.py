@@ -0,0 +1,69 @@
+"""Unit tests for the governor module."""
+
+import pytest
+from hamcrest import (
+    assert_that,
+    has_entries,
+    has_properties,
+    instance_of,
+)
+
+from pytest_xdocker.cache import STATE_DIR_ENV
+from pytest_xdocker.governor import (
+    LIMITS_ENV,
+    get_docker_semaphore,
+    get_limits,
+    parse_limits,
+)
+from pytest_xdocker.lock import FileSemaphore, NullLock
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("", {}),
+        ("run=1", {"run": 1}),
+        ("run=1, build=0", {"run": 1, "build": 0}),
+    ],
+)
+def test_parse_limits(value, expected):
+    """Limits should be parsed from comma separated pairs."""
+    assert parse_limits(value) == expected
+
+
+def test_get_limits_env(monkeypatch):
+    """Limits from the environment should override the defaults."""
+    monkeypatch.setenv(LIMITS_ENV, "run=1")
+    assert_that(get_limits(), has_entries(run=1))
+
+
+def test_get_limits_default(monkeypatch):
+    """Operations should be unlimited by default."""
+    monkeypatch.delenv(LIMITS_ENV, raising=False)
+    assert get_limits() == {}
+    assert_that(get_docker_semaphore("run"), instance_of(NullLock))
+
+
+def test_get_docker_semaphore(monkeypatch, tmp_path):
+    """A limited operation should get a semaphore in the state directory."""
+    monkeypatch.setenv(STATE_DIR_ENV, str(tmp_path))
+    monkeypatch.setenv(LIMITS_ENV, "run=3")
+    semaphore = get_docker_semaphore("run")
+    assert_that(semaphore, has_properties(limit=3))
+    with semaphore:
+        assert (tmp_path / "governor" / "run").is_dir()
+
+
+def test_get_docker_semaphore_unlimited(monkeypatch):
+    """An unlimited operation should not be limited."""
+    monkeypatch.setenv(LIMITS_ENV, "run=0")
+    assert_that(get_docker_semaphore("run"), instance_of(NullLock))
+    assert_that(get_docker_semaphore("unknown"), instance_of(NullLock))
+
+
+def test_get_docker_semaphore_instance(tmp_path, monkeypatch):
+    """Each call should get a new semaphore."""
+    monkeypatch.setenv(STATE_DIR_ENV, str(tmp_path))
+    monkeypatch.setenv(LIMITS_ENV, "pull=2")
+    assert_that(get_docker_semaphore("pull"), instance_of(FileSemaphore))
+    assert get_docker_semaphore("pull") is not get_docker_semaphore("pull")
@@ -1,19 +1,38 @@
 """Unit tests for the lock module."""
 
+import json
+from math import inf
+from time import sleep
+from unittest.mock import Mock, patch
+
 import pytest
+from hamcrest import (
+    assert_that,
+    contains_exactly,
+    greater_than_or_equal_to,
+    has_properties,
+)
 
 from pytest_xdocker.lock import (
+    LOCKS_ENV,
     AlreadyLockedError,
     FileLock,
+    FileSemaphore,
+    LeaseLock,
+    LeaseLostError,
+    LockTimeoutError,
     MemoryLock,
     NotLockedError,
     NullLock,
+    get_lock_class,
 )
+from pytest_xdocker.metrics import Recorder
 
 
 @pytest.fixture(
     params=[
         "file",
+        "lease",
         "memory",
     ]
 )
@@ -24,6 +43,11 @@ def real_lock(tmp_path, request):
         path.mkdir()
         lockfile = path / "lockfile"
         yield FileLock(lockfile)
+    elif request.param == "lease":
+        lock = LeaseLock(tmp_path / "lease")
+        yield lock
+        if lock.is_locked:
+            lock.unlock()
     elif request.param == "memory":
         yield MemoryLock()
     else:
@@ -71,3 +95,235 @@ def test_null_unlock():
     """A null lock should never raise an exception when unlocking."""
     null_lock = NullLock()
     null_lock.unlock()
+
+
+def test_file_lock_shared(tmp_path):
+    """Shared file locks should be held concurrently, but not with an exclusive lock."""
+    lockfile = tmp_path / "lockfile"
+    with FileLock(lockfile, shared=True), FileLock(lockfile, shared=True):
+        assert not FileLock(lockfile).try_lock()
+
+    assert FileLock(lockfile).try_lock()
+
+
+def test_file_lock_exclusive(tmp_path):
+    """An exclusive file lock should exclude shared locks."""
+    lockfile = tmp_path / "lockfile"
+    with FileLock(lockfile):
+        assert not FileLock(lockfile, shared=True).try_lock()
+        assert not FileLock(lockfile).try_lock()
+
+
+def test_file_lock_try_lock(tmp_path):
+    """Trying to lock a free file lock should acquire it."""
+    lock = FileLock(tmp_path / "lockfile")
+    assert lock.try_lock()
+    assert lock.is_locked
+
+
+def test_file_lock_timeout(tmp_path):
+    """Locking a held file lock should raise after the timeout."""
+    lockfile = tmp_path / "lockfile"
+    with FileLock(lockfile), pytest.raises(LockTimeoutError):
+        FileLock(lockfile, timeout=0.1).lock()
+
+
+def test_file_lock_timeout_acquired(tmp_path):
+    """Locking a free file lock with a timeout should acquire it."""
+    lock = FileLock(tmp_path / "lockfile", timeout=0.1)
+    with lock:
+        assert lock.is_locked
+
+
+def test_file_lock_metrics(tmp_path):
+    """Locking should record the wait and hold durations of the lock file."""
+    lockfile = tmp_path / "lockfile"
+    recorder = Recorder(enabled=True)
+    with patch("pytest_xdocker.lock.recorder", recorder), FileLock(lockfile), pytest.raises(LockTimeoutError):
+        FileLock(lockfile, timeout=0.1).lock()
+
+    assert_that(
+        recorder.locks,
+        contains_exactly(
+            has_properties(lockfile=str(lockfile), wait=greater_than_or_equal_to(0.1), acquired=False),
+            has_properties(lockfile=str(lockfile), hold=greater_than_or_equal_to(0.1), acquired=True),
+        ),
+    )
+
+
+def test_file_semaphore_limit(tmp_path):
+    """A file semaphore should only be acquired up to its limit."""
+    first, second = FileSemaphore(tmp_path, 2), FileSemaphore(tmp_path, 2)
+    with first, second, pytest.raises(LockTimeoutError):
+        FileSemaphore(tmp_path, 2, timeout=0.1).lock()
+
+
+def test_file_semaphore_release(tmp_path):
+    """Releasing a file semaphore should free its slot."""
+    with FileSemaphore(tmp_path, 1):
+        pass
+
+    semaphore = FileSemaphore(tmp_path, 1, timeout=0)
+    with semaphore:
+        assert semaphore.is_locked
+
+    assert not semaphore.is_locked
+
+
+def test_file_semaphore_metrics(tmp_path):
+    """Acquiring a file semaphore should record the wait for its slot."""
+    recorder = Recorder(enabled=True)
+    with patch("pytest_xdocker.lock.recorder", recorder), FileSemaphore(tmp_path, 1):
+        pass
+
+    assert_that(recorder.locks, contains_exactly(has_properties(lockfile=str(tmp_path / "slot-0.lock"), acquired=True)))
+
+
+def test_file_lock_try_lock_wait(tmp_path):
+    """Trying to lock should record the time already waited for the lock."""
+    recorder = Recorder(enabled=True)
+    with patch("pytest_xdocker.lock.recorder", recorder):
+        lock = FileLock(tmp_path / "lockfile")
+        lock.try_lock(wait=1.0)
+        lock.unlock()
+
+    assert_that(recorder.locks, contains_exactly(has_properties(wait=1.0)))
+
+
+def test_lease_lock_exclusive(tmp_path):
+    """A lease should not be acquired by another owner until released."""
+    leasefile = tmp_path / "lease"
+    with LeaseLock(leasefile), pytest.raises(LockTimeoutError):
+        LeaseLock(leasefile, timeout=0.1).lock()
+
+    with LeaseLock(leasefile, timeout=0):
+        pass
+
+
+def test_lease_lock_steal_expired(tmp_path):
+    """An expired lease should be stolen by another owner."""
+    leasefile = tmp_path / "lease"
+    leasefile.write_text(json.dumps({"owner": "crashed", "expires": 0}))
+    lock = LeaseLock(leasefile, timeout=1)
+    with lock:
+        assert json.loads(leasefile.read_text())["owner"] == lock.owner
+
+    assert not leasefile.exists()
+
+
+def test_lease_lock_heartbeat(tmp_path):
+    """A held lease should be renewed before it expires."""
+    leasefile = tmp_path / "lease"
+    with LeaseLock(leasefile, ttl=0.2, heartbeat=0.05) as lock:
+        sleep(0.4)
+        with pytest.raises(LockTimeoutError):
+            LeaseLock(leasefile, timeout=0.1).lock()
+
+        assert not lock.is_lost
+
+
+def test_lease_lock_lost(tmp_path):
+    """A lease stolen while held should be lost and raise on unlock."""
+    leasefile = tmp_path / "lease"
+    record = {"owner": "other", "expires": 0}
+    lock = LeaseLock(leasefile, heartbeat=0.05)
+    with pytest.raises(LeaseLostError), lock:
+        leasefile.write_text(json.dumps(record))
+        sleep(0.2)
+        assert lock.is_lost
+
+    # The lease of the other owner should not be overwritten.
+    assert json.loads(leasefile.read_text()) == record
+
+
+def test_lease_lock_shared(tmp_path):
+    """Shared leases should be held together, but not with an exclusive lease."""
+    leasefile = tmp_path / "lease"
+    with LeaseLock(leasefile, shared=True), LeaseLock(leasefile, shared=True, timeout=0):
+        assert not LeaseLock(leasefile).try_lock()
+        with pytest.raises(LockTimeoutError):
+            LeaseLock(leasefile, timeout=0.1).lock()
+
+        assert not leasefile.exists()
+
+    lock = LeaseLock(leasefile)
+    assert lock.try_lock()
+    assert not LeaseLock(leasefile, shared=True).try_lock()
+    lock.unlock()
+
+
+def test_lease_lock_shared_expired(tmp_path):
+    """An expired shared lease should not block an exclusive lease."""
+    leasefile = tmp_path / "lease"
+    (tmp_path / "lease.crashed.shared").write_text(json.dumps({"owner": "crashed", "expires": 0}))
+    with LeaseLock(leasefile, timeout=1):
+        assert not (tmp_path / "lease.crashed.shared").exists()
+
+
+def test_lease_lock_steal_renewed(tmp_path):
+    """A lease renewed before being stolen should be kept."""
+    leasefile = tmp_path / "lease"
+    clock = Mock(return_value=1000)
+    holder = LeaseLock(leasefile, ttl=10, clock=clock)
+    assert holder.try_lock()
+    stealer = LeaseLock(leasefile, ttl=10, clock=clock)
+    record = stealer._read(leasefile)
+    clock.return_value += 20
+    # The holder renews after the stealer read the expired lease.
+    leasefile.write_text(json.dumps({**record, "expires": clock() + 10}))
+    assert not stealer.try_lock()
+    holder.unlock()
+
+
+def test_lease_lock_guard_expired(tmp_path):
+    """An expired guard should be broken by another owner."""
+    leasefile = tmp_path / "lease"
+    leasefile.write_text(json.dumps({"owner": "crashed", "expires": 0}))
+    guard = tmp_path / "lease.guard"
+    guard.write_text(json.dumps({"owner": "crashed", "expires": 0, "token": "stale"}))
+    with LeaseLock(leasefile, timeout=1):
+        assert not guard.exists()
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_lease_lock_guard_replaced(tmp_path):
+    """A guard replaced after expiring should not be broken."""
+    leasefile = tmp_path / "lease"
+    guard = tmp_path / "lease.guard"
+    record = {"owner": "other", "expires": inf, "token": "fresh"}
+    guard.write_text(json.dumps(record))
+    LeaseLock(leasefile)._break_guard(guard, {"owner": "crashed", "expires": 0, "token": "stale"})
+    assert json.loads(guard.read_text()) == record
+    assert list(tmp_path.iterdir()) == [guard]
+
+
+def test_file_semaphore_lease(tmp_path):
+    """A file semaphore should also limit lease locks."""
+    with FileSemaphore(tmp_path, 1, lock_class=LeaseLock), pytest.raises(LockTimeoutError):
+        FileSemaphore(tmp_path, 1, timeout=0.1, lock_class=LeaseLock).lock()
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, FileLock),
+        ("file", FileLock),
+        ("lease", LeaseLock),
+    ],
+)
+def test_get_lock_class(monkeypatch, value, expected):
+    """The lock class should be selected from the environment."""
+    if value is not None:
+        monkeypatch.setenv(LOCKS_ENV, value)
+    else:
+        monkeypatch.delenv(LOCKS_ENV, raising=False)
+
+    assert get_lock_class() is expected
+
+
+def test_get_lock_class_invalid(monkeypatch):
+    """An unknown lock class should raise."""
+    monkeypatch.setenv(LOCKS_ENV, "unknown")
+    with pytest.raises(ValueError, match=LOCKS_ENV):
+        get_lock_class()
@@ -0,0 +1,146 @@
+"""Unit tests for the metrics module."""
+
+from subprocess import CalledProcessError
+
+import pytest
+from hamcrest import (
+    assert_that,
+    contains_exactly,
+    has_properties,
+)
+
+from pytest_xdocker.metrics import LockStats, Recorder, RetryStats, Timing
+
+
+def test_recorder_disabled():
+    """A disabled recorder should not record timings."""
+    recorder = Recorder()
+    with recorder.timing("run", "docker run"):
+        pass
+
+    assert recorder.timings == []
+
+
+def test_recorder_timing_returncode():
+    """A timing without error should have a zero returncode."""
+    recorder = Recorder(enabled=True)
+    with recorder.timing("run", "docker run"):
+        pass
+
+    assert_that(recorder.timings, contains_exactly(has_properties(kind="run", command="docker run", returncode=0)))
+
+
+def test_recorder_timing_called_process_error():
+    """A timing raising CalledProcessError should have its returncode."""
+    recorder = Recorder(enabled=True)
+    with pytest.raises(CalledProcessError), recorder.timing("pull", "docker pull"):
+        raise CalledProcessError(2, "docker pull")
+
+    assert_that(recorder.timings, contains_exactly(has_properties(returncode=2)))
+
+
+def test_recorder_timing_error():
+    """A timing raising any other error should have no returncode."""
+    recorder = Recorder(enabled=True)
+    with pytest.raises(ValueError), recorder.timing("poll", "probe"):
+        raise ValueError
+
+    assert_that(recorder.timings, contains_exactly(has_properties(returncode=None)))
+
+
+def test_recorder_context():
+    """Timings should be tagged with the test and fixture of the context."""
+    recorder = Recorder(enabled=True)
+    with recorder.context(test="test"), recorder.context(fixture="fixture"), recorder.timing("run", "docker run"):
+        pass
+
+    assert_that(recorder, has_properties(test=None, fixture=None))
+    assert_that(recorder.timings, contains_exactly(has_properties(test="test", fixture="fixture")))
+
+
+def test_recorder_slowest():
+    """The slowest timings should be sorted by decreasing duration."""
+    fast, slow = Timing("inspect", "fast", duration=1.0), Timing("run", "slow", duration=2.0)
+    recorder = Recorder(timings=[fast, slow])
+    assert recorder.slowest() == [slow, fast]
+    assert recorder.slowest(1) == [slow]
+
+
+def test_recorder_totals():
+    """Totals should sum durations by key, ignoring missing keys."""
+    recorder = Recorder(
+        timings=[
+            Timing("run", "a", test="a", duration=1.0),
+            Timing("run", "b", test="b", duration=1.0),
+            Timing("run", "b", test="b", duration=2.0),
+            Timing("run", "c", duration=5.0),
+        ]
+    )
+    assert recorder.totals("test") == {"b": 3.0, "a": 1.0}
+
+
+def test_recorder_summary():
+    """The summary should include the total and each slowest operation."""
+    recorder = Recorder(timings=[Timing("run", "docker run\nalpine", "test", "fixture", 1.5, 0)])
+    assert list(recorder.summary()) == [
+        "1.50s in 1 docker operations",
+        "1.50s run      rc=0   test [fixture] docker run",
+        "1.50s test test",
+        "1.50s fixture fixture",
+    ]
+
+
+def test_recorder_retrying():
+    """Retry statistics should be tagged with the test."""
+    recorder = Recorder(enabled=True)
+    with recorder.context(test="test"), recorder.retrying("probe") as stats:
+        stats.attempts += 1
+
+    assert_that(recorder.retries, contains_exactly(has_properties(probe="probe", test="test", attempts=1)))
+
+
+def test_recorder_retrying_disabled():
+    """A disabled recorder should not record retry statistics."""
+    recorder = Recorder()
+    with recorder.retrying("probe"):
+        pass
+
+    assert recorder.retries == []
+
+
+def test_recorder_retry_summary():
+    """The retry summary should aggregate statistics by test."""
+    recorder = Recorder(
+        retries=[
+            RetryStats("a", "test", attempts=3, sleep=2.0, success=True),
+            RetryStats("b", "test", attempts=30, sleep=29.0, success=False),
+            RetryStats("c", "other", attempts=1, sleep=0.0, success=True),
+        ]
+    )
+    assert list(recorder.retry_summary()) == [
+        "31.00s sleeping in 33 attempts of 2 polls (1 failed) test",
+        "0.00s sleeping in 1 attempts of 1 polls (0 failed) other",
+    ]
+
+
+def test_recorder_update():
+    """Raw metrics should be loaded back into another recorder."""
+    recorder = Recorder(
+        timings=[Timing("run", "docker run", duration=1.0)],
+        retries=[RetryStats("probe", attempts=1)],
+        locks=[LockStats("lockfile", wait=1.0)],
+    )
+    other = Recorder()
+    other.update(recorder.to_dict())
+    assert other == recorder
+
+
+def test_recorder_lock_summary():
+    """The lock summary should start with the lock waited for the most."""
+    recorder = Recorder(enabled=True)
+    recorder.record_lock("a.lock", 1.0, 2.0)
+    recorder.record_lock("b.lock", 3.0, acquired=False)
+    assert list(recorder.lock_summary()) == [
+        "3.00s waiting (max 3.00s) and 0.00s holding in 1 locks (1 timed out) b.lock",
+        "1.00s waiting (max 1.00s) and 2.00s holding in 1 locks (0 timed out) a.lock",
+    ]
@@ -1,8 +1,414 @@
 """Unit tests for the network module."""
 
-from pytest_xdocker.network import get_open_port
+import ipaddress
+import socket
+from subprocess import CalledProcessError, TimeoutExpired
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+import netifaces
+import pytest
+
+from pytest_xdocker.cache import STATE_DIR_ENV
+from pytest_xdocker.network import (
+    DEFAULT_SUBNET,
+    OWNER_LABEL,
+    SUBNET_ENV,
+    IpAllocationError,
+    IpAllocator,
+    NetworkPool,
+    NetworkPoolError,
+    PortAllocationError,
+    PortAllocator,
+    find_host_ip,
+    find_local_subnets,
+    format_ports,
+    get_bridge_gateway,
+    get_host_ip,
+    get_open_port,
+    get_process_owner,
+    get_process_owners,
+    is_port_free,
+    is_routable_ip,
+    parse_ports,
+    unique_ip,
+)
 
 
 def test_get_open_port_returns_different_ports():
     """Calling get_open_port twice should return different ports."""
     assert get_open_port() != get_open_port()
+
+
+@pytest.fixture
+def interfaces(monkeypatch):
+    """Fake the interfaces of this host, without docker."""
+    addresses = {
+        "lo": "127.0.0.1",
+        "eth0": "192.168.1.2",
+        "docker0": "172.17.0.1",
+    }
+    monkeypatch.setattr(netifaces, "interfaces", Mock(side_effect=lambda: list(addresses)))
+    monkeypatch.setattr(
+        netifaces,
+        "ifaddresses",
+        Mock(side_effect=lambda i: {socket.AF_INET: [{"addr": addresses[i], "netmask": "255.255.0.0"}]}),
+    )
+    monkeypatch.setattr("pytest_xdocker.network.get_bridge_gateway", Mock(return_value=None))
+    find_host_ip.cache_clear()
+    find_local_subnets.cache_clear()
+    yield addresses
+    find_host_ip.cache_clear()
+    find_local_subnets.cache_clear()
+
+
+def test_get_host_ip_docker0(interfaces):
+    """The docker0 interface should be preferred."""
+    assert get_host_ip() == "172.17.0.1"
+
+
+def test_get_host_ip_bridge_gateway(interfaces):
+    """The gateway of the bridge network should be preferred when local."""
+    with patch("pytest_xdocker.network.get_bridge_gateway", Mock(return_value="192.168.1.2")):
+        assert get_host_ip() == "192.168.1.2"
+
+
+def test_get_bridge_gateway():
+    """The gateway should be read from the bridge network with a timeout."""
+    output = '[{"IPAM": {"Config": [{"Gateway": "172.17.0.1"}]}}]'
+    with patch("pytest_xdocker.command.Command.execute", Mock(return_value=output)) as execute:
+        assert get_bridge_gateway() == "172.17.0.1"
+
+    assert execute.call_args.kwargs["timeout"] == 5
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        CalledProcessError(1, "docker"),
+        FileNotFoundError("docker"),
+        TimeoutExpired("docker", 5),
+    ],
+)
+def test_get_bridge_gateway_error(error):
+    """The gateway should be None when docker fails, is missing or hangs."""
+    with patch("pytest_xdocker.command.Command.execute", Mock(side_effect=error)):
+        assert get_bridge_gateway() is None
+
+
+def test_get_host_ip_memoized(interfaces):
+    """The IP should only be looked up again when the interfaces change."""
+    get_host_ip()
+    get_host_ip()
+    assert netifaces.ifaddresses.call_count == len(interfaces)
+    del interfaces["docker0"]
+    assert get_host_ip() == "192.168.1.2"
+
+
+@pytest.mark.parametrize(
+    "ip, expected",
+    [
+        ("172.17.0.2", True),
+        ("192.168.3.4", True),
+        ("127.0.0.2", False),
+        ("10.0.0.1", False),
+    ],
+)
+def test_is_routable_ip(interfaces, ip, expected):
+    """An IP should be routable when in the subnet of an interface, except loopback."""
+    assert is_routable_ip(ip) is expected
+
+
+def test_is_port_free():
+    """A port should not be free while listening."""
+    with socket.socket() as s:
+        s.bind(("", 0))
+        s.listen()
+        port = s.getsockname()[1]
+        assert not is_port_free(port)
+
+    assert is_port_free(port)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("1-2", (1, 2)),
+        ("1", (1, 1)),
+        (1, (1, 1)),
+        ("1-2/tcp", (1, 2)),
+    ],
+)
+def test_parse_ports(value, expected):
+    """A range of ports should be parsed inclusively."""
+    assert parse_ports(value) == expected
+
+
+@pytest.mark.parametrize(
+    "start, count, expected",
+    [
+        (1, 1, 1),
+        (1, 3, "1-3"),
+    ],
+)
+def test_format_ports(start, count, expected):
+    """A block of ports should be formatted as a range."""
+    assert format_ports(start, count) == expected
+
+
+@pytest.fixture
+def clock():
+    """Clock that can be moved forward."""
+    return Mock(return_value=1000)
+
+
+@pytest.fixture
+def allocator(tmp_path, clock):
+    """Port allocator with a small range where all ports are free."""
+    return PortAllocator(
+        tmp_path / "ports.json",
+        start=20000,
+        end=20003,
+        get_owners=Mock(return_value=set()),
+        is_free=Mock(return_value=True),
+        clock=clock,
+        randrange=Mock(return_value=0),
+    )
+
+
+def test_port_allocator_allocate(allocator):
+    """Allocating should return different ports until none is free."""
+    assert allocator.allocate("a") == 20000
+    assert allocator.allocate("b", 3) == 20001
+    with pytest.raises(PortAllocationError):
+        allocator.allocate("c")
+
+
+def test_port_allocator_not_free(allocator):
+    """Allocating should skip ports which are not free on the host."""
+    allocator.is_free.side_effect = lambda port: port != 20000
+    assert allocator.allocate("a") == 20001
+
+
+def test_port_allocator_reserve(allocator):
+    """Reserving should only succeed for the same owner."""
+    port = allocator.allocate("a")
+    assert allocator.reserve("a", port)
+    assert not allocator.reserve("b", port)
+
+
+def test_port_allocator_release(allocator):
+    """Releasing should free the port."""
+    port = allocator.allocate("a")
+    allocator.release(port)
+    assert allocator.reserve("b", port)
+
+
+def test_port_allocator_reclaim(allocator, clock):
+    """Ports of owners gone after the grace period should be reclaimed."""
+    allocator.allocate("a")
+    allocator.allocate("b", 3)
+    allocator.get_owners.return_value = {"b"}
+    clock.return_value += allocator.grace + 1
+    assert allocator.allocate("c") == 20000
+
+
+def test_port_allocator_reclaim_unknown(allocator, clock):
+    """Ports should be kept when the owners are unknown."""
+    allocator.allocate("a")
+    allocator.allocate("b", 3)
+    allocator.get_owners.side_effect = CalledProcessError(1, "docker")
+    clock.return_value += allocator.grace + 1
+    with pytest.raises(PortAllocationError):
+        allocator.allocate("c")
+
+
+def test_port_allocator_block_contiguous(allocator):
+    """Allocating a block should skip blocks with a port which is not free."""
+    allocator.is_free.side_effect = lambda port: port != 20001
+    assert allocator.allocate("a", 2) == 20002
+
+
+def test_port_allocator_reserve_block(allocator):
+    """Reserving a block should fail when any port is reserved by another owner."""
+    allocator.allocate("a")
+    assert not allocator.reserve("b", 20000, 2)
+    assert allocator.reserve("b", 20001, 2)
+
+
+@pytest.fixture
+def ip_allocator(tmp_path, clock):
+    """IP allocator with a small subnet."""
+    return IpAllocator(
+        tmp_path / "ips.json",
+        "10.0.0.0/29",
+        get_owners=Mock(return_value=set()),
+        clock=clock,
+        randrange=Mock(return_value=0),
+    )
+
+
+def test_ip_allocator_allocate(ip_allocator):
+    """Allocating should skip the gateway and return different IPs until none is free."""
+    ips = [ip_allocator.allocate("a") for _ in range(5)]
+    assert ips == ["10.0.0.2", "10.0.0.3", "10.0.0.4", "10.0.0.5", "10.0.0.6"]
+    with pytest.raises(IpAllocationError):
+        ip_allocator.allocate("a")
+
+
+def test_ip_allocator_reserve(ip_allocator):
+    """Reserving should only succeed for the same owner."""
+    ip = ip_allocator.allocate("a")
+    assert ip_allocator.reserve("a", ip)
+    assert not ip_allocator.reserve("b", ip)
+    ip_allocator.release(ip)
+    assert ip_allocator.reserve("b", ip)
+
+
+def test_ip_allocator_reclaim(ip_allocator, clock):
+    """IPs of owners gone after the grace period should be reclaimed."""
+    ip = ip_allocator.allocate("a")
+    ip_allocator.allocate("b")
+    ip_allocator.get_owners.return_value = {"b"}
+    clock.return_value += ip_allocator.grace + 1
+    assert ip_allocator.allocate("c") == ip
+
+
+def test_get_process_owners():
+    """The current process should be an owner."""
+    assert get_process_owner() in get_process_owners()
+
+
+def test_unique_ip(tmp_path, monkeypatch):
+    """Unique IPs should be different and in the subnet."""
+    monkeypatch.setenv(STATE_DIR_ENV, str(tmp_path))
+    monkeypatch.setenv(SUBNET_ENV, "10.0.0.0/24")
+    ips = {unique_ip(None) for _ in range(10)}
+    assert len(ips) == 10
+    assert all(ip.startswith("10.0.0.") for ip in ips)
+
+
+@pytest.fixture
+def docker():
+    """Fake docker network commands, keeping the networks with their owner and subnet."""
+    docker = SimpleNamespace(networks={}, subnets={}, commands=[], overlaps=set())
+
+    def execute(command, **kwargs):
+        args = list(command)
+        docker.commands.append(args)
+        if args[2] == "ls":
+            return "".join(f"{network} {owner}\n" for network, owner in docker.networks.items())
+        elif args[2] == "create" and args[-1] in docker.overlaps:
+            raise CalledProcessError(1, args)
+        elif args[2] == "create":
+            labels = dict(args[i + 1].split("=", 1) for i, arg in enumerate(args) if arg == "--label")
+            docker.networks[args[-1]] = labels[OWNER_LABEL]
+            docker.subnets[args[-1]] = args[args.index("--subnet") + 1]
+        elif args[2] == "rm":
+            del docker.networks[args[-1]]
+        return ""
+
+    with (
+        patch("pytest_xdocker.command.Command.execute", execute),
+        patch("pytest_xdocker.network.DockerNetworkInspect") as inspect,
+    ):
+        inspect.return_value.get.return_value = {}
+        yield docker
+
+
+@pytest.fixture
+def pool(tmp_path, clock):
+    """Network pool of two networks where only the current process is alive."""
+    return NetworkPool(
+        tmp_path / "pool.json",
+        "pool",
+        size=2,
+        subnet="10.0.0.0/16",
+        timeout=0,
+        owner="me",
+        get_owners=Mock(return_value={"me", "host:1", "host:2"}),
+        clock=clock,
+    )
+
+
+def test_network_pool_acquire(pool, docker):
+    """Acquiring should fill the pool, then lease networks until none is free."""
+    assert pool.acquire("host:1") == "pool-0"
+    assert docker.networks == {"pool-0": "me", "pool-1": "me"}
+    docker.commands.clear()
+    assert pool.acquire("host:2") == "pool-1"
+    with pytest.raises(NetworkPoolError):
+        pool.acquire("host:3")
+
+    assert docker.commands == []
+
+
+def test_network_pool_acquire_owner(pool, docker):
+    """Acquiring for an owner which is not a process should raise."""
+    with pytest.raises(ValueError, match="host:pid"):
+        pool.acquire("container")
+
+
+def test_network_pool_overlaps(pool, docker):
+    """Networks which can't be created should be left out of the pool."""
+    docker.overlaps.add("pool-0")
+    assert pool.acquire("host:1") == "pool-1"
+    with pytest.raises(NetworkPoolError):
+        pool.acquire("host:2")
+
+
+def test_network_pool_overlaps_all(pool, docker):
+    """A pool without any network should raise when filled."""
+    docker.overlaps.update(pool.networks)
+    with pytest.raises(NetworkPoolError, match="could be created"):
+        pool.fill()
+
+
+def test_default_subnet():
+    """The default subnet should not overlap the default address pools of docker."""
+    subnet = ipaddress.ip_network(DEFAULT_SUBNET)
+    assert not subnet.overlaps(ipaddress.ip_network("172.16.0.0/12"))
+    assert not subnet.overlaps(ipaddress.ip_network("192.168.0.0/16"))
+
+
+def test_network_pool_subnets(pool, docker):
+    """Each network should be created in its own block of the subnet."""
+    pool.fill()
+    assert docker.subnets == {"pool-0": "10.0.0.0/24", "pool-1": "10.0.1.0/24"}
+    assert pool.get_subnet("pool-1") == "10.0.1.0/24"
+
+
+def test_network_pool_subnets_exhausted(pool):
+    """Getting a subnet beyond the subnet of the pool should raise."""
+    pool.subnet = ipaddress.ip_network("10.0.0.0/24")
+    pool.prefixlen = 25
+    pool.size = 3
+    assert pool.get_subnet("pool-1") == "10.0.0.128/25"
+    with pytest.raises(NetworkPoolError):
+        pool.get_subnet("pool-2")
+
+
+def test_network_pool_release(pool, docker):
+    """Releasing should disconnect the containers left on the network."""
+    network = pool.acquire("host:1")
+    with patch("pytest_xdocker.network.NetworkPool.disconnect") as disconnect:
+        pool.release(network)
+
+    disconnect.assert_called_once_with(network)
+    assert pool.acquire("host:2") == network
+
+
+def test_network_pool_reuse(pool, docker):
+    """Networks of other processes which are alive should be reused."""
+    docker.networks["pool-0"] = "other"
+    pool.get_owners.return_value.add("other")
+    assert pool.acquire("host:1") == "pool-0"
+    assert docker.networks["pool-0"] == "other"
+
+
+def test_network_pool_collect(pool, docker):
+    """Networks created by a process which is gone should be removed."""
+    docker.networks["pool-0"] = "gone"
+    docker.networks["pool-5"] = "gone"
+    pool.fill()
+    assert docker.networks == {"pool-0": "me", "pool-1": "me"}
@@ -2,21 +2,53 @@
 
 import logging
 import platform
+import sys
 from typing import ClassVar
+from unittest.mock import Mock, patch
 
+import py
 import pytest
 from hamcrest import (
     assert_that,
+    contains_exactly,
     contains_string,
+    greater_than,
     has_item,
     has_properties,
 )
 from xprocess import ProcessStarter
 
+from pytest_xdocker.cache import MemoryCache
+from pytest_xdocker.lock import FileLock, LeaseLock
+from pytest_xdocker.network import PortAllocator
 from pytest_xdocker.process import (
+    PUBLISH_KEY,
     Process,
     ProcessConfig,
+    ProcessData,
+    ProcessServer,
+    StartupHistory,
+    percentile,
 )
+from pytest_xdocker.retry import ProbeResult
+
+
+class SleepServer(ProcessServer):
+    """Server sleeping after printing it's ready."""
+
+    def __init__(self, probes, **kwargs):
+        """Init."""
+        super().__init__(**kwargs)
+        self.probes = probes
+
+    def prepare_func(self, controldir):
+        """Sleep for a while."""
+        args = [sys.executable, "-c", "import time; print('Ready!', flush=True); time.sleep(30)"]
+        return ProcessData("Ready!", args)
+
+    def get_probes(self, name):
+        """Return the probes given on init."""
+        return self.probes
 
 
 def test_process_startup_failure(tmp_path, unique):
@@ -67,3 +99,239 @@ def prepare_func(*args, **kwargs):
     process = Process(config=config)
     with pytest.raises(Expected):
         process.ensure(unique("text"), prepare_func)
+
+
+def test_process_config_cache_bounds(tmp_path):
+    """The default cache should bound the published ports."""
+    config = ProcessConfig(tmp_path)
+    assert_that(
+        config.cache.back,
+        has_properties(ttl=ProcessServer.publish_ttl, max_size=ProcessServer.publish_max_size),
+    )
+
+
+def test_process_server_probes(tmp_path, unique):
+    """Running a server should poll its probes once started."""
+    probe = Mock(return_value=ProbeResult(True))
+    process = Process(config=ProcessConfig(tmp_path))
+    server = SleepServer([probe], process=process)
+    with server.run(unique("text")):
+        probe.assert_called_once_with()
+
+
+def test_process_server_run_shared(tmp_path, unique):
+    """Running an already running server should not wait for other users."""
+    name = unique("text")
+    process = Process(config=ProcessConfig(tmp_path))
+    server = SleepServer([], process=process)
+    with server.run(name) as started, server.run(name) as again:
+        assert again == started
+        lockfile = process.getinfo(name).controldir.join("xprocess.lock")
+        assert not FileLock(lockfile).try_lock()
+
+
+def test_process_server_run_lease(tmp_path, unique):
+    """Running a server with lease locks should share the server between users."""
+    name = unique("text")
+    process = Process(config=ProcessConfig(tmp_path))
+    server = SleepServer([], process=process, lock_class=LeaseLock)
+    with server.run(name) as started, server.run(name) as again:
+        assert again == started
+
+    controldir = process.getinfo(name).controldir
+    assert not controldir.join("xprocess.lock").exists()
+    assert not controldir.listdir("*.shared")
+
+
+def test_process_server_run_in_use(tmp_path, unique):
+    """Finishing to run a server should not terminate it while in use."""
+    name = unique("text")
+    process = Process(config=ProcessConfig(tmp_path))
+    server = SleepServer([], process=process)
+    with server.run(name):
+        with server.run(name):
+            pass
+
+        assert process.getinfo(name).isrunning()
+
+
+def test_process_server_run_start_shared(tmp_path, unique):
+    """Starting a server should keep the shared lock so that it isn't terminated."""
+    name = unique("text")
+    process = Process(config=ProcessConfig(tmp_path))
+    server = SleepServer([], process=process)
+    lockfile = process.getinfo(name).controldir.join("xprocess.lock")
+    ensure = process.ensure
+
+    def ensure_shared(*args):
+        assert not FileLock(lockfile).try_lock()
+        return ensure(*args)
+
+    with patch.object(process, "ensure", ensure_shared), server.run(name):
+        pass
+
+
+def test_process_server_run_restart(tmp_path, unique):
+    """Restarting a server should share it again once restarted."""
+    name = unique("text")
+    process = Process(config=ProcessConfig(tmp_path))
+    server = SleepServer([], process=process)
+    controldir = process.getinfo(name).controldir
+    with server.run(name):
+        pass
+
+    with server.run(name, restart=True):
+        assert not FileLock(controldir.join("xprocess.lock")).try_lock()
+        for lockfile in ("xprocess.start.lock", "xprocess.restart.lock"):
+            lock = FileLock(controldir.join(lockfile))
+            assert lock.try_lock()
+            lock.unlock()
+
+    assert not process.getinfo(name).isrunning()
+
+
+def test_process_server_run_starting(tmp_path, unique):
+    """Finishing to run a server should not terminate it while another process starts it."""
+    name = unique("text")
+    process = Process(config=ProcessConfig(tmp_path))
+    server = SleepServer([], process=process)
+    start_lock = FileLock(process.getinfo(name).controldir.join("xprocess.start.lock"))
+    with server.run(name):
+        start_lock.lock()
+
+    start_lock.unlock()
+    assert process.getinfo(name).isrunning()
+    process.getinfo(name).terminate()
+
+
+def test_process_server_get_address(tmp_path):
+    """Getting the address of a server should connect directly when asked."""
+    server = SleepServer([], process=Process(config=ProcessConfig(tmp_path)), direct=True)
+    with patch("pytest_xdocker.process.get_container_address", Mock(return_value=("ip", 80))) as get_address:
+        assert server.get_address("name", 80, "net") == ("ip", 80)
+
+    assert get_address.call_args.args[1:] == (80, True, "net")
+
+
+def test_process_server_get_socket_path(tmp_path):
+    """Getting the path of a socket should create the shared socket directory."""
+    process = Process(config=ProcessConfig(tmp_path))
+    server = SleepServer([], process=process)
+    path = server.get_socket_path("name", "server.sock")
+    assert path.parent == server.get_socket_dir(process.getinfo("name").controldir)
+    assert path.parent.stat().st_mode & 0o777 == 0o770
+
+
+def test_process_server_get_socket_path_too_long(tmp_path):
+    """Getting the path of a socket should raise when too long for a unix socket."""
+    server = SleepServer([], process=Process(config=ProcessConfig(tmp_path)))
+    with pytest.raises(ValueError, match="longer than 107 bytes"):
+        server.get_socket_path("name", "s" * 107)
+
+
+def test_process_server_get_cache_publish(tmp_path):
+    """Published ports should be allocated and cached under the publish key."""
+    cache = MemoryCache()
+    allocator = PortAllocator(tmp_path / "ports.json")
+    server = SleepServer([], process=Process(config=ProcessConfig(tmp_path, cache=cache)), port_allocator=allocator)
+    controldir = py.path.local(tmp_path / "server")
+    _, host_port, _ = server.get_cache_publish(controldir, 80)
+    assert cache.get(f"{PUBLISH_KEY}/server/80", None) == host_port
+    assert server.get_cache_publish(controldir, 80)[1] == host_port
+    assert not allocator.reserve("other", host_port)
+
+
+def test_process_server_get_cache_publish_reserved(tmp_path):
+    """A cached port reserved by another owner should be replaced."""
+    cache = MemoryCache()
+    allocator = PortAllocator(tmp_path / "ports.json")
+    server = SleepServer([], process=Process(config=ProcessConfig(tmp_path, cache=cache)), port_allocator=allocator)
+    port = allocator.allocate("other")
+    cache.set(f"{PUBLISH_KEY}/server/80", port)
+    _, host_port, _ = server.get_cache_publish(py.path.local(tmp_path / "server"), 80)
+    assert host_port != port
+    assert cache.get(f"{PUBLISH_KEY}/server/80", None) == host_port
+
+
+def test_process_server_get_cache_publish_block(tmp_path):
+    """A block of container ports should be published to a block of host ports."""
+    cache = MemoryCache()
+    allocator = PortAllocator(tmp_path / "ports.json")
+    server = SleepServer([], process=Process(config=ProcessConfig(tmp_path, cache=cache)), port_allocator=allocator)
+    _, host_ports, _ = server.get_cache_publish(py.path.local(tmp_path / "server"), "80-82")
+    start = cache.get(f"{PUBLISH_KEY}/server/80-82", None)
+    assert host_ports == f"{start}-{start + 2}"
+    assert not allocator.reserve("other", start + 2)
+
+
+@pytest.mark.parametrize(
+    "values, q, expected",
+    [
+        ([1], 50, 1),
+        ([3, 1, 2], 0, 1),
+        ([3, 1, 2], 50, 2),
+        ([3, 1, 2], 100, 3),
+    ],
+)
+def test_percentile(values, q, expected):
+    """The percentile should be the nearest rank."""
+    assert percentile(values, q) == expected
+
+
+def test_startup_history_size():
+    """The history should only keep the latest startups."""
+    history = StartupHistory(MemoryCache(), size=2)
+    for duration in [1, 2, 3]:
+        history.add("test", duration)
+
+    assert history.get("test") == [2, 3]
+
+
+def test_startup_history_without_history():
+    """Without history, the starter should be unchanged."""
+    history = StartupHistory(MemoryCache())
+    starter = Mock(timeout=120)
+    wait = starter.wait
+    history.adapt("test", starter)
+    assert_that(starter, has_properties(timeout=120, wait=wait))
+
+
+@pytest.mark.parametrize(
+    "durations, timeout",
+    [
+        ([1, 2, 3], 120),
+        ([100, 200, 300], 600),
+        ([80, 80, 80], 160),
+    ],
+)
+def test_startup_history_timeout(durations, timeout):
+    """The timeout should be extended for slow processes up to the ceiling."""
+    history = StartupHistory(MemoryCache())
+    for duration in durations:
+        history.add("test", duration)
+
+    assert history.get_timeout("test", 120) == timeout
+
+
+def test_startup_history_delay():
+    """The wait should be delayed by half the usual fastest startup."""
+    sleeper = Mock()
+    history = StartupHistory(MemoryCache(), sleeper=sleeper)
+    history.add("test", 4)
+    starter = Mock(timeout=120)
+    wait = starter.wait
+    history.adapt("test", starter).wait("log_file")
+    sleeper.assert_called_once_with(2)
+    wait.assert_called_once_with("log_file")
+
+
+def test_process_ensure_history(tmp_path, unique):
+    """Starting a process should record its startup time."""
+    name = unique("text")
+    cache = MemoryCache()
+    process = Process(config=ProcessConfig(tmp_path, cache=cache))
+    server = SleepServer([], process=process)
+    with server.run(name):
+        pass
+
+    assert_that(process.history.get(name), contains_exactly(greater_than(0)))
@@ -1,27 +1,69 @@
 """Unit tests for the retry module."""
 
+import socket
+import sys
 from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from itertools import count
-from unittest.mock import Mock
+from threading import Barrier, Thread
+from unittest.mock import Mock, patch
 
 import pytest
 from hamcrest import (
     assert_that,
+    contains_exactly,
     has_properties,
     is_,
     raises,
 )
 
+from pytest_xdocker.command import Command
+from pytest_xdocker.metrics import Recorder
+from pytest_xdocker.network import get_open_port
 from pytest_xdocker.retry import (
+    BackoffPoller,
     CatchingProbe,
+    CommandProbe,
+    HttpProbe,
+    LogProbe,
+    MultiPoller,
     Poller,
+    PollingError,
     ProbeResult,
+    TcpProbe,
+    UnixSocketProbe,
     UntilProbe,
     calling,
     retry,
 )
 
 
+class StatusHandler(BaseHTTPRequestHandler):
+    """Respond with the status in the path, eg /404."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Send the status without body."""
+        self.send_response(int(self.path.strip("/")))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        """Quiet."""
+
+
+@pytest.fixture
+def http_server():
+    """Run an HTTP server in a thread."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    thread = Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 class Sample:
     """Dummy class to test prettifying."""
 
@@ -104,6 +146,91 @@ def test_poller_check_sleep():
     assert mock_func.call_count == mock_sleeper.call_count + 1
 
 
+def test_poller_check_timing():
+    """Polling should record its timing as a poll."""
+    recorder = Recorder(enabled=True)
+    with patch("pytest_xdocker.retry.recorder", recorder):
+        Poller(1, 0).check(UntilProbe(Mock(return_value=0), 0))
+
+    assert_that(recorder.timings, contains_exactly(has_properties(kind="poll", returncode=0)))
+
+
+def test_poller_check_retry_stats():
+    """Polling should record the attempts and sleep of the probe."""
+    recorder = Recorder(enabled=True)
+    probe = UntilProbe(Mock(side_effect=partial(next, count())), 2)
+    with patch("pytest_xdocker.retry.recorder", recorder):
+        Poller(10, 0.5, Mock()).check(probe)
+
+    assert_that(recorder.retries, contains_exactly(has_properties(attempts=3, sleep=1.0, success=True)))
+
+
+def test_backoff_poller_check_retry_stats():
+    """Polling with backoff should record a failure at the deadline."""
+    recorder = Recorder(enabled=True)
+    clock = Mock(side_effect=[0, 0.5, 1.5])
+    poller = BackoffPoller(1, delay=0.5, jitter=0, sleeper=Mock(), clock=clock)
+    with patch("pytest_xdocker.retry.recorder", recorder), pytest.raises(AssertionError):
+        poller.check(UntilProbe(Mock(return_value=0), 1))
+
+    assert_that(recorder.retries, contains_exactly(has_properties(attempts=2, sleep=0.5, success=False)))
+
+
+def test_retry_within_returns():
+    """Retrying within a deadline should stop when matching the value."""
+    assert retry(next, count()).within(1, delay=0).until(1) == 1
+
+
+def test_retry_within_raises():
+    """Retrying within a deadline should raise when not matching the value."""
+    with pytest.raises(AssertionError):
+        retry(next, count()).within(0).until(-1)
+
+
+def test_backoff_poller_delays():
+    """Delays should back off exponentially up to the maximum."""
+    poller = BackoffPoller(10, delay=0.1, max_delay=1, factor=3)
+    delays = poller.delays()
+    assert [next(delays) for _ in range(4)] == pytest.approx([0.1, 0.3, 0.9, 1])
+
+
+def test_backoff_poller_check_sleep():
+    """Polling should sleep with backoff between each probe."""
+    mock_sleeper = Mock()
+    probe = UntilProbe(Mock(side_effect=partial(next, count())), 3)
+    poller = BackoffPoller(10, delay=0.1, jitter=0, sleeper=mock_sleeper)
+    assert poller.check(probe) == 3
+    assert [c.args[0] for c in mock_sleeper.call_args_list] == pytest.approx([0.1, 0.2, 0.4])
+
+
+def test_backoff_poller_check_deadline():
+    """Polling should stop at the deadline without sleeping past it."""
+    clock = Mock(side_effect=[0, 0.7, 1.4])
+    mock_sleeper = Mock()
+    probe = UntilProbe(Mock(return_value=0), 1)
+    poller = BackoffPoller(1, delay=0.5, jitter=0, sleeper=mock_sleeper, clock=clock)
+    with pytest.raises(AssertionError):
+        poller.check(probe)
+
+    assert [c.args[0] for c in mock_sleeper.call_args_list] == pytest.approx([0.3])
+
+
+def test_backoff_poller_check_probe_delay():
+    """Polling should sleep for the delay requested by the probe."""
+    mock_sleeper = Mock()
+    probe = Mock(side_effect=[ProbeResult(False, delay=0.01), ProbeResult(True, "ready")])
+    poller = BackoffPoller(10, sleeper=mock_sleeper)
+    assert poller.check(probe) == "ready"
+    mock_sleeper.assert_called_once_with(0.01)
+
+
+def test_backoff_poller_check_raised():
+    """Polling should raise the exception of the last probe."""
+    probe = CatchingProbe(Mock(side_effect=KeyError), KeyError)
+    with pytest.raises(KeyError):
+        BackoffPoller(0).check(probe)
+
+
 @pytest.mark.parametrize(
     "func, value, result",
     [
@@ -155,3 +282,155 @@ def test_catching_probe_uncaught():
 
     with pytest.raises(KeyError):
         probe()
+
+
+def test_multi_poller_check_empty():
+    """Polling no probes should return immediately."""
+    assert MultiPoller().check([]) == []
+
+
+def test_multi_poller_check_returns():
+    """Polling many probes should return the value of each probe."""
+    probes = [UntilProbe(Mock(side_effect=partial(next, count())), n) for n in range(3)]
+    poller = MultiPoller(BackoffPoller(10, delay=0))
+    assert poller.check(probes) == [0, 1, 2]
+
+
+def test_multi_poller_check_concurrent():
+    """Probes should be polled concurrently rather than sequentially."""
+    barrier = Barrier(3, timeout=10)
+    probes = [UntilProbe(barrier.wait, is_(int)) for _ in range(3)]
+    assert len(MultiPoller().check(probes)) == 3
+
+
+def test_multi_poller_check_failures():
+    """Polling should report the failed probes with their last result."""
+    success = UntilProbe(Mock(return_value=1), 1)
+    failure = UntilProbe(Mock(return_value=0), 1)
+    poller = MultiPoller(BackoffPoller(0))
+    with pytest.raises(PollingError) as error:
+        poller.check([success, failure])
+
+    assert error.value.failures == [(failure, ProbeResult(False, 0))]
+
+
+def test_tcp_probe_listening():
+    """Probing a listening port should succeed."""
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        probe = TcpProbe(*server.getsockname())
+        assert probe()
+
+
+def test_tcp_probe_closed():
+    """Probing a closed port should fail with the connection error."""
+    probe = TcpProbe("127.0.0.1", get_open_port())
+    assert_that(probe(), has_properties(success=False, raised=is_(OSError)))
+
+
+def test_unix_socket_probe(tmp_path):
+    """Probing a unix socket should only succeed while listening."""
+    path = tmp_path / "server.sock"
+    probe = UnixSocketProbe(path)
+    assert_that(probe(), has_properties(success=False, raised=is_(OSError)))
+    with socket.socket(socket.AF_UNIX) as server:
+        server.bind(str(path))
+        server.listen()
+        assert probe()
+
+    # The socket file is left behind by the server.
+    assert not probe()
+
+
+def test_tcp_probe_from_container_direct():
+    """Probing a container directly should connect to its IP when routable."""
+    container = Mock(network_ips=["172.17.0.2"], port_binding=80)
+    with patch("pytest_xdocker.network.is_routable_ip", Mock(return_value=True)):
+        assert TcpProbe.from_container(container, direct=True) == TcpProbe("172.17.0.2", 80)
+
+
+def test_tcp_probe_from_container_direct_routable():
+    """Probing a container directly should connect to its first routable IP."""
+    container = Mock(network_ips=["10.0.0.2", "172.17.0.2"], port_binding=80)
+    with patch("pytest_xdocker.network.is_routable_ip", Mock(side_effect=lambda ip: ip.startswith("172."))):
+        assert TcpProbe.from_container(container, direct=True) == TcpProbe("172.17.0.2", 80)
+
+
+def test_tcp_probe_from_container_direct_network():
+    """Probing a container directly on a network should only connect to its IP on that network."""
+    container = Mock(network_ip=Mock(return_value="172.17.0.2"), port_binding=80)
+    with patch("pytest_xdocker.network.is_routable_ip", Mock(return_value=True)):
+        assert TcpProbe.from_container(container, direct=True, network="user") == TcpProbe("172.17.0.2", 80)
+
+    container.network_ip.assert_called_once_with("user")
+
+
+def test_tcp_probe_from_container_direct_fallback():
+    """Probing a container directly should fallback to the published port when not routable."""
+    container = Mock(network_ips=["172.17.0.2"], host_ip=Mock(return_value="1.2.3.4"))
+    container.host_port.return_value = 1234
+    with patch("pytest_xdocker.network.is_routable_ip", Mock(return_value=False)):
+        assert TcpProbe.from_container(container, 80, direct=True) == TcpProbe("1.2.3.4", 1234)
+
+
+def test_tcp_probe_from_container():
+    """Probing a container on all interfaces should connect to localhost."""
+    container = Mock(host_ip=Mock(return_value="0.0.0.0"), host_port=Mock(return_value=1234))  # noqa: S104
+    assert TcpProbe.from_container(container) == TcpProbe("127.0.0.1", 1234)
+
+
+@pytest.mark.parametrize(
+    "path, status, success",
+    [
+        ("/200", 200, True),
+        ("/404", 200, False),
+        ("/404", 404, True),
+    ],
+)
+def test_http_probe_status(http_server, path, status, success):
+    """Probing HTTP should compare the response status."""
+    probe = HttpProbe(*http_server.server_address, path=path, status=status)
+    assert probe().success == success
+
+
+def test_http_probe_reuses_connection(http_server):
+    """Probing HTTP many times should reuse the same connection."""
+    probe = HttpProbe(*http_server.server_address, path="/200")
+    probe()
+    sock = probe._connection.sock
+    probe()
+    assert probe._connection.sock is sock
+
+
+def test_http_probe_closed():
+    """Probing HTTP on a closed port should fail with the connection error."""
+    probe = HttpProbe("127.0.0.1", get_open_port())
+    assert_that(probe(), has_properties(success=False, raised=is_(OSError)))
+
+
+@pytest.mark.parametrize(
+    "code, success",
+    [
+        (0, True),
+        (1, False),
+    ],
+)
+def test_command_probe(code, success):
+    """Probing a command should check its exit status."""
+    command = Command(sys.executable).with_optionals("-c", f"raise SystemExit({code})")
+    assert CommandProbe(command)().success == success
+
+
+def test_log_probe(tmp_path):
+    """Probing a log should only match complete new lines."""
+    path = tmp_path / "log"
+    probe = LogProbe(path, "^Ready")
+    assert not probe()
+
+    path.write_text("Booting\nRea")
+    assert not probe()
+
+    with path.open("a") as f:
+        f.write("dy!\n")
+    assert_that(probe(), has_properties(success=True, returned="Ready!"))
@@ -0,0 +1,58 @@
+"""Unit tests for the trace module."""
+
+from unittest.mock import patch
+
+from hamcrest import (
+    assert_that,
+    contains_exactly,
+    has_entries,
+)
+
+from pytest_xdocker.trace import Tracer, load_trace, start_trace
+
+
+def test_tracer_disabled(tmp_path):
+    """A tracer without path should not write anything."""
+    tracer = Tracer()
+    with tracer.span("run"):
+        pass
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_tracer_span(tmp_path):
+    """A span should be written as a complete event with its attributes."""
+    path = tmp_path / "trace.json"
+    tracer = Tracer(path)
+    with patch.dict("os.environ", {"PYTEST_XDIST_WORKER": "gw1"}), tracer.span("run", container="test"):
+        pass
+
+    assert_that(
+        load_trace(path),
+        contains_exactly(
+            has_entries(ph="M", args={"name": "gw1"}),
+            has_entries(name="run", ph="X", args={"worker": "gw1", "container": "test"}),
+        ),
+    )
+
+
+def test_tracer_spans_append(tmp_path):
+    """Spans from many tracers should append to a started trace."""
+    path = tmp_path / "trace.json"
+    start_trace(path)
+    for name in ["first", "second"]:
+        with Tracer(path).span(name):
+            pass
+
+    events = [event["name"] for event in load_trace(path) if event["ph"] == "X"]
+    assert events == ["first", "second"]
+
+
+def test_start_trace_truncates(tmp_path):
+    """Starting a trace should remove the previous events."""
+    path = tmp_path / "trace.json"
+    with Tracer(path).span("previous"):
+        pass
+
+    start_trace(path)
+    assert load_trace(path) == []
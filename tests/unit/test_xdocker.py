@@ -1,6 +1,8 @@
 """Unit tests for the xdocker module."""
 
-from subprocess import CalledProcessError
+import os
+import sys
+from subprocess import CalledProcessError, run
 from unittest.mock import Mock, patch
 
 import pytest
@@ -9,12 +11,14 @@
     has_properties,
 )
 
+from pytest_xdocker import xdocker
 from pytest_xdocker.docker import DockerContainer
 from pytest_xdocker.xdocker import (
     docker_call,
     docker_remove,
     docker_run,
     docker_up,
+    get_xdocker,
     main,
     monitor_container,
 )
@@ -145,3 +149,27 @@ def test_main_detach(capsys):
 
     captured = capsys.readouterr()
     assert "Cannot pass --detach" in captured.err
+
+
+def test_import_time():
+    """Importing the script should not look for xdocker nor import psutil."""
+    result = run(
+        [sys.executable, "-X", "importtime", "-c", "import pytest_xdocker.xdocker"],
+        capture_output=True,
+        check=True,
+        env={**os.environ, "PATH": ""},
+        text=True,
+    )
+    modules = {line.rsplit("|", 1)[-1].strip() for line in result.stderr.splitlines()}
+    assert not modules & {"netifaces", "psutil", "xprocess"}
+
+
+def test_xdocker_attribute():
+    """The xdocker command should be resolved on first access."""
+    assert xdocker.xdocker is get_xdocker()
+
+
+def test_unknown_attribute():
+    """Accessing an unknown attribute should still raise."""
+    with pytest.raises(AttributeError):
+        xdocker.unknown  # noqa: B018